@@ -15,9 +15,13 @@ from .func import (
     minimum,
     maximum,
     every,
+    exist,
+    last,
     count,
     hhv,
     llv,
+    hhvbars,
+    llvbars,
     Ref,
     iif,
     box_top_bottom,
@@ -31,6 +35,9 @@ from .context import (
     set_start_date,
     set_data_backend,
     set_current_freq,
+    set_lazy,
+    set_fusion,
+    get_trading_calendar,
 )
 from .helper import select
 
@@ -65,9 +72,13 @@ REF = Ref
 MIN = minimum
 MAX = maximum
 EVERY = every
+EXIST = exist
+LAST = last
 COUNT = count
 HHV = hhv
 LLV = llv
+HHVBARS = hhvbars
+LLVBARS = llvbars
 IF = IIF = iif
 BTB = box_top_bottom
 
@@ -100,9 +111,13 @@ __all__ = [
     "MAX",
     "MIN",
     "EVERY",
+    "EXIST",
+    "LAST",
     "COUNT",
     "HHV",
     "LLV",
+    "HHVBARS",
+    "LLVBARS",
     "IF", "IIF",
 
     "S",
@@ -117,4 +132,7 @@ __all__ = [
     "set_start_date",
     "set_data_backend",
     "set_current_freq",
+    "set_lazy",
+    "set_fusion",
+    "get_trading_calendar",
 ]
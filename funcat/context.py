@@ -2,6 +2,7 @@
 #
 
 import datetime
+import contextlib
 
 import six
 
@@ -11,12 +12,22 @@ from .utils import get_int_date
 class ExecutionContext(object):
     stack = []
 
-    def __init__(self, date=None, order_book_id=None, data_backend=None, freq="1d", start_date=datetime.date(2005, 1, 1)):
+    def __init__(self, date=None, order_book_id=None, data_backend=None, freq="1d", start_date=datetime.date(2005, 1, 1),
+                 lazy=False, bar_count=None, fusion=True, memo=False):
         self._current_date = self._convert_date_to_int(date)
         self._start_date = self._convert_date_to_int(start_date)
         self._order_book_id = order_book_id
         self._data_backend = data_backend
         self._freq = freq
+        self._lazy = lazy
+        self._tracing = False
+        # 惰性模式下连续的逐元素运算合并计算，见 time_series.get_fused_expr
+        self._fusion = fusion
+        # 只用最近 bar_count 根 bar 计算，见 set_bar_count
+        self._bar_count = bar_count
+        self._fetch_start_date = None
+        # 当前股票、日期下已计算的结果，见 time_series.memo_call 和 memoize，为 None 时不缓存
+        self._memo = {} if memo else None
 
     def _push(self):
         self.stack.append(self)
@@ -41,11 +52,17 @@ class ExecutionContext(object):
             date = int(date.strftime("%Y%m%d"))
         return date
 
+    def _set(self, name, value):
+        if getattr(self, name) != value:
+            setattr(self, name, value)
+            if self._memo is not None:
+                self._memo.clear()
+
     def _set_current_date(self, date):
-        self._current_date = self._convert_date_to_int(date)
+        self._set("_current_date", self._convert_date_to_int(date))
 
     def _set_start_date(self, date):
-        self._start_date = self._convert_date_to_int(date)
+        self._set("_start_date", self._convert_date_to_int(date))
 
     @classmethod
     def get_active(cls):
@@ -70,12 +87,30 @@ class ExecutionContext(object):
     def get_start_date(cls):
         return cls.get_active()._start_date
 
+    @classmethod
+    def set_bar_count(cls, bar_count, fetch_start_date=None):
+        """只用最近 bar_count 根 bar 计算，为 None 时用从 start_date 开始的全部历史
+
+        :param fetch_start_date: 从哪天开始取行情，取到的 bar 不够 bar_count 根（比如中间停牌）时仍然从 start_date 开始取
+        """
+        active = cls.get_active()
+        active._set("_bar_count", bar_count)
+        active._set("_fetch_start_date", active._convert_date_to_int(fetch_start_date))
+
+    @classmethod
+    def get_bar_count(cls):
+        return cls.get_active()._bar_count
+
+    @classmethod
+    def get_fetch_start_date(cls):
+        return cls.get_active()._fetch_start_date
+
     @classmethod
     def set_current_security(cls, order_book_id):
         """set current watching order_book_id
         :param order_book_id: "000002.XSHE"
         """
-        cls.get_active()._order_book_id = order_book_id
+        cls.get_active()._set("_order_book_id", order_book_id)
 
     @classmethod
     def get_current_freq(cls):
@@ -83,7 +118,7 @@ class ExecutionContext(object):
 
     @classmethod
     def set_current_freq(cls, freq):
-        cls.get_active()._freq = freq
+        cls.get_active()._set("_freq", freq)
 
     @classmethod
     def get_current_security(cls):
@@ -94,12 +129,117 @@ class ExecutionContext(object):
         """set current watching order_book_id
         :param order_book_id: "000002.XSHE"
         """
-        cls.get_active()._data_backend = data_backend
+        cls.get_active()._set("_data_backend", data_backend)
 
     @classmethod
     def get_data_backend(cls):
         return cls.get_active()._data_backend
 
+    @classmethod
+    def set_lazy(cls, lazy):
+        """开启后，TimeSeries 的运算符和函数只构建表达式，用到值的时候才计算
+        """
+        cls.get_active()._lazy = lazy
+
+    @classmethod
+    def is_lazy(cls):
+        return bool(cls.stack) and cls.stack[-1]._lazy
+
+    @classmethod
+    def set_fusion(cls, fusion):
+        """开启后，惰性模式下连续的算术、比较、逻辑运算合并成一个表达式一次算完，不产生中间的序列
+        """
+        cls.get_active()._fusion = fusion
+
+    @classmethod
+    def is_fusion(cls):
+        return bool(cls.stack) and cls.stack[-1]._fusion
+
+    @classmethod
+    def get_memo(cls):
+        """切换股票、日期、频率、起始日期或者 data_backend 时会被清空，没有开启 memoize 时为 None"""
+        if not cls.stack:
+            return None
+        return cls.stack[-1]._memo
+
+    @classmethod
+    @contextlib.contextmanager
+    def memoize(cls):
+        """临时开启 memo，同一股票、日期下重复的函数调用只计算一次，退出时释放缓存的结果
+
+        select 在整个选股过程中开启，交互使用时默认关闭
+        """
+        if not cls.stack:
+            yield
+            return
+        active = cls.stack[-1]
+        memo, active._memo = active._memo, {}
+        try:
+            yield
+        finally:
+            active._memo = memo
+
+    @classmethod
+    def get_stamp(cls):
+        """决定行情数据的所有状态，表达式的计算结果只在 stamp 不变时有效"""
+        if not cls.stack:
+            return None
+        active = cls.stack[-1]
+        return (id(active._data_backend), active._order_book_id, active._current_date, active._freq, active._start_date,
+                active._bar_count, active._fetch_start_date)
+
+    @classmethod
+    @contextlib.contextmanager
+    def eager(cls):
+        """临时关闭 lazy，用于计算表达式"""
+        if not cls.stack:
+            yield
+            return
+        active = cls.stack[-1]
+        lazy, active._lazy = active._lazy, False
+        try:
+            yield
+        finally:
+            active._lazy = lazy
+
+    @classmethod
+    @contextlib.contextmanager
+    def lazy(cls):
+        """临时开启 lazy，只构建表达式"""
+        if not cls.stack:
+            yield
+            return
+        active = cls.stack[-1]
+        lazy, active._lazy = active._lazy, True
+        try:
+            yield
+        finally:
+            active._lazy = lazy
+
+    @classmethod
+    @contextlib.contextmanager
+    def tracing(cls):
+        """临时开启 lazy，只构建表达式不计算，期间取行情会抛出 FormulaException"""
+        active = cls.get_active()
+        lazy, tracing = active._lazy, active._tracing
+        active._lazy, active._tracing = True, True
+        try:
+            yield
+        finally:
+            active._lazy, active._tracing = lazy, tracing
+
+    @classmethod
+    def is_tracing(cls):
+        return bool(cls.stack) and cls.stack[-1]._tracing
+
+    @classmethod
+    def get_trading_calendar(cls, start=None, end=None):
+        """交易日历至少从 start_date 开始"""
+        active = cls.get_active()
+        if start is None or (active._start_date is not None and active._start_date < start):
+            start = active._start_date
+        return active._data_backend.get_trading_calendar(start, end)
+
 
 def set_data_backend(backend):
     ExecutionContext.set_data_backend(backend)
@@ -129,6 +269,21 @@ def set_current_freq(freq):
     ExecutionContext.set_current_freq(freq)
 
 
+def set_lazy(lazy=True):
+    ExecutionContext.set_lazy(lazy)
+
+
+def set_fusion(fusion=True):
+    ExecutionContext.set_fusion(fusion)
+
+
+def get_trading_calendar():
+    """获取当前 data_backend 的交易日历
+    :rtype: TradingCalendar
+    """
+    return ExecutionContext.get_trading_calendar()
+
+
 def symbol(order_book_id):
     """获取股票代码对应的名字
     :param order_book_id:
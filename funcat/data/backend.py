@@ -1,9 +1,27 @@
 # -*- coding: utf-8 -*-
 #
 
+import time
+import weakref
+
+import numpy as np
+
+from .cache import DEFAULT_TTL, get_today
+from .trading_calendar import TradingCalendar, get_date_int
+from ..utils import FormulaException
+
 
 class DataBackend(object):
     skip_suspended = True
+    # 是否由 1m/1d 在本地合成 5m/15m/30m/60m 和 1w/1M
+    local_resample = False
+    calendar_start_date = 20050101
+    # 包含今天的 get_availability 结果的有效秒数，None 为不过期
+    availability_ttl = DEFAULT_TTL
+
+    _trading_calendar = None
+    _calendar_range = None
+    _availability = None
 
     def get_price(self, order_book_id, start, end, freq):
         """
@@ -16,6 +34,26 @@ class DataBackend(object):
         """
         raise NotImplementedError
 
+    def get_price_many(self, order_book_ids, start, end, freq):
+        """批量获取行情，默认逐个调用 get_price，backend 可以覆盖为批量接口
+
+        :param order_book_ids: [000001.XSHE, 000002.XSHE, ...]
+        :param start: 20160101
+        :param end: 20160201
+        :param freq: 1m 1d 5m 15m ...
+        :returns: {order_book_id: numpy.rec.array}，没有数据的股票不在其中
+        :rtype: dict
+        """
+        result = {}
+        for order_book_id in order_book_ids:
+            try:
+                bars = self.get_price(order_book_id, start, end, freq)
+            except (KeyError, FormulaException):
+                continue
+            if bars is not None and len(bars) > 0:
+                result[order_book_id] = bars
+        return result
+
     def get_order_book_id_list(self):
         """获取所有的
         """
@@ -29,6 +67,84 @@ class DataBackend(object):
         """
         raise NotImplementedError
 
+    def get_trading_calendar(self, start=None, end=None):
+        """获取交易日历，至少覆盖从 calendar_start_date 和 start 中较早的一天到今天和 end 中较晚的一天
+
+        已有的日历覆盖不了时（start 更早，或者过了一天）才重新调用 get_trading_dates
+
+        :param start: 20050101
+        :param end: 20160201
+        :rtype: TradingCalendar
+        """
+        start = min(get_date_int(start), self.calendar_start_date) if start is not None else self.calendar_start_date
+        end = max(get_date_int(end), get_today()) if end is not None else get_today()
+        if self._trading_calendar is not None:
+            calendar_start, calendar_end = self._calendar_range
+            if calendar_start <= start and end <= calendar_end:
+                return self._trading_calendar
+            start = min(start, calendar_start)
+        self._trading_calendar = TradingCalendar(self.get_trading_dates(start, end))
+        self._calendar_range = (start, end)
+        return self._trading_calendar
+
+    def get_availability(self, order_book_id, bars=None, start=None):
+        """获取股票在每个交易日是否有行情（已上市、未停牌、未退市），和交易日历对齐
+
+        :param order_book_id: e.g. 000002.XSHE
+        :param bars: 已经取到的日线或者分钟线，为 None 时通过 get_price 获取日线
+        :param start: bars 是从 start 开始取的，start 之前的交易日都为 False，为 None 时 bars 包含全部历史
+        :returns: 与 get_trading_calendar().dates 等长的 bool 数组
+        :rtype: numpy.ndarray
+        """
+        dates = self.get_trading_calendar().dates
+        entry = self._availability.get(order_book_id) if self._availability is not None else None
+        if entry is not None and self._is_availability_valid(entry, dates, bars, start):
+            return entry[1]
+
+        source = bars
+        if bars is None and len(dates) > 0:
+            try:
+                bars = self.get_price(order_book_id, start if start is not None else int(dates[0]), int(dates[-1]), "1d")
+            except (KeyError, FormulaException):
+                bars = None
+        if bars is None or len(bars) == 0:
+            availability = np.zeros(len(dates), dtype=bool)
+        else:
+            bar_dates = bars["datetime"].astype(np.int64) // 1000000
+            availability = np.isin(dates, bar_dates)
+        self.set_availability(order_book_id, availability, start, source)
+        return availability
+
+    def set_availability(self, order_book_id, availability, start=None, source=None):
+        """缓存 get_availability 的结果
+
+        :param availability: 与 get_trading_calendar().dates 等长的 bool 数组
+        :param start: 从 start 开始有效，为 None 时包含全部历史
+        :param source: 由哪个 bars 得到，之后传入的 bars 不是同一个对象（例如 bar_cache 重新加载过）时重新计算
+        """
+        if self._availability is None:
+            self._availability = {}
+        try:
+            ref = weakref.ref(source) if source is not None else None
+        except TypeError:
+            ref = None
+        self._availability[order_book_id] = (start, availability, ref, time.monotonic())
+
+    def _is_availability_valid(self, entry, dates, bars, start):
+        cached_start, availability, ref, loaded_at = entry
+        # 缓存的结果从 cached_start 开始有效
+        if cached_start is not None and (start is None or cached_start > start):
+            return False
+        # 交易日历更新过
+        if len(availability) != len(dates):
+            return False
+        if bars is not None and ref is not None:
+            return ref() is bars
+        # 包含今天的结果在盘中还会变化
+        if self.availability_ttl is not None and len(dates) > 0 and dates[-1] >= get_today():
+            return time.monotonic() - loaded_at <= self.availability_ttl
+        return True
+
     def symbol(self, order_book_id):
         """获取order_book_id对应的名字
         :param order_book_id str: 股票代码
@@ -36,3 +152,49 @@ class DataBackend(object):
         :rtype: str
         """
         raise NotImplementedError
+
+
+class DataBackendWrapper(DataBackend):
+    """包装另一个 DataBackend，没有覆盖的方法都转发给被包装的 backend
+    """
+
+    def __init__(self, data_backend):
+        self.data_backend = data_backend
+
+    @property
+    def skip_suspended(self):
+        return self.data_backend.skip_suspended
+
+    @property
+    def local_resample(self):
+        return self.data_backend.local_resample
+
+    def __getattr__(self, name):
+        if name == "data_backend":
+            raise AttributeError(name)
+        return getattr(self.data_backend, name)
+
+    def get_price(self, order_book_id, start, end, freq):
+        return self.data_backend.get_price(order_book_id, start, end, freq)
+
+    def get_price_many(self, order_book_ids, start, end, freq):
+        return self.data_backend.get_price_many(order_book_ids, start, end, freq)
+
+    def get_order_book_id_list(self):
+        return self.data_backend.get_order_book_id_list()
+
+    def get_trading_dates(self, start, end):
+        return self.data_backend.get_trading_dates(start, end)
+
+    def get_trading_calendar(self, start=None, end=None):
+        return self.data_backend.get_trading_calendar(start, end)
+
+    def symbol(self, order_book_id):
+        return self.data_backend.symbol(order_book_id)
+
+    def get_availability(self, order_book_id, bars=None, start=None):
+        # 被包装的 backend 可能有自己的结果，例如 RQDataBackend 由停牌标记得到的
+        return self.data_backend.get_availability(order_book_id, bars=bars, start=start)
+
+    def set_availability(self, order_book_id, availability, start=None, source=None):
+        self.data_backend.set_availability(order_book_id, availability, start=start, source=source)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+
+import datetime
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+
+# 全局缓存默认的字节上限
+DEFAULT_MAXBYTES = 1 << 30
+# 加载到今天的数据在盘中还会增加，默认 60 秒后重新加载
+DEFAULT_TTL = 60
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize", "maxbytes", "currbytes"])
+
+
+def get_datetime_int(date, end=False):
+    """把 20160104 或者 20160104093000 统一成 bars["datetime"] 的格式
+    :param date: int date
+    :param end: 只有日期时，是否取当天最后一刻
+    """
+    date = int(date)
+    if date < 100000000:
+        date = date * 1000000 + (235959 if end else 0)
+    return date
+
+
+def get_end_date(end):
+    return end // 1000000 if end > 99999999 else end
+
+
+def get_today():
+    return int(datetime.date.today().strftime("%Y%m%d"))
+
+
+def get_load_end(end):
+    """缓存总是加载到今天为止的数据"""
+    return max(get_end_date(end), get_today())
+
+
+def slice_bars(bars, start=None, end=None):
+    """用二分查找截取 [start, end] 区间内的 bars，返回的是 view，不会 copy
+    :param bars: numpy.rec.array, 按 datetime 升序
+    :param start: 20160101
+    :param end: 20160201
+    """
+    if len(bars) == 0:
+        return bars
+    dt = bars["datetime"]
+    lo = 0 if start is None else np.searchsorted(dt, get_datetime_int(start), side="left")
+    hi = len(dt) if end is None else np.searchsorted(dt, get_datetime_int(end, end=True), side="right")
+    return bars[lo:hi]
+
+
+class BarCache(object):
+    """按 (order_book_id, freq, start_date) 缓存完整的历史 bars
+
+    第一次访问时向 data_backend 取到今天为止的全部数据，
+    之后当前日期变化时只需要对缓存做二分截取。
+    加载到今天的条目超过 ttl 秒或者调用 refresh 之后重新加载。
+
+    :param maxsize: 最多缓存的条数，None 为不限
+    :param maxbytes: 最多缓存的 bars 字节数，None 为不限
+    :param ttl: 加载到今天的条目的有效秒数，None 为不过期
+    """
+
+    def __init__(self, maxsize=8192, maxbytes=None, ttl=DEFAULT_TTL):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.currbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _is_valid(self, entry, end_date):
+        if entry is None or entry[0] < end_date:
+            return False
+        if self.ttl is not None and entry[0] >= get_today():
+            return time.monotonic() - entry[2] <= self.ttl
+        return True
+
+    def get(self, key, end):
+        """取出覆盖到 end 的完整 bars，没有则返回 None"""
+        end_date = get_end_date(end)
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._is_valid(entry, end_date):
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def get_bars(self, data_backend, order_book_id, start, end, freq):
+        """
+        :param data_backend: DataBackend
+        :param order_book_id: e.g. 000002.XSHE
+        :param start: 20160101
+        :param end: 20160201
+        :param freq: 1m 1d 5m 15m ...
+        :returns: bars 截止到 end 的 view
+        :rtype: numpy.rec.array
+        """
+        return slice_bars(self.get_history(data_backend, order_book_id, start, end, freq), end=end)
+
+    def get_history(self, data_backend, order_book_id, start, end, freq):
+        """返回缓存中完整的 bars，至少覆盖到 end"""
+        key = (data_backend, order_book_id, freq, start)
+        bars = self.get(key, end)
+        if bars is not None:
+            return bars
+
+        load_end = get_load_end(end)
+        try:
+            bars = data_backend.get_price(order_book_id, start=start, end=load_end, freq=freq)
+        except KeyError:
+            bars = np.array([])
+
+        self.put(key, load_end, bars)
+        return bars
+
+    def prefetch(self, data_backend, order_book_ids, start, end, freq, chunk_size=200):
+        """通过 get_price_many 批量把还没有缓存的股票加载进来
+
+        :param order_book_ids: [000001.XSHE, 000002.XSHE, ...]
+        :param chunk_size: 每次调用 get_price_many 的股票数量
+        :returns: 新加载的 (股票数量, 字节数)
+        """
+        end_date = get_end_date(end)
+        load_end = get_load_end(end)
+        with self._lock:
+            missing = []
+            for order_book_id in order_book_ids:
+                if not self._is_valid(self._entries.get((data_backend, order_book_id, freq, start)), end_date):
+                    missing.append(order_book_id)
+
+        nbytes = 0
+        for i in range(0, len(missing), chunk_size):
+            chunk = missing[i:i + chunk_size]
+            bars_dict = data_backend.get_price_many(chunk, start=start, end=load_end, freq=freq)
+            for order_book_id in chunk:
+                bars = bars_dict.get(order_book_id)
+                if bars is None:
+                    bars = np.array([])
+                self.put((data_backend, order_book_id, freq, start), load_end, bars)
+                nbytes += bars.nbytes
+        return len(missing), nbytes
+
+    def get_prefetch_size(self, item_bytes, limit):
+        """一次最多预加载多少只股票，预加载的只占缓存的一半，留给公式用到的其他频率，不会把自己挤出去
+
+        :param item_bytes: 每只股票的 bars 大约占多少字节，不知道时为 None
+        :param limit: 不超过这个数量
+        """
+        size = limit
+        if self.maxsize is not None:
+            size = min(size, self.maxsize // 2)
+        if self.maxbytes is not None and item_bytes:
+            size = min(size, int(self.maxbytes // 2 // item_bytes))
+        return max(size, 1)
+
+    def put(self, key, end, bars):
+        # 缓存的 bars 在多个公式、线程间共享，不允许修改
+        bars.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.currbytes -= old[1].nbytes
+            self._entries[key] = (end, bars, time.monotonic())
+            self.currbytes += bars.nbytes
+            while self._entries and (
+                    (self.maxsize is not None and len(self._entries) > self.maxsize) or
+                    (self.maxbytes is not None and self.currbytes > self.maxbytes)):
+                _, evicted = self._entries.popitem(last=False)
+                self.currbytes -= evicted[1].nbytes
+
+    def refresh(self, order_book_id=None):
+        """丢弃加载到今天的条目，下次访问时重新加载当天新增的 bars
+
+        :param order_book_id: 只刷新这只股票，None 为全部
+        """
+        today = get_today()
+        with self._lock:
+            for key in list(self._entries):
+                end, bars, _ = self._entries[key]
+                if end >= today and (order_book_id is None or key[1] == order_book_id):
+                    del self._entries[key]
+                    self.currbytes -= bars.nbytes
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._entries), self.maxbytes, self.currbytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.currbytes = 0
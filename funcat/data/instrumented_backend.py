@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+#
+
+import json
+import time
+import bisect
+import random
+import threading
+from collections import defaultdict
+
+import numpy as np
+import six
+
+from .backend import DataBackendWrapper
+
+
+# 延迟直方图的边界，单位毫秒
+HISTOGRAM_BUCKETS_MS = [0.1, 1, 10, 100, 1000, 10000]
+# 每项统计最多保留多少个耗时样本用来估计分位数
+RESERVOIR_SIZE = 1024
+
+
+def get_result_size(result):
+    """返回 (字节数, 行数)"""
+    if isinstance(result, dict):
+        sizes = [get_result_size(value) for value in result.values()]
+        return sum(s[0] for s in sizes), sum(s[1] for s in sizes)
+    if isinstance(result, np.ndarray):
+        return result.nbytes, len(result)
+    if isinstance(result, (list, tuple)):
+        return 0, len(result)
+    dates = getattr(result, "dates", None)
+    if isinstance(dates, np.ndarray):
+        # TradingCalendar
+        return dates.nbytes, len(dates)
+    return 0, 0
+
+
+class Stats(object):
+    """调用次数、耗时和数据量的统计
+
+    次数、总耗时、最大耗时和直方图是精确的，
+    分位数由最多 reservoir_size 个均匀抽样（reservoir sampling）的耗时估计，内存不随调用次数增长。
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE):
+        self.count = 0
+        self.errors = 0
+        self.nbytes = 0
+        self.rows = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+        self.reservoir_size = reservoir_size
+        self.latencies = []
+
+    def add(self, elapsed, nbytes, rows, error):
+        self.count += 1
+        self.errors += int(error)
+        self.nbytes += nbytes
+        self.rows += rows
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+        self.histogram[bisect.bisect_right(HISTOGRAM_BUCKETS_MS, elapsed * 1000)] += 1
+        if len(self.latencies) < self.reservoir_size:
+            self.latencies.append(elapsed)
+        else:
+            i = random.randrange(self.count)
+            if i < self.reservoir_size:
+                self.latencies[i] = elapsed
+
+    def to_dict(self):
+        result = {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes": self.nbytes,
+            "rows": self.rows,
+            "total_ms": self.total * 1000,
+        }
+        if self.count > 0:
+            p50, p90, p99 = np.percentile(np.array(self.latencies) * 1000, [50, 90, 99])
+            result.update({
+                "mean_ms": self.total * 1000 / self.count,
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p99_ms": float(p99),
+                "max_ms": self.max * 1000,
+                "histogram": list(self.histogram),
+            })
+        return result
+
+
+class InstrumentedBackend(DataBackendWrapper):
+    """统计被包装的 backend 每个方法的调用次数、耗时分布和返回的数据量
+
+    get_price 还会按股票和频率分别统计，可以用来区分 select 的时间有多少花在了取数据上。
+
+    :param data_backend: 被包装的 DataBackend
+    :param callback: 每次调用结束后以 dict 形式回调一次
+    """
+
+    def __init__(self, data_backend, callback=None):
+        super(InstrumentedBackend, self).__init__(data_backend)
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._methods = defaultdict(Stats)
+            self._securities = defaultdict(Stats)
+            self._freqs = defaultdict(Stats)
+
+    def _call(self, method, order_book_id, freq, *args):
+        error = None
+        result = None
+        start = time.perf_counter()
+        try:
+            result = getattr(self.data_backend, method)(*args)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            nbytes, rows = get_result_size(result)
+            with self._lock:
+                self._methods[method].add(elapsed, nbytes, rows, error is not None)
+                if freq is not None:
+                    self._freqs[freq].add(elapsed, nbytes, rows, error is not None)
+                if isinstance(order_book_id, six.string_types):
+                    self._securities[order_book_id].add(elapsed, nbytes, rows, error is not None)
+                elif method == "get_price_many" and result:
+                    # 批量接口的耗时平摊到每只股票上
+                    for key, bars in result.items():
+                        self._securities[key].add(elapsed / len(result), *get_result_size(bars), error=False)
+            if self.callback is not None:
+                self.callback({
+                    "method": method,
+                    "order_book_id": order_book_id,
+                    "freq": freq,
+                    "elapsed": elapsed,
+                    "bytes": nbytes,
+                    "rows": rows,
+                    "error": repr(error) if error is not None else None,
+                })
+
+    def get_price(self, order_book_id, start, end, freq):
+        return self._call("get_price", order_book_id, freq, order_book_id, start, end, freq)
+
+    def get_price_many(self, order_book_ids, start, end, freq):
+        return self._call("get_price_many", None, freq, order_book_ids, start, end, freq)
+
+    def get_order_book_id_list(self):
+        return self._call("get_order_book_id_list", None, None)
+
+    def get_trading_dates(self, start, end):
+        return self._call("get_trading_dates", None, None, start, end)
+
+    def get_trading_calendar(self, start=None, end=None):
+        return self._call("get_trading_calendar", None, None, start, end)
+
+    def symbol(self, order_book_id):
+        return self._call("symbol", None, None, order_book_id)
+
+    def report(self):
+        """
+        :returns: {"methods": {...}, "securities": {...}, "freqs": {...}}
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                "methods": {k: v.to_dict() for k, v in self._methods.items()},
+                "securities": {k: v.to_dict() for k, v in self._securities.items()},
+                "freqs": {k: v.to_dict() for k, v in self._freqs.items()},
+            }
+
+    def dump(self, path_or_buf=None):
+        """以 JSON 格式输出 report
+
+        :param path_or_buf: 文件路径、文件对象或者接收 report 的回调函数，为 None 时返回字符串
+        """
+        report = self.report()
+        if callable(path_or_buf):
+            return path_or_buf(report)
+        if path_or_buf is None:
+            return json.dumps(report, indent=2)
+        if isinstance(path_or_buf, six.string_types):
+            with open(path_or_buf, "w") as f:
+                json.dump(report, f, indent=2)
+        else:
+            json.dump(report, path_or_buf, indent=2)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+
+import os
+import json
+import bisect
+
+import numpy as np
+
+from .backend import DataBackend
+from .cache import get_datetime_int
+from .trading_calendar import TradingCalendar
+
+
+# 目录结构:
+#
+#     <store_path>/
+#         trading_dates.dat       int64 交易日, 20160104
+#         instruments.json        {order_book_id: symbol}
+#         <freq>/
+#             index.json          {"version": 2, "fields": [[name, dtype], ...],
+#                                  "file": "bars.1.dat", "rows": 行数, "start": 20050101,
+#                                  "securities": {order_book_id: [offset, length, capacity]}}
+#             bars.<n>.dat        所有股票的 bars 按记录存放，每只股票占连续的 capacity 行，
+#                                 其中前 length 行有效，按 datetime 升序
+#
+# 按记录存放，get_price 返回的是 memmap 的一段 view，不需要 copy。
+# 增量更新时新的 bars 写进预留的行，index.json 是唯一的提交点。
+
+TRADING_DATES_FILE = "trading_dates.dat"
+INSTRUMENTS_FILE = "instruments.json"
+INDEX_FILE = "index.json"
+STORE_VERSION = 2
+
+FIELDS = [
+    ("datetime", "<u8"),
+    ("open", "<f8"),
+    ("high", "<f8"),
+    ("low", "<f8"),
+    ("close", "<f8"),
+    ("volume", "<f8"),
+    ("total_turnover", "<f8"),
+]
+BAR_DTYPE = np.dtype(FIELDS)
+
+FREQ_ALIASES = {
+    "D": "1d",
+    "W": "1w",
+}
+
+
+def open_records(path, dtype, length):
+    if length == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(length, ))
+
+
+def search_datetime(dt, value, side):
+    """在 bars["datetime"] 中二分查找
+
+    记录中的一列不是连续的，np.searchsorted 会先把整列复制一遍，这里只访问 log(n) 个元素
+    """
+    if side == "left":
+        return bisect.bisect_left(dt, value)
+    return bisect.bisect_right(dt, value)
+
+
+class FreqStore(object):
+    """单个频率下所有股票 bars 的 memmap"""
+
+    def __init__(self, path):
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            meta = json.load(f)
+        if meta.get("version") != STORE_VERSION:
+            raise ValueError("store {} is built by an older version of funcat, "
+                             "rebuild it with funcat-build-store --rebuild".format(path))
+        self.path = path
+        self.meta = meta
+        self.dtype = np.dtype([(name, dtype) for name, dtype in meta["fields"]])
+        self.index = {order_book_id: tuple(loc[:2]) for order_book_id, loc in meta["securities"].items()}
+        self.bars = open_records(os.path.join(path, meta["file"]), self.dtype, meta["rows"]).view(np.recarray)
+
+
+class MemmapDataBackend(DataBackend):
+    """
+    从本地存储中读取行情，bars 按记录存放，每只股票的 bars 是连续的一段，
+    get_price 返回 np.memmap 的 view，多个进程可以共享同一份 page cache。
+    存储由 funcat-build-store 生成，其余频率由 1m/1d 在本地合成。
+    """
+    skip_suspended = True
+    local_resample = True
+
+    def __init__(self, store_path):
+        self.store_path = os.path.expanduser(store_path)
+        self._stores = {}
+        self._trading_dates = None
+        self._instruments = None
+
+    def _get_store(self, freq):
+        freq = FREQ_ALIASES.get(freq, freq)
+        store = self._stores.get(freq)
+        if store is None:
+            path = os.path.join(self.store_path, freq)
+            if not os.path.exists(os.path.join(path, INDEX_FILE)):
+                raise KeyError("freq {} not in store {}".format(freq, self.store_path))
+            store = self._stores[freq] = FreqStore(path)
+        return store
+
+    @property
+    def trading_dates(self):
+        if self._trading_dates is None:
+            # 交易日很少，直接读进内存，更新时可以替换文件
+            self._trading_dates = np.fromfile(os.path.join(self.store_path, TRADING_DATES_FILE), dtype=np.int64)
+        return self._trading_dates
+
+    @property
+    def instruments(self):
+        if self._instruments is None:
+            with open(os.path.join(self.store_path, INSTRUMENTS_FILE)) as f:
+                self._instruments = json.load(f)
+        return self._instruments
+
+    def get_price(self, order_book_id, start, end, freq):
+        """
+        :param order_book_id: e.g. 000002.XSHE
+        :param start: 20160101
+        :param end: 20160201
+        :param freq: 1m 1d 5m 15m ...
+        :returns:
+        :rtype: numpy.rec.array
+        """
+        store = self._get_store(freq)
+        try:
+            offset, length = store.index[order_book_id]
+        except KeyError:
+            raise KeyError("empty bars {}".format(order_book_id))
+
+        dt = store.bars["datetime"][offset:offset + length]
+        lo = offset + search_datetime(dt, get_datetime_int(start), side="left")
+        hi = offset + search_datetime(dt, get_datetime_int(end, end=True), side="right")
+        if hi <= lo:
+            raise KeyError("empty bars {}".format(order_book_id))
+
+        return store.bars[lo:hi]
+
+    def get_order_book_id_list(self):
+        """获取所有的股票代码列表
+        """
+        return sorted(self.instruments)
+
+    def get_trading_dates(self, start, end):
+        """获取所有的交易日
+
+        :param start: 20160101
+        :param end: 20160201
+        """
+        return self.get_trading_calendar().get_trading_dates(start, end).tolist()
+
+    def get_trading_calendar(self, start=None, end=None):
+        # 日历就是存储中的交易日，不会更新
+        if self._trading_calendar is None:
+            self._trading_calendar = TradingCalendar(self.trading_dates)
+        return self._trading_calendar
+
+    def symbol(self, order_book_id):
+        """获取order_book_id对应的名字
+        :param order_book_id str: 股票代码
+        :returns: 名字
+        :rtype: str
+        """
+        return self.instruments.get(order_book_id, order_book_id)
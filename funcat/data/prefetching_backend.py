@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .backend import DataBackendWrapper
+from .cache import slice_bars
+
+
+class PrefetchingBackend(DataBackendWrapper):
+    """在后台线程中预先加载接下来要用到的股票行情
+
+    调用 prefetch 告知接下来访问股票的顺序后，会一直保持最多 depth 只股票在加载中或已加载完成，
+    当前公式计算的同时，下一批股票的 IO 已经在进行。被包装的 backend 需要是线程安全的。
+
+    :param data_backend: 被包装的 DataBackend
+    :param depth: 最多提前加载多少只股票
+    :param max_workers: 线程池的线程数
+    :param max_bytes: 已加载但还没被取走的 bars 最多占用的字节数
+    """
+
+    def __init__(self, data_backend, depth=16, max_workers=4, max_bytes=256 * 1024 ** 2):
+        super(PrefetchingBackend, self).__init__(data_backend)
+        self.depth = depth
+        self.max_workers = max_workers
+        self.max_bytes = max_bytes
+        self._lock = threading.RLock()
+        self._executor = None
+        self._window = None
+        self._queue = deque()
+        self._futures = {}
+        self._ready = {}
+        self._ready_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def prefetch(self, order_book_ids, start, end, freq):
+        """按顺序预加载 order_book_ids 在 [start, end] 之间的行情，会取消之前的预加载
+
+        :param order_book_ids: [000001.XSHE, 000002.XSHE, ...]
+        :param start: 20160101
+        :param end: 20160201
+        :param freq: 1m 1d 5m 15m ...
+        """
+        with self._lock:
+            self._cancel()
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+            self._window = (start, end, freq)
+            self._queue = deque(order_book_ids)
+            self._fill()
+
+    def get_price(self, order_book_id, start, end, freq):
+        with self._lock:
+            future = None
+            if self._covers(start, end, freq):
+                future = self._futures.pop(order_book_id, None)
+                if future is None:
+                    self._remove_from_queue(order_book_id)
+
+        if future is None:
+            return self.data_backend.get_price(order_book_id, start, end, freq)
+
+        try:
+            bars = future.result()
+        finally:
+            with self._lock:
+                self._ready_bytes -= self._ready.pop(future, 0)
+                self._fill()
+        return slice_bars(bars, start, end)
+
+    def cancel_prefetch(self):
+        """取消所有还没开始的预加载，丢弃已加载但还没被取走的结果，之后仍然可以再次 prefetch"""
+        with self._lock:
+            self._cancel()
+
+    def close(self):
+        """取消所有还没开始的预加载，等待正在进行的加载结束"""
+        with self._lock:
+            self._cancel()
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def _covers(self, start, end, freq):
+        if self._window is None:
+            return False
+        window_start, window_end, window_freq = self._window
+        return freq == window_freq and window_start <= start and end <= window_end
+
+    def _remove_from_queue(self, order_book_id):
+        try:
+            self._queue.remove(order_book_id)
+        except ValueError:
+            pass
+
+    def _fill(self):
+        if self._executor is None or self._window is None:
+            return
+        start, end, freq = self._window
+        while self._queue and len(self._futures) < self.depth and self._ready_bytes < self.max_bytes:
+            order_book_id = self._queue.popleft()
+            if order_book_id in self._futures:
+                continue
+            future = self._executor.submit(self.data_backend.get_price, order_book_id, start, end, freq)
+            self._futures[order_book_id] = future
+            future.add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        if future.cancelled() or future.exception() is not None:
+            return
+        with self._lock:
+            if any(f is future for f in self._futures.values()):
+                nbytes = getattr(future.result(), "nbytes", 0)
+                self._ready[future] = nbytes
+                self._ready_bytes += nbytes
+
+    def _cancel(self):
+        for future in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._ready.clear()
+        self._ready_bytes = 0
+        self._queue.clear()
+        self._window = None
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+#
+
+import threading
+import weakref
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from .cache import get_datetime_int
+
+
+WEEKLY_FREQS = ("1w", "W")
+MONTHLY_FREQS = ("1M", "M")
+
+
+def get_source_freq(freq):
+    """freq 可以由哪个频率合成，不能合成则返回 None
+
+    5m/15m/30m/60m 由 1m 合成，1w/W/1M/M 由 1d 合成
+    """
+    if freq in WEEKLY_FREQS or freq in MONTHLY_FREQS:
+        return "1d"
+    if freq.endswith("m") and freq[:-1].isdigit() and int(freq[:-1]) > 1:
+        return "1m"
+    return None
+
+
+def get_days(date):
+    """20160104 -> 1970-01-01 以来的天数"""
+    year, month, day = date // 10000, date // 100 % 100, date % 100
+    months = ((year - 1970) * 12 + month - 1).astype("datetime64[M]")
+    return months.astype("datetime64[D]").astype(np.int64) + day - 1
+
+
+def get_bucket_ids(dt, freq):
+    """每根 bar 所属的周期编号，同一周期的 bar 编号相同且连续
+
+    分钟线按 A 股交易时段切分，9:31-10:30 为第一根 60m，13:01-14:00 为第三根 60m
+    """
+    dt = np.asarray(dt, dtype=np.int64)
+    date = dt // 1000000
+    if freq in WEEKLY_FREQS:
+        # 1970-01-05 是周一
+        return (get_days(date) - 4) // 7
+    if freq in MONTHLY_FREQS:
+        return date // 100
+
+    n = int(freq[:-1])
+    hhmm = dt // 100 % 10000
+    minute = hhmm // 100 * 60 + hhmm % 100
+    session_minute = np.where(minute <= 11 * 60 + 30, minute - (9 * 60 + 30), minute - 13 * 60 + 120)
+    return date * 1000 + (np.maximum(session_minute, 1) - 1) // n
+
+
+def aggregate(bars, starts, ends):
+    """按 [starts[i], ends[i]] 合并 bars"""
+    result = np.empty(len(starts), dtype=bars.dtype)
+    for name in bars.dtype.names:
+        column = bars[name]
+        if name == "open":
+            result[name] = column[starts]
+        elif name == "high":
+            result[name] = np.maximum.reduceat(column, starts)
+        elif name == "low":
+            result[name] = np.minimum.reduceat(column, starts)
+        elif name in ("volume", "total_turnover"):
+            result[name] = np.add.reduceat(column, starts)
+        else:
+            result[name] = column[ends]
+    result = result.view(np.recarray)
+    result.flags.writeable = False
+    return result
+
+
+def resample_bars(bars, freq):
+    """把 1m 合成 5m/15m/30m/60m，或者把 1d 合成 1w/1M
+
+    :param bars: numpy.rec.array, 按 datetime 升序
+    :returns: (合成后的 bars, 每个周期在原 bars 中的起始位置)
+    """
+    if len(bars) == 0:
+        # 不引用原来的 bars，见 Resampler
+        return bars.copy(), np.array([], dtype=np.int64)
+    ids = get_bucket_ids(bars["datetime"], freq)
+    starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+    ends = np.r_[starts[1:], len(ids)] - 1
+    return aggregate(bars, starts, ends), starts
+
+
+class Resampler(object):
+    """缓存完整历史合成后的结果，截止日期落在某个周期中间时只重新合成最后一根 bar
+
+    只保存源历史的弱引用，源历史被 bar_cache 淘汰、不再被使用之后，对应的条目也随之丢弃。
+    """
+
+    def __init__(self, maxsize=8192):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # 源历史已经被回收的 (key, weakref)，弱引用的回调中不能加锁，留到下次访问时删除
+        self._dead = deque()
+        self._lock = threading.Lock()
+
+    def _purge(self):
+        while self._dead:
+            key, ref = self._dead.popleft()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._entries[key]
+
+    def get_bars(self, key, history, freq, end):
+        """
+        :param key: 缓存的 key
+        :param history: 源频率的完整历史 bars
+        :param freq: 目标频率
+        :param end: 截止时间 20160104 或 20160104103000
+        """
+        with self._lock:
+            self._purge()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is history:
+                self._entries.move_to_end(key)
+            else:
+                entry = None
+        if entry is None:
+            dead = self._dead
+            ref = weakref.ref(history, lambda ref, key=key: dead.append((key, ref)))
+            entry = (ref, ) + resample_bars(history, freq)
+            with self._lock:
+                self._purge()
+                self._entries[key] = entry
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+
+        _, resampled, starts = entry
+        if len(resampled) == 0:
+            return resampled
+        count = np.searchsorted(history["datetime"], get_datetime_int(end, end=True), side="right")
+        if count == len(history):
+            return resampled
+        # 最后一个周期只合成截止日期之前的部分
+        k = np.searchsorted(starts, count - 1, side="right") - 1
+        if k < 0:
+            return resampled[:0]
+        if k + 1 < len(starts) and starts[k + 1] == count:
+            return resampled[:k + 1]
+        last = aggregate(history[starts[k]:count], np.array([0]), np.array([count - 1 - starts[k]]))
+        result = np.concatenate([resampled[:k], last]).view(np.recarray)
+        result.flags.writeable = False
+        return result
+
+    def __len__(self):
+        with self._lock:
+            self._purge()
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dead.clear()
@@ -9,7 +9,7 @@ import numpy as np
 from numpy.lib import recfunctions as rfn
 
 from .backend import DataBackend
-from ..utils import get_date_from_int, get_int_date
+from ..utils import get_date_from_int, get_int_date, FormulaException
 
 MAX_BAR_COUNT = 10000
 
@@ -37,6 +37,21 @@ class RQAlphaDataBackend(DataBackend):
             data_bundle_path = self.rqalpha_path
         self.data_proxy = DataProxy(BaseDataSource(os.path.expanduser(data_bundle_path), {}), None)
 
+    def _get_history_kwargs(self, start, end, freq):
+        assert freq in ("1d", "1w", "1m", "5m", "10m", "15m", "30m", "60m", "D", "W")
+        start = get_date_from_int(start)
+        end = get_date_from_int(end)
+        dt = datetime.datetime.combine(end, datetime.time(16, 30, 0))
+        if freq in ("1d","D"):
+            bar_count = min(MAX_BAR_COUNT, (end - start).days)
+            return dict(bar_count=bar_count, frequency="1d", field=None, dt=dt)
+        elif freq in ("1w","W"):
+            bar_count = min(MAX_BAR_COUNT, int((end - start).days / 7)) + 1
+            return dict(bar_count=bar_count, frequency="1w", field=None, dt=dt)
+        else:
+            return dict(bar_count=-1, frequency=freq, field=None, dt=dt,
+                        adjust_orig=datetime.datetime.combine(start - datetime.timedelta(days=1), datetime.time(16, 30, 0)))
+
     def get_price(self, order_book_id, start, end, freq):
         """
         :param order_book_id: e.g. 000002.XSHE
@@ -48,32 +63,37 @@ class RQAlphaDataBackend(DataBackend):
         if self.data_proxy is None:
             self.init()
 
-        assert freq in ("1d", "1w", "1m", "5m", "10m", "15m", "30m", "60m", "D", "W")
-        start = get_date_from_int(start)
-        end = get_date_from_int(end)
-        if freq in ("1d","D"):
-            bar_count = min(MAX_BAR_COUNT, (end - start).days)
-            bars = self.data_proxy.history_bars(
-                order_book_id, bar_count, "1d", field=None,
-                dt=datetime.datetime.combine(end, datetime.time(16, 30, 0)))
-        elif freq in ("1w","W"):
-            bar_count = min(MAX_BAR_COUNT, int((end - start).days / 7)) + 1
-            bars = self.data_proxy.history_bars(
-                order_book_id, bar_count, "1w", field=None,
-                dt=datetime.datetime.combine(end, datetime.time(16, 30, 0)))
-        else:
-            bars = self.data_proxy.history_bars(
-                order_book_id, -1, freq, field=None,
-                dt=datetime.datetime.combine(end, datetime.time(16, 30, 0)),
-                adjust_orig=datetime.datetime.combine(start - datetime.timedelta(days=1), datetime.time(16, 30, 0)))
-            pass
+        bars = self.data_proxy.history_bars(order_book_id, **self._get_history_kwargs(start, end, freq))
         if bars is None or len(bars) == 0:
             raise KeyError("empty bars {}".format(order_book_id))
-        # 只读暂不copy
-        # bars = bars.copy()
+        # 不需要 copy，缓存的 bars 会被设为只读
         self._datetime = bars["datetime"]
         return bars
 
+    def get_price_many(self, order_book_ids, start, end, freq):
+        """批量获取行情，只初始化和计算一次参数，没有数据或者取数出错的股票直接跳过
+
+        :param order_book_ids: [000001.XSHE, 000002.XSHE, ...]
+        :param start: 20160101
+        :param end: 20160201
+        :returns: {order_book_id: numpy.rec.array}
+        :rtype: dict
+        """
+        if self.data_proxy is None:
+            self.init()
+
+        kwargs = self._get_history_kwargs(start, end, freq)
+        history_bars = self.data_proxy.history_bars
+        result = {}
+        for order_book_id in order_book_ids:
+            try:
+                bars = history_bars(order_book_id, **kwargs)
+            except (KeyError, FormulaException):
+                continue
+            if bars is not None and len(bars) > 0:
+                result[order_book_id] = bars
+        return result
+
     def get_order_book_id_list(self, type="CS"):
         """获取所有的
         """
@@ -111,8 +131,8 @@ class RQAlphaDataBackend(DataBackend):
             
         start = get_date_from_int(start)
         end = get_date_from_int(end)
-        trading_dates = self.data_proxy.get_trading_dates(start, end).tolist()
-        trading_dates = [get_int_date(dt.date()) for dt in trading_dates]
+        dates = self.data_proxy.get_trading_dates(start, end)
+        trading_dates = (dates.year * 10000 + dates.month * 100 + dates.day).tolist()
         return trading_dates
 
     def get_previous_trading_date(self, start):
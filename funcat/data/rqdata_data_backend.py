@@ -1,15 +1,30 @@
 # -*- coding: utf-8 -*-
 #
 from funcat.data.backend import DataBackend
+from funcat.data.cache import BarCache, slice_bars, get_load_end
 from funcat.utils import get_str_date_from_int, get_int_date, FormulaException
 
 from functools import lru_cache
 
+import numpy as np
+
 
 class RQDataBackend(DataBackend):
-    def __init__(self):
+    """
+    每只股票只从 rqdatac 取一次 start_date 到今天的完整数据，
+    之后任意 (start, end) 都从缓存中截取。
+    返回的只是完整数据的一部分时返回 copy，这样别处缓存的 bars 不会让整段完整数据一直留在内存里，
+    cache_bytes 才是真正的上限。
+
+    :param start_date: 缓存的起始日期，更早的请求不走缓存
+    :param cache_bytes: 缓存的 bars 最多占用的字节数
+    """
+
+    def __init__(self, start_date=20050101, cache_bytes=2 * 1024 ** 3):
         import rqdatac
         self.rqdatac = rqdatac
+        self.start_date = start_date
+        self._cache = BarCache(maxsize=None, maxbytes=cache_bytes)
 
     @staticmethod
     def convert_date_to_int(dt):
@@ -23,8 +38,20 @@ class RQDataBackend(DataBackend):
         t += dt.hour * 10000 + dt.minute * 100 + dt.second
         return t
 
-    @lru_cache(4096)
-    def get_price(self, order_book_id, start, end, freq):
+    @staticmethod
+    def convert_df_to_records(df, suspended):
+        df["suspended"] = suspended
+        df = df[df["suspended"] == False]
+
+        df = df.reset_index()
+        df["datetime"] = df["index"].apply(RQDataBackend.convert_dt_to_int)
+        del df["index"]
+
+        arr = df.to_records()
+
+        return arr
+
+    def fetch_price(self, order_book_id, start, end, freq):
         start = get_str_date_from_int(start)
         end = get_str_date_from_int(end)
 
@@ -34,16 +61,112 @@ class RQDataBackend(DataBackend):
         if suspended_df is None:
             raise FormulaException("missing data {}".format(order_book_id))
 
-        df["suspended"] = suspended_df[order_book_id]
-        df = df[df["suspended"] == False]
+        self.set_suspended(order_book_id, suspended_df[order_book_id])
+        return self.convert_df_to_records(df, suspended_df[order_book_id])
 
-        df = df.reset_index()
-        df["datetime"] = df["index"].apply(RQDataBackend.convert_dt_to_int)
-        del df["index"]
+    def set_suspended(self, order_book_id, suspended):
+        """由停牌标记得到 get_availability 的结果，之后不需要再为它取日线"""
+        dates = suspended.index
+        dates = (dates.year * 10000 + dates.month * 100 + dates.day).values.astype(np.int64)
+        calendar_dates = self.get_trading_calendar().dates
+        # 没有覆盖到日历最后一天的不能用
+        if len(dates) == 0 or len(calendar_dates) == 0 or dates[-1] < calendar_dates[-1]:
+            return
+        start = int(dates[0]) if dates[0] > calendar_dates[0] else None
+        availability = np.isin(calendar_dates, dates[~suspended.values.astype(bool)])
+        entry = self._availability.get(order_book_id) if self._availability is not None else None
+        # 用新取到的停牌标记更新之前覆盖范围更大的结果，start 之前的部分保持不变
+        if (entry is not None and start is not None and len(entry[1]) == len(calendar_dates) and
+                (entry[0] is None or entry[0] < start)):
+            pos = np.searchsorted(calendar_dates, start)
+            availability[:pos] = entry[1][:pos]
+            start = entry[0]
+        self.set_availability(order_book_id, availability, start)
 
-        arr = df.to_records()
+    def get_price(self, order_book_id, start, end, freq):
+        """
+        :param order_book_id: e.g. 000002.XSHE
+        :param start: 20160101
+        :param end: 20160201
+        :returns:
+        :rtype: numpy.rec.array
+        """
+        if start < self.start_date:
+            return self.fetch_price(order_book_id, start, end, freq)
 
-        return arr
+        key = (order_book_id, freq)
+        bars = self._cache.get(key, end)
+        if bars is None:
+            load_end = get_load_end(end)
+            bars = self.fetch_price(order_book_id, self.start_date, load_end, freq)
+            self._cache.put(key, load_end, bars)
+        return self.get_slice(bars, start, end)
+
+    @staticmethod
+    def get_slice(bars, start, end):
+        """截取 [start, end]，只是一部分时返回 copy"""
+        sliced = slice_bars(bars, start, end)
+        if len(sliced) == len(bars):
+            return bars
+        return sliced.copy()
+
+    def get_price_many(self, order_book_ids, start, end, freq):
+        """一次 rqdatac.get_price 取回所有没有缓存的股票
+
+        :param order_book_ids: [000001.XSHE, 000002.XSHE, ...]
+        :param start: 20160101
+        :param end: 20160201
+        :returns: {order_book_id: numpy.rec.array}
+        :rtype: dict
+        """
+        if start < self.start_date:
+            return self.fetch_price_many(order_book_ids, start, end, freq)
+
+        result = {}
+        missing = []
+        for order_book_id in order_book_ids:
+            bars = self._cache.get((order_book_id, freq), end)
+            if bars is None:
+                missing.append(order_book_id)
+            else:
+                result[order_book_id] = bars
+
+        if missing:
+            load_end = get_load_end(end)
+            for order_book_id, bars in self.fetch_price_many(missing, self.start_date, load_end, freq).items():
+                self._cache.put((order_book_id, freq), load_end, bars)
+                result[order_book_id] = bars
+
+        for order_book_id in list(result):
+            bars = self.get_slice(result[order_book_id], start, end)
+            if len(bars) > 0:
+                result[order_book_id] = bars
+            else:
+                del result[order_book_id]
+        return result
+
+    def fetch_price_many(self, order_book_ids, start, end, freq):
+        order_book_ids = list(order_book_ids)
+        start = get_str_date_from_int(start)
+        end = get_str_date_from_int(end)
+
+        df = self.rqdatac.get_price(order_book_ids, start_date=start, end_date=end, frequency=freq, expect_df=True)
+        suspended_df = self.rqdatac.is_suspended(order_book_ids, start_date=start, end_date=end)
+        if df is None or suspended_df is None:
+            return {}
+
+        result = {}
+        for order_book_id, sub_df in df.groupby(level=0):
+            if order_book_id not in suspended_df:
+                continue
+            self.set_suspended(order_book_id, suspended_df[order_book_id])
+            sub_df = sub_df.reset_index(level=0, drop=True)
+            sub_df.index.name = None
+            suspended = suspended_df[order_book_id].reindex(sub_df.index.normalize()).values
+            arr = self.convert_df_to_records(sub_df, suspended)
+            if len(arr) > 0:
+                result[order_book_id] = arr
+        return result
 
     @lru_cache()
     def get_order_book_id_list(self):
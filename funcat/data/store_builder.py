@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import print_function
+
+import os
+import json
+import argparse
+import datetime
+
+import numpy as np
+
+from .memmap_data_backend import (
+    FreqStore,
+    FIELDS,
+    BAR_DTYPE,
+    FREQ_ALIASES,
+    INDEX_FILE,
+    INSTRUMENTS_FILE,
+    STORE_VERSION,
+    TRADING_DATES_FILE,
+)
+from ..utils import FormulaException, get_int_date
+
+
+def to_records(bars):
+    """把 backend 返回的 bars 转成 BAR_DTYPE 的记录，缺失的字段用 nan 填充"""
+    names = bars.dtype.names or ()
+    records = np.empty(len(bars), dtype=BAR_DTYPE)
+    for name, _ in FIELDS:
+        records[name] = bars[name] if name in names else np.nan
+    return records
+
+
+# 每只股票在 bars 文件中预留的空间，之后的增量更新直接写进预留的位置
+MIN_RESERVE = 256
+
+
+def get_capacity(length):
+    return length + max(length // 16, MIN_RESERVE)
+
+
+def write_array(path, arr):
+    tmp_path = path + ".tmp"
+    np.asarray(arr).tofile(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def write_json(path, obj):
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def remove_stale_files(path, keep):
+    """删除 path 下不再被 index 引用的 .dat，其他进程还在 memmap 的文件在 Windows 下删不掉，留到下次"""
+    for name in os.listdir(path):
+        if name.endswith(".dat") and name != keep:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def get_next_bars_file(path):
+    """重写 bars 时换一个没有用过的文件名，已经 memmap 旧文件的进程不受影响"""
+    version = 0
+    for name in os.listdir(path):
+        parts = name.split(".")
+        if len(parts) == 3 and parts[0] == "bars" and parts[1].isdigit() and parts[2] == "dat":
+            version = max(version, int(parts[1]))
+    return "bars.{:d}.dat".format(version + 1)
+
+
+class StoreBuilder(object):
+    """把任意 DataBackend 的数据转成 MemmapDataBackend 使用的本地存储
+
+    如果存储已经存在，比已存储的最后一个 datetime 更新的 bars 直接追加到 bars 文件中，
+    start 早于已存储的起始日期时补上之前的 bars，最后写入 index.json 作为提交点。
+    """
+
+    def __init__(self, data_backend, store_path, verbose=True):
+        self.data_backend = data_backend
+        self.store_path = os.path.expanduser(store_path)
+        self.verbose = verbose
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def build(self, freqs=("1d", ), start=20050101, end=None, incremental=True):
+        """
+        :param freqs: 需要生成的频率
+        :param start: 20050101
+        :param end: 20160201, 默认为今天
+        :param incremental: 是否在已有存储的基础上增量更新
+        """
+        start = get_int_date(start)
+        end = get_int_date(end if end is not None else datetime.date.today())
+        if not os.path.exists(self.store_path):
+            os.makedirs(self.store_path)
+
+        order_book_id_list = self.data_backend.get_order_book_id_list()
+        self.build_trading_dates(start, end, incremental)
+        self.build_instruments(order_book_id_list, incremental)
+        for freq in freqs:
+            self.build_freq(FREQ_ALIASES.get(freq, freq), order_book_id_list, start, end, incremental)
+
+    def build_trading_dates(self, start, end, incremental):
+        path = os.path.join(self.store_path, TRADING_DATES_FILE)
+        trading_dates = np.array(self.data_backend.get_trading_dates(start, end), dtype=np.int64)
+        if incremental and os.path.exists(path):
+            trading_dates = np.union1d(np.fromfile(path, dtype=np.int64), trading_dates)
+        write_array(path, trading_dates)
+        self.log("trading dates: {}".format(len(trading_dates)))
+
+    def build_instruments(self, order_book_id_list, incremental):
+        path = os.path.join(self.store_path, INSTRUMENTS_FILE)
+        instruments = {}
+        if incremental and os.path.exists(path):
+            with open(path) as f:
+                instruments = json.load(f)
+        for order_book_id in order_book_id_list:
+            if order_book_id not in instruments:
+                instruments[order_book_id] = self.data_backend.symbol(order_book_id)
+        write_json(path, instruments)
+
+    def build_freq(self, freq, order_book_id_list, start, end, incremental):
+        path = os.path.join(self.store_path, freq)
+        store = None
+        if incremental and os.path.exists(os.path.join(path, INDEX_FILE)):
+            try:
+                store = FreqStore(path)
+            except ValueError as e:
+                self.log("rebuild [{}]: {}".format(freq, e))
+
+        if store is None:
+            if not os.path.exists(path):
+                os.makedirs(path)
+            bars_file = self.write_freq(path, freq, self.fetch_all(freq, order_book_id_list, start, end), start)
+            remove_stale_files(path, keep=bars_file)
+        else:
+            self.append_freq(store, freq, order_book_id_list, start, end)
+
+    def fetch_all(self, freq, order_book_id_list, start, end):
+        for i, order_book_id in enumerate(order_book_id_list):
+            yield order_book_id, self.fetch(freq, order_book_id, start, end)
+            if (i + 1) % 100 == 0:
+                self.log("[{}] {}/{}".format(freq, i + 1, len(order_book_id_list)))
+
+    def write_freq(self, path, freq, items, start):
+        """把 (order_book_id, records) 写进新的 bars 文件，每只股票之后留出预留空间"""
+        bars_file = get_next_bars_file(path)
+        securities = {}
+        rows = 0
+        with open(os.path.join(path, bars_file), "wb") as f:
+            for order_book_id, records in items:
+                if records is None or len(records) == 0:
+                    continue
+                capacity = get_capacity(len(records))
+                f.seek(rows * BAR_DTYPE.itemsize)
+                records.tofile(f)
+                securities[order_book_id] = [rows, len(records), capacity]
+                rows += capacity
+            f.truncate(rows * BAR_DTYPE.itemsize)
+            f.flush()
+            os.fsync(f.fileno())
+        self.commit(path, bars_file, rows, securities, start)
+        self.log("[{}] {} securities, {} bars".format(freq, len(securities), sum(loc[1] for loc in securities.values())))
+        return bars_file
+
+    def append_freq(self, store, freq, order_book_id_list, start, end):
+        """在原来的 bars 文件上追加
+
+        新的 bars 写在预留空间里；预留空间不够或者需要在前面补数据时，把这只股票整段移到文件末尾。
+        其他进程只会读 index.json 中记录的范围，所以在提交之前看不到写了一半的数据。
+        """
+        meta = store.meta
+        securities = dict((order_book_id, list(loc) + [loc[1]] * (3 - len(loc)))
+                          for order_book_id, loc in meta["securities"].items())
+        old_start = meta.get("start", start)
+        order_book_id_list = sorted(set(order_book_id_list) | set(securities))
+        rows = meta["rows"]
+        itemsize = BAR_DTYPE.itemsize
+        appended = 0
+
+        with open(os.path.join(store.path, meta["file"]), "r+b") as f:
+            for i, order_book_id in enumerate(order_book_id_list):
+                loc = securities.get(order_book_id)
+                if loc is None:
+                    head, old, tail = None, None, self.fetch(freq, order_book_id, start, end)
+                else:
+                    offset, length, capacity = loc
+                    old = store.bars[offset:offset + length]
+                    first_dt, last_dt = int(old["datetime"][0]), int(old["datetime"][-1])
+                    head = None
+                    if start < old_start:
+                        head = self.fetch(freq, order_book_id, start, first_dt // 1000000)
+                        if head is not None:
+                            head = head[head["datetime"] < first_dt]
+                    tail = None
+                    if max(start, last_dt // 1000000) <= end:
+                        tail = self.fetch(freq, order_book_id, max(start, last_dt // 1000000), end)
+                        if tail is not None:
+                            tail = tail[tail["datetime"] > last_dt]
+
+                head_length = 0 if head is None else len(head)
+                tail_length = 0 if tail is None else len(tail)
+                if head_length + tail_length > 0:
+                    appended += head_length + tail_length
+                    if loc is not None and head_length == 0 and length + tail_length <= capacity:
+                        f.seek((offset + length) * itemsize)
+                        tail.tofile(f)
+                        loc[1] = length + tail_length
+                    else:
+                        chunks = [chunk for chunk in (head, old, tail) if chunk is not None and len(chunk) > 0]
+                        length = sum(len(chunk) for chunk in chunks)
+                        capacity = get_capacity(length)
+                        f.seek(rows * itemsize)
+                        for chunk in chunks:
+                            np.asarray(chunk).tofile(f)
+                        securities[order_book_id] = [rows, length, capacity]
+                        rows += capacity
+
+                if (i + 1) % 100 == 0:
+                    self.log("[{}] {}/{}".format(freq, i + 1, len(order_book_id_list)))
+
+            f.truncate(rows * itemsize)
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.commit(store.path, meta["file"], rows, securities, min(start, old_start))
+        remove_stale_files(store.path, keep=meta["file"])
+        self.log("[{}] {} securities, {} new bars".format(freq, len(securities), appended))
+
+        # 移走的股票留下的空间超过一半时重写一次
+        if rows - sum(loc[2] for loc in securities.values()) > rows // 2:
+            self.compact(store.path, freq)
+
+    def compact(self, path, freq):
+        store = FreqStore(path)
+        items = ((order_book_id, store.bars[offset:offset + length])
+                 for order_book_id, (offset, length) in sorted(store.index.items(), key=lambda item: item[1]))
+        bars_file = self.write_freq(path, freq, items, store.meta["start"])
+        del items, store
+        remove_stale_files(path, keep=bars_file)
+
+    def commit(self, path, bars_file, rows, securities, start):
+        write_json(os.path.join(path, INDEX_FILE), {
+            "version": STORE_VERSION,
+            "fields": [(name, np.dtype(dtype).str) for name, dtype in FIELDS],
+            "file": bars_file,
+            "rows": rows,
+            "start": start,
+            "securities": securities,
+        })
+
+    def fetch(self, freq, order_book_id, start, end):
+        """取 [start, end] 的 bars 转成记录，没有数据时返回 None"""
+        try:
+            bars = self.data_backend.get_price(order_book_id, start=start, end=end, freq=freq)
+        except (KeyError, FormulaException) as e:
+            self.log("skip {}: {}".format(order_book_id, e))
+            return None
+
+        if bars is None or len(bars) == 0:
+            return None
+        return to_records(bars)
+
+
+def create_data_backend(name, rqalpha_path=None):
+    if name == "tushare":
+        from .tushare_backend import TushareDataBackend
+        return TushareDataBackend()
+    elif name == "rqdata":
+        from .rqdata_data_backend import RQDataBackend
+        data_backend = RQDataBackend()
+        data_backend.rqdatac.init()
+        return data_backend
+    elif name == "rqalpha":
+        from .rqalpha_data_backend import RQAlphaDataBackend
+        return RQAlphaDataBackend(rqalpha_path=rqalpha_path)
+    raise ValueError("unknown data backend {}".format(name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="funcat-build-store",
+        description="build a local memmap store for MemmapDataBackend")
+    parser.add_argument("store_path", help="output directory")
+    parser.add_argument("-b", "--backend", default="rqalpha", choices=["tushare", "rqdata", "rqalpha"])
+    parser.add_argument("--rqalpha-path", default=None, help="rqalpha bundle path")
+    parser.add_argument("-f", "--freq", action="append", dest="freqs", help="1d 1w 1m 5m ..., default 1d")
+    parser.add_argument("-s", "--start", default="20050101")
+    parser.add_argument("-e", "--end", default=None)
+    parser.add_argument("--rebuild", action="store_true", help="ignore existing data and rebuild")
+    parser.add_argument("-q", "--quiet", action="store_true")
+    args = parser.parse_args(argv)
+
+    data_backend = create_data_backend(args.backend, rqalpha_path=args.rqalpha_path)
+    builder = StoreBuilder(data_backend, args.store_path, verbose=not args.quiet)
+    builder.build(freqs=args.freqs or ["1d"], start=args.start, end=args.end, incremental=not args.rebuild)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+
+from ..utils import get_int_date
+
+
+def get_date_int(date):
+    """20160104, "2016-01-04", datetime.date 或者 20160104093000 统一成 20160104"""
+    if isinstance(date, np.integer):
+        date = int(date)
+    date = get_int_date(date)
+    if date > 99999999:
+        date //= 1000000
+    return date
+
+
+class TradingCalendar(object):
+    """交易日历，内部是升序的 int64 数组，所有查询都是二分查找
+
+    :param trading_dates: [20160104, 20160105, ...]
+    """
+
+    def __init__(self, trading_dates):
+        dates = np.asarray(trading_dates, dtype=np.int64)
+        if len(dates) > 1 and not np.all(dates[1:] > dates[:-1]):
+            dates = np.unique(dates)
+        self.dates = dates
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, date):
+        date = get_date_int(date)
+        pos = np.searchsorted(self.dates, date)
+        return pos < len(self.dates) and self.dates[pos] == date
+
+    def __repr__(self):
+        if len(self.dates) == 0:
+            return "TradingCalendar([])"
+        return "TradingCalendar({}-{}, {} days)".format(self.dates[0], self.dates[-1], len(self.dates))
+
+    def index(self, date):
+        """date 在日历中的位置，不是交易日则返回之前最近一个交易日的位置，可能为 -1"""
+        return int(np.searchsorted(self.dates, get_date_int(date), side="right")) - 1
+
+    def get_trading_dates(self, start, end):
+        """[start, end] 之间的交易日
+
+        :param start: 20160101
+        :param end: 20160201
+        :rtype: numpy.ndarray
+        """
+        lo = np.searchsorted(self.dates, get_date_int(start), side="left")
+        hi = np.searchsorted(self.dates, get_date_int(end), side="right")
+        return self.dates[lo:hi]
+
+    def get_previous_trading_date(self, date, n=1):
+        """date 之前的第 n 个交易日"""
+        pos = int(np.searchsorted(self.dates, get_date_int(date), side="left")) - n
+        return self._get(pos)
+
+    def get_next_trading_date(self, date, n=1):
+        """date 之后的第 n 个交易日"""
+        pos = int(np.searchsorted(self.dates, get_date_int(date), side="right")) + n - 1
+        return self._get(pos)
+
+    def offset(self, date, n):
+        """从 date（非交易日则取之前最近一个交易日）偏移 n 个交易日，n 为负数则往前"""
+        return self._get(self.index(date) + n)
+
+    def count(self, start, end):
+        """[start, end] 之间交易日的数量"""
+        return len(self.get_trading_dates(start, end))
+
+    def _get(self, pos):
+        if pos < 0 or pos >= len(self.dates):
+            raise IndexError("trading date out of calendar range")
+        return int(self.dates[pos])
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 #
 
+import pandas as pd
 from cached_property import cached_property
 
 from .backend import DataBackend
@@ -58,14 +59,13 @@ class TushareDataBackend(DataBackend):
 
         df = self.ts.get_k_data(code, start=start, end=end, index=is_index, ktype=ktype)
 
-        if freq[-1] == "m":
-            df["datetime"] = df.apply(
-                lambda row: int(row["date"].split(" ")[0].replace("-", "")) * 1000000 + int(row["date"].split(" ")[1].replace(":", "")) * 100, axis=1)
-        elif freq in ("1d", "W", "M"):
-            df["datetime"] = df["date"].apply(lambda x: int(x.replace("-", "")) * 1000000)
+        dt = pd.to_datetime(df["date"]).dt
+        date = (dt.year * 10000 + dt.month * 100 + dt.day).astype("int64")
+        df["datetime"] = date * 1000000 + dt.hour * 10000 + dt.minute * 100 + dt.second
 
         del df["code"]
-        arr = df.to_records()
+        del df["date"]
+        arr = df.to_records(index=False)
 
         return arr
 
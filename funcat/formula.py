@@ -0,0 +1,552 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import os
+import re
+import json
+import operator
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import six
+
+from . import api
+from .context import ExecutionContext
+from .time_series import TimeSeries, evaluate_fused
+from .fusion import check_expr
+from .lookback import EMA_TOLERANCE, get_call_lookback
+from .utils import FormulaException
+
+
+# 编译结果在磁盘上的缓存目录，不设置时只缓存在内存中
+FORMULA_CACHE_ENV = "FUNCAT_FORMULA_CACHE"
+# 计划的格式变化时加 1，旧版本的缓存会被忽略
+PLAN_VERSION = 1
+# 内存中最多缓存的公式数，超过后清空
+FORMULA_MAXSIZE = 4096
+
+# 通达信中和 funcat 名字不同的变量
+ALIASES = {"VOL": "VOLUME", "AMOUNT": "AMO"}
+# api 中不能在公式里使用的名字
+EXCLUDED_NAMES = ("S", "T")
+
+TOKEN_RE = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>\{[^}]*\}|//[^\n]*)
+  | (?P<number>(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?)
+  | (?P<name>[^\W\d]\w*)
+  | (?P<op>:=|<>|>=|<=|!=|==|&&|\|\||[-+*/<>=:;,()])
+""", re.VERBOSE | re.UNICODE)
+
+KEYWORDS = ("AND", "OR", "NOT")
+OPERATOR_ALIASES = {"&&": "AND", "||": "OR", "==": "=", "!=": "<>"}
+
+# 二元运算符按优先级从低到高
+BINARY_LEVELS = (
+    ("OR", ),
+    ("AND", ),
+    ("=", "<>", ">", "<", ">=", "<="),
+    ("+", "-"),
+    ("*", "/"),
+)
+
+# 编译时计算常数之间的运算
+CONSTANT_OPS = {
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "=": operator.eq,
+    "<>": operator.ne,
+    ">": operator.gt,
+    "<": operator.lt,
+    ">=": operator.ge,
+    "<=": operator.le,
+    "AND": lambda a, b: bool(a and b),
+    "OR": lambda a, b: bool(a or b),
+}
+
+
+def get_namespace():
+    """公式中可以使用的行情变量和函数"""
+    namespace = {}
+    for name in api.__all__:
+        if name.isupper() and name not in EXCLUDED_NAMES:
+            namespace[name] = getattr(api, name)
+    for alias, name in ALIASES.items():
+        namespace[alias] = namespace[name]
+    return namespace
+
+
+NAMESPACE = get_namespace()
+
+getargspec = getattr(inspect, "getfullargspec", None) or inspect.getargspec
+
+
+def get_arity(func):
+    """函数参数个数的 (最少, 最多)，有 *args 时最多为 None"""
+    skip = 0
+    if inspect.isclass(func):
+        func, skip = func.__init__, 1
+    while hasattr(func, "__wrapped__"):
+        func = func.__wrapped__
+    spec = getargspec(func)
+    count = len(spec[0]) - skip
+    return count - len(spec[3] or ()), None if spec[1] else count
+
+
+def get_location(source, pos):
+    line = source.count("\n", 0, pos) + 1
+    column = pos - (source.rfind("\n", 0, pos) + 1) + 1
+    return "line {}, column {}".format(line, column)
+
+
+def tokenize(source):
+    """:returns: [(类型, 值, 位置)]，名字统一转成大写"""
+    tokens = []
+    pos = 0
+    while pos < len(source):
+        match = TOKEN_RE.match(source, pos)
+        if match is None:
+            raise FormulaException("unexpected character {!r} at {}".format(source[pos], get_location(source, pos)))
+        kind, text = match.lastgroup, match.group()
+        if kind == "number":
+            value = float(text) if any(c in text for c in ".eE") else int(text)
+            tokens.append(("number", value, pos))
+        elif kind == "name":
+            name = text.upper()
+            tokens.append(("op" if name in KEYWORDS else "name", name, pos))
+        elif kind == "op":
+            tokens.append(("op", OPERATOR_ALIASES.get(text, text), pos))
+        pos = match.end()
+    tokens.append(("end", None, pos))
+    return tokens
+
+
+class Parser(object):
+    """递归下降解析通达信公式
+
+    语法树的节点是 tuple：("number", 值)、("name", 名字, 位置)、("call", 函数名, [参数], 位置)、
+    ("binary", 运算符, 左, 右)、("unary", 运算符, 操作数)
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.tokens = tokenize(source)
+        self.index = 0
+
+    def parse(self):
+        """:returns: [(赋值符号, 名字, 语法树)]，赋值符号为 := 或 :，没有名字的输出语句名字为 None"""
+        statements = []
+        while self.peek()[0] != "end":
+            if self.accept(";"):
+                continue
+            statements.append(self.parse_statement())
+            if self.peek()[0] != "end":
+                self.expect(";")
+        if not statements:
+            raise FormulaException("empty formula")
+        return statements
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.index + offset, len(self.tokens) - 1)]
+
+    def accept(self, op):
+        kind, value, _ = self.peek()
+        if kind == "op" and value == op:
+            self.index += 1
+            return True
+        return False
+
+    def expect(self, op):
+        if not self.accept(op):
+            self.error("expected {!r}".format(op))
+
+    def error(self, message):
+        kind, value, pos = self.peek()
+        found = "end of formula" if kind == "end" else repr(value)
+        raise FormulaException("{}, found {} at {}".format(message, found, get_location(self.source, pos)))
+
+    def parse_statement(self):
+        kind, name, _ = self.peek()
+        next_kind, assign, _ = self.peek(1)
+        if kind == "name" and next_kind == "op" and assign in (":=", ":"):
+            self.index += 2
+            statement = (assign, name, self.parse_expr())
+        else:
+            statement = (":", None, self.parse_expr())
+        # 忽略 COLORRED、LINETHICK2、NODRAW 这类画线属性
+        while self.accept(","):
+            if self.peek()[0] != "name":
+                self.error("expected drawing attribute")
+            self.index += 1
+        return statement
+
+    def parse_expr(self, level=0):
+        if level == len(BINARY_LEVELS):
+            return self.parse_unary()
+        left = self.parse_expr(level + 1)
+        while True:
+            kind, op, _ = self.peek()
+            if kind != "op" or op not in BINARY_LEVELS[level]:
+                return left
+            self.index += 1
+            left = ("binary", op, left, self.parse_expr(level + 1))
+
+    def parse_unary(self):
+        if self.accept("NOT"):
+            return ("unary", "NOT", self.parse_unary())
+        if self.accept("-"):
+            return ("unary", "NEG", self.parse_unary())
+        if self.accept("+"):
+            return self.parse_unary()
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value, pos = self.peek()
+        if kind == "number":
+            self.index += 1
+            return ("number", value)
+        if kind == "name":
+            self.index += 1
+            if not self.accept("("):
+                return ("name", value, pos)
+            args = []
+            if not self.accept(")"):
+                args.append(self.parse_expr())
+                while self.accept(","):
+                    args.append(self.parse_expr())
+                self.expect(")")
+            return ("call", value, args, pos)
+        if self.accept("("):
+            expr = self.parse_expr()
+            self.expect(")")
+            return expr
+        self.error("unexpected token")
+
+
+def fold_constant(op, values):
+    a = values[0]
+    if op == "NEG":
+        return -a
+    if op == "NOT":
+        return not a
+    b = values[1]
+    if op == "/":
+        # 和序列运算一样按 numpy 的规则，除以 0 得到 inf 或 nan
+        with np.errstate(all="ignore"):
+            return float(np.float64(a) / b)
+    return CONSTANT_OPS[op](a, b)
+
+
+class Compiler(object):
+    """把语法树变成有向无环图，相同的子表达式只保留一个节点，常数运算在编译时算好
+
+    节点是 tuple：("const", 值)、("data", 名字)、("call", 函数名, 子节点...)、("op", 运算符, 子节点...)，
+    子节点用编号表示。
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.nodes = []
+        self.ids = {}
+
+    def error(self, message, pos):
+        raise FormulaException("{} at {}".format(message, get_location(self.source, pos)))
+
+    def add(self, node):
+        # True == 1 == 1.0，常数的 key 带上类型
+        key = node + (type(node[1]), ) if node[0] == "const" else node
+        node_id = self.ids.get(key)
+        if node_id is None:
+            node_id = self.ids[key] = len(self.nodes)
+            self.nodes.append(node)
+        return node_id
+
+    def compile(self):
+        """:returns: 执行计划，只包含 json 能保存的类型"""
+        env = {}
+        outputs = []
+        for assign, name, expr in Parser(self.source).parse():
+            node_id = self.visit(expr, env)
+            if name is not None:
+                env[name] = node_id
+            if assign == ":":
+                outputs.append((name or "OUT{}".format(len(outputs) + 1), node_id))
+        if not outputs:
+            # 没有输出语句时最后一个赋值就是结果
+            outputs.append((name, node_id))
+        return self.plan(outputs)
+
+    def visit(self, expr, env):
+        kind = expr[0]
+        if kind == "number":
+            return self.add(("const", expr[1]))
+        if kind == "name":
+            name = expr[1]
+            if name in env:
+                return env[name]
+            value = NAMESPACE.get(name)
+            if isinstance(value, TimeSeries):
+                return self.add(("data", name))
+            if value is not None:
+                # 通达信中没有参数的函数可以省略括号，funcat 的函数都需要参数
+                self.error("{} requires arguments".format(name), expr[2])
+            self.error("unknown name {}".format(name), expr[2])
+        if kind == "call":
+            name, args = expr[1], expr[2]
+            if name in env or isinstance(NAMESPACE.get(name), TimeSeries):
+                self.error("{} is not a function".format(name), expr[3])
+            if name not in NAMESPACE:
+                self.error("unknown function {}".format(name), expr[3])
+            lo, hi = get_arity(NAMESPACE[name])
+            if len(args) < lo or (hi is not None and len(args) > hi):
+                if lo == hi:
+                    expected = lo
+                elif hi is None:
+                    expected = "at least {}".format(lo)
+                else:
+                    expected = "{} to {}".format(lo, hi)
+                self.error("{} takes {} arguments, got {}".format(name, expected, len(args)), expr[3])
+            return self.add(("call", name) + tuple(self.visit(arg, env) for arg in args))
+
+        children = tuple(self.visit(arg, env) for arg in expr[2:])
+        if all(self.nodes[child][0] == "const" for child in children):
+            value = fold_constant(expr[1], [self.nodes[child][1] for child in children])
+            return self.add(("const", value))
+        return self.add(("op", expr[1]) + children)
+
+    def plan(self, outputs):
+        """把节点排成计算步骤
+
+        行情和函数调用各是一步；运算节点只有在是输出、作为函数参数、或者被多次引用时才单独成为一步，
+        其余的内联到引用它的运算中，一步之内的连续运算一起计算。
+        """
+        nodes = self.nodes
+        uses = [0] * len(nodes)
+        materialized = set(node_id for _, node_id in outputs)
+        stack = list(materialized)
+        reachable = set()
+        while stack:
+            node_id = stack.pop()
+            if node_id in reachable:
+                continue
+            reachable.add(node_id)
+            node = nodes[node_id]
+            if node[0] in ("call", "op"):
+                for child in node[2:]:
+                    uses[child] += 1
+                    if node[0] == "call":
+                        materialized.add(child)
+                    stack.append(child)
+
+        steps = []
+        step_ids = {}
+        for node_id in sorted(reachable):
+            node = nodes[node_id]
+            kind = node[0]
+            if kind == "const" or (kind == "op" and node_id not in materialized and uses[node_id] < 2):
+                continue
+            if kind == "data":
+                step = {"op": "data", "name": node[1]}
+            elif kind == "call":
+                step = {"op": "call", "name": node[1], "args": [self.get_arg(child, step_ids) for child in node[2:]]}
+            else:
+                inputs = []
+                step = {"op": "fused", "expr": self.get_expr(node_id, step_ids, inputs, root=True), "inputs": inputs}
+            step_ids[node_id] = len(steps)
+            steps.append(step)
+
+        return {
+            "version": PLAN_VERSION,
+            "source": self.source,
+            "steps": steps,
+            "outputs": [[name, self.get_arg(node_id, step_ids)] for name, node_id in outputs],
+        }
+
+    def get_arg(self, node_id, step_ids):
+        """函数参数：["step", 步骤编号] 或 ["const", 值]"""
+        if node_id in step_ids:
+            return ["step", step_ids[node_id]]
+        return ["const", self.nodes[node_id][1]]
+
+    def get_expr(self, node_id, step_ids, inputs, root=False):
+        """一步之内的运算：["input", 输入编号]、["const", 值] 或 [运算符, 子表达式...]"""
+        node = self.nodes[node_id]
+        if node[0] == "const":
+            return ["const", node[1]]
+        if node_id in step_ids and not root:
+            step_id = step_ids[node_id]
+            if step_id not in inputs:
+                inputs.append(step_id)
+            return ["input", inputs.index(step_id)]
+        return [node[1]] + [self.get_expr(child, step_ids, inputs) for child in node[2:]]
+
+
+def get_formula_cache_dir():
+    """没有设置环境变量 FUNCAT_FORMULA_CACHE 时为 None，不在磁盘上缓存"""
+    path = os.environ.get(FORMULA_CACHE_ENV)
+    return os.path.expanduser(path) if path else None
+
+
+def load_plan(digest):
+    directory = get_formula_cache_dir()
+    if directory is None:
+        return None
+    try:
+        with open(os.path.join(directory, digest + ".json")) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_plan(digest, plan):
+    directory = get_formula_cache_dir()
+    if directory is None:
+        return
+    path = os.path.join(directory, digest + ".json")
+    try:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(plan, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+class Formula(object):
+    """编译好的公式
+
+    调用时在当前股票、日期下计算，返回最后一个输出，可以直接传给 select。
+    中间结果不经过 memo，只计算用到的步骤。
+
+    :param source: 公式原文
+    :param plan: Compiler.compile 得到的执行计划
+    """
+
+    def __init__(self, source, plan):
+        self.source = source
+        self.steps = plan["steps"]
+        self.output_names = [name for name, _ in plan["outputs"]]
+        self.output_args = [arg for _, arg in plan["outputs"]]
+        # 每一步的行情变量、函数，fused 步骤是检查过的表达式
+        self.functions = []
+        for i, step in enumerate(self.steps):
+            if step["op"] in ("data", "call"):
+                function = NAMESPACE[step["name"]]
+                if isinstance(function, TimeSeries) != (step["op"] == "data"):
+                    raise FormulaException("invalid step {!r}".format(step["name"]))
+            elif step["op"] == "fused":
+                function = check_expr(step["expr"], len(step["inputs"]))
+            else:
+                raise FormulaException("invalid step {!r}".format(step["op"]))
+            for arg in self.get_step_args(step):
+                if arg >= i:
+                    raise FormulaException("invalid plan")
+            self.functions.append(function)
+        self.lookback = self.get_lookback()[0]
+
+    def __call__(self):
+        return self.evaluate([self.output_args[-1]])[0]
+
+    def __repr__(self):
+        return "Formula({!r})".format(self.source)
+
+    def outputs(self):
+        """:returns: OrderedDict 输出名字 -> 序列"""
+        return OrderedDict(zip(self.output_names, self.evaluate(self.output_args)))
+
+    @staticmethod
+    def get_step_args(step):
+        if step["op"] == "call":
+            return [arg[1] for arg in step["args"] if arg[0] == "step"]
+        if step["op"] == "fused":
+            return step["inputs"]
+        return []
+
+    def evaluate(self, args):
+        needed = set()
+        stack = [arg[1] for arg in args if arg[0] == "step"]
+        while stack:
+            i = stack.pop()
+            if i not in needed:
+                needed.add(i)
+                stack.extend(self.get_step_args(self.steps[i]))
+
+        results = {}
+        with ExecutionContext.eager():
+            for i in sorted(needed):
+                step = self.steps[i]
+                function = self.functions[i]
+                if step["op"] == "data":
+                    results[i] = function
+                elif step["op"] == "call":
+                    results[i] = function(*[results[arg[1]] if arg[0] == "step" else arg[1]
+                                            for arg in step["args"]])
+                else:
+                    results[i] = evaluate_fused(function, [results[k] for k in step["inputs"]])
+        return [results[arg[1]] if arg[0] == "step" else arg[1] for arg in args]
+
+    def get_lookback(self, tolerance=EMA_TOLERANCE):
+        """和 infer_lookback 一样返回 (bar 数, 用到的频率)，公式只用当前频率"""
+        lookbacks = []
+        for i, step in enumerate(self.steps):
+            if step["op"] == "data":
+                lookback = 1 if self.functions[i]._dynamic_update else 0
+            elif step["op"] == "call":
+                args = [None if arg[0] == "step" else arg[1] for arg in step["args"]]
+                inputs = [lookbacks[arg[1]] for arg in step["args"] if arg[0] == "step"]
+                lookback = get_call_lookback(self.functions[i], args, inputs, tolerance)
+            else:
+                inputs = [lookbacks[k] for k in step["inputs"]]
+                lookback = None if None in inputs else max(inputs)
+            lookbacks.append(lookback)
+        arg = self.output_args[-1]
+        return (lookbacks[arg[1]] if arg[0] == "step" else 0), set([None])
+
+
+_formulas = {}
+_formulas_lock = threading.Lock()
+
+
+def compile_formula(source):
+    """把通达信公式编译成 Formula
+
+    支持 := 赋值、: 输出、{} 和 // 注释、AND/OR/NOT 以及 api 中的行情变量和函数，
+    VOL、AMOUNT 分别对应 VOLUME、AMO。编译时合并相同的子表达式、算好常数运算、推断 lookback。
+
+    编译结果按公式的 sha1 缓存在内存中，设置环境变量 FUNCAT_FORMULA_CACHE 时也缓存在这个目录里。
+    同一个公式对成千上万只股票只解析一次。
+
+    >>> formula = compile_formula("DIF := EMA(C, 12) - EMA(C, 26); DEA := EMA(DIF, 9); CROSS(DIF, DEA);")
+    >>> select(formula, 20160101, 20160201)
+    """
+    data = source.encode("utf-8") if isinstance(source, six.text_type) else source
+    digest = hashlib.sha1(data).hexdigest()
+    formula = _formulas.get(digest)
+    if formula is not None:
+        return formula
+
+    formula = None
+    plan = load_plan(digest)
+    if plan is not None and plan.get("version") == PLAN_VERSION and plan.get("source") == source:
+        try:
+            formula = Formula(source, plan)
+        except (FormulaException, KeyError, TypeError, ValueError, IndexError):
+            formula = None
+    if formula is None:
+        plan = Compiler(source).compile()
+        formula = Formula(source, plan)
+        save_plan(digest, plan)
+
+    with _formulas_lock:
+        if len(_formulas) >= FORMULA_MAXSIZE:
+            _formulas.clear()
+        _formulas[digest] = formula
+    return formula
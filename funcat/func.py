@@ -1,17 +1,23 @@
 # -*- coding: utf-8 -*-
 #
 
+from __future__ import division
+
 from functools import reduce
 
+import six
+
 import numpy as np
-import talib
 
 from .context import ExecutionContext
-from .utils import FormulaException, rolling_window, handle_numpy_warning
+from .utils import FormulaException, handle_numpy_warning
+from .kernels import dispatcher, get_kernel, count_true, sliding_extreme
 from .time_series import (
     MarketDataSeries,
     NumericSeries,
     BoolSeries,
+    SeriesOperatorMeta,
+    lazy_operator,
     fit_series,
     get_series,
     get_bars,
@@ -19,20 +25,46 @@ from .time_series import (
 )
 
 
-class OneArgumentSeries(NumericSeries):
-    func = talib.MA
+def replace_inf(series, value, negative=False):
+    """把 +inf（negative 为 True 时包括 -inf）替换成 value
+
+    行情数据是只读的，所以不修改 series，而是写到新的数组里，没有 inf 时直接返回 series
+    """
+    if series.dtype.kind != "f":
+        return series
+    mask = np.isinf(series) if negative else series == np.inf
+    if not mask.any():
+        return series
+    return np.where(mask, value, series)
+
+
+def apply_window(func, series, n):
+    """用 func 计算窗口长度为 n 的指标
+
+    series 是 0 维的常数时，当作足够长的常数序列，结果同样是 0 维。
+    n 为 0（从第一个周期开始）时结果和序列的长度有关，不能确定。
+    """
+    if np.ndim(series) > 0:
+        return func(series)
+    if n <= 0:
+        raise FormulaException("window size {} is not supported for a constant".format(n))
+    return np.asarray(func(np.full(n, series))[-1])
+
+
+class OneArgumentSeries(six.with_metaclass(SeriesOperatorMeta, NumericSeries)):
+    func = dispatcher("MA")
 
     def __init__(self, series, arg):
         if isinstance(series, NumericSeries):
             series = series.series
 
             try:
-                series[series == np.inf] = np.nan
+                series = replace_inf(series, np.nan)
                 """
                 Higher version TA-Lib may zip the (self, series, arg) into *args,
                 use class function here to avoid passing self downstream.
                 """
-                series = self.__class__.func(series, arg)
+                series = apply_window(lambda x: self.__class__.func(x, arg), series, arg)
             except Exception as e:
                 raise FormulaException(e)
         super(OneArgumentSeries, self).__init__(series)
@@ -41,33 +73,33 @@ class OneArgumentSeries(NumericSeries):
 
 class MovingAverageSeries(OneArgumentSeries):
     """http://www.tadoc.org/indicator/MA.htm"""
-    func = talib.MA
+    func = dispatcher("MA")
 
 
 class WeightedMovingAverageSeries(OneArgumentSeries):
     """http://www.tadoc.org/indicator/WMA.htm"""
-    func = talib.WMA
+    func = dispatcher("WMA")
 
 
 class ExponentialMovingAverageSeries(OneArgumentSeries):
     """http://www.fmlabs.com/reference/default.htm?url=ExpMA.htm"""
-    func = talib.EMA
+    func = dispatcher("EMA")
 
 
 class StdSeries(OneArgumentSeries):
-    func = talib.STDDEV
+    func = dispatcher("STD")
 
 
-class TwoArgumentSeries(NumericSeries):
-    func = talib.STDDEV
+class TwoArgumentSeries(six.with_metaclass(SeriesOperatorMeta, NumericSeries)):
+    func = dispatcher("STD")
 
     def __init__(self, series, arg1, arg2):
         if isinstance(series, NumericSeries):
             series = series.series
 
             try:
-                series[series == np.inf] = np.nan
-                series = self.__class__.func(series, arg1, arg2)
+                series = replace_inf(series, np.nan)
+                series = apply_window(lambda x: self.__class__.func(x, arg1, arg2), series, arg1)
             except Exception as e:
                 raise FormulaException(e)
         super(TwoArgumentSeries, self).__init__(series)
@@ -76,18 +108,22 @@ class TwoArgumentSeries(NumericSeries):
 
 
 class SMASeries(TwoArgumentSeries):
-    """同花顺专用SMA"""
+    """同花顺专用SMA
 
-    def func(series, n, _):
-        results = np.nan_to_num(series).copy()
-        # FIXME this is very slow
-        for i in range(1, len(series)):
-            results[i] = ((n - 1) * results[i - 1] + results[i]) / n
-        return results
+    SMA(X, N, M): Y = (M * X + (N - M) * Y') / N，第一个值取 X，X 中的 nan 当作 0
+    """
+
+    def func(series, n, m):
+        if not 0 <= m <= n or n <= 0:
+            raise FormulaException("SMA requires 0 <= M <= N and N > 0")
+        series = np.nan_to_num(np.asarray(series, dtype=np.float64))
+        if len(series) == 0:
+            return series
+        return get_kernel("SMA")(series, m / n)
 
 
-class CCISeries(NumericSeries):
-    func = talib.CCI
+class CCISeries(six.with_metaclass(SeriesOperatorMeta, NumericSeries)):
+    func = dispatcher("CCI")
 
     def __init__(self, high, low, close):
         if isinstance(high, NumericSeries) and isinstance(low, NumericSeries) and isinstance(close, NumericSeries):
@@ -96,43 +132,71 @@ class CCISeries(NumericSeries):
             series2 = close.series
 
             try:
-                series0[series0 == np.inf] = np.nan
-                series1[series1 == np.inf] = np.nan
-                series2[series2 == np.inf] = np.nan
-                series = self.__class__.func(series0, series1, series2)
+                series0 = replace_inf(series0, np.nan)
+                series1 = replace_inf(series1, np.nan)
+                series2 = replace_inf(series2, np.nan)
+                # TA-Lib 默认的 14 日
+                series = self.__class__.func(series0, series1, series2, 14)
             except Exception as e:
                 raise FormulaException(e)
             super(CCISeries, self).__init__(series)
 
 
-class SumSeries(NumericSeries):
+class SumSeries(six.with_metaclass(SeriesOperatorMeta, NumericSeries)):
     """求和"""
     def __init__(self, series, period):
         if isinstance(series, NumericSeries):
             series = series.series
             try:
-                series[series == np.inf] = 0
-                series[series == -np.inf] = 0
-                series = talib.SUM(series, period)
+                series = replace_inf(series, 0, negative=True)
+                series = apply_window(lambda x: get_kernel("SUM")(x, period), series, period)
             except Exception as e:
                 raise FormulaException(e)
         super(SumSeries, self).__init__(series)
         self.extra_create_kwargs["period"] = period
 
 
-class AbsSeries(NumericSeries):
+class AbsSeries(six.with_metaclass(SeriesOperatorMeta, NumericSeries)):
     def __init__(self, series):
         if isinstance(series, NumericSeries):
             series = series.series
             try:
-                series[series == np.inf] = 0
-                series[series == -np.inf] = 0
+                series = replace_inf(series, 0, negative=True)
                 series = np.abs(series)
             except Exception as e:
                 raise FormulaException(e)
         super(AbsSeries, self).__init__(series)
 
 
+def range_extreme(series, lo, hi, maximum=True):
+    """series[lo[i]:hi[i] + 1] 的最大（最小）值，区间长度可以各不相同
+
+    用 sparse table 计算，每个区间拆成两个长度为 2^k 的重叠区间。
+    """
+    series = np.asarray(series, dtype=np.float64)
+    reduce = np.maximum if maximum else np.minimum
+    lengths = hi - lo + 1
+    result = np.empty(len(lo), dtype=np.float64)
+    if len(lo) == 0:
+        return result
+    levels = np.frexp(lengths)[1] - 1
+    table = series
+    for level in range(levels.max() + 1):
+        if level > 0:
+            width = 1 << (level - 1)
+            table = reduce(table[:-width], table[width:])
+        mask = levels == level
+        if mask.any():
+            result[mask] = reduce(table[lo[mask]], table[hi[mask] - (1 << level) + 1])
+    return result
+
+
+def get_window_sizes(size, n):
+    """count_true 结果中每个窗口的长度"""
+    return n if n != 0 else np.arange(1, size + 1)
+
+
+@lazy_operator(BoolSeries)
 @handle_numpy_warning
 def CrossOver(s1, s2):
     """s1金叉s2
@@ -155,6 +219,7 @@ def Ref(s1, n):
     return s1[n]
 
 
+@lazy_operator(NumericSeries)
 @handle_numpy_warning
 def minimum(s1, s2):
     s1, s2 = ensure_timeseries(s1), ensure_timeseries(s2)
@@ -165,6 +230,7 @@ def minimum(s1, s2):
     return NumericSeries(s)
 
 
+@lazy_operator(NumericSeries)
 @handle_numpy_warning
 def maximum(s1, s2):
     s1, s2 = ensure_timeseries(s1), ensure_timeseries(s2)
@@ -175,20 +241,11 @@ def maximum(s1, s2):
     return NumericSeries(s)
 
 
+@lazy_operator(NumericSeries)
 @handle_numpy_warning
 def count(cond, n):
-    # TODO lazy compute
-    series = cond.series
-    size = len(cond.series) - n
-    try:
-        result = np.full(size, 0, dtype=np.int)
-    except ValueError as e:
-        raise FormulaException(e)
-    for i in range(size - 1, 0, -1):
-        s = series[-n:]
-        result[i] = len(s[s == True])
-        series = series[:-1]
-    return NumericSeries(result)
+    """最近 n 个周期 cond 成立的次数，n 为 0 时从第一个周期开始统计"""
+    return NumericSeries(apply_window(lambda x: get_kernel("COUNT")(x, n), cond.series, n))
 
 
 @handle_numpy_warning
@@ -224,48 +281,72 @@ def box_top_bottom(open, close, high, low):
     return NumericSeries(tops), NumericSeries(btms)
 
 
+@lazy_operator(BoolSeries)
 @handle_numpy_warning
 def every(cond, n):
-    return count(cond, n) == n
+    """最近 n 个周期 cond 一直成立"""
+    def func(series):
+        counts = count_true(series, n)
+        return counts == get_window_sizes(len(counts), n)
+    return BoolSeries(apply_window(func, cond.series, n))
 
 
+@lazy_operator(BoolSeries)
 @handle_numpy_warning
-def hhv(s, n):
-    # TODO lazy compute
-    series = s.series
-    size = len(s.series) - n
-    try:
-        result = np.full(size, 0, dtype=np.float64)
-    except ValueError as e:
-        raise FormulaException(e)
+def exist(cond, n):
+    """最近 n 个周期 cond 至少成立一次"""
+    return BoolSeries(apply_window(lambda x: count_true(x, n) > 0, cond.series, n))
 
-    result = np.max(rolling_window(series, n), 1)
 
-    return NumericSeries(result)
+@lazy_operator(BoolSeries)
+@handle_numpy_warning
+def last(cond, a, b):
+    """从 a 个周期前到 b 个周期前 cond 一直成立，a 为 0 时从第一个周期开始"""
+    if b < 0 or (a != 0 and a < b):
+        raise FormulaException("LAST requires 0 <= B <= A")
+    n = a - b + 1 if a != 0 else 0
+
+    def func(series):
+        counts = count_true(series[:len(series) - b], n)
+        return counts == get_window_sizes(len(counts), n)
+    return BoolSeries(apply_window(func, cond.series, a + 1 if a != 0 else 0))
+
+
+@lazy_operator(NumericSeries)
+@handle_numpy_warning
+def hhv(s, n):
+    """最近 n 个周期的最大值，n 为 0 时从第一个周期开始"""
+    return NumericSeries(apply_window(lambda x: get_kernel("HHV")(x, n), s.series, n))
 
 
+@lazy_operator(NumericSeries)
 @handle_numpy_warning
 def llv(s, n):
-    # TODO lazy compute
-    series = s.series
-    size = len(s.series) - n
-    try:
-        result = np.full(size, 0, dtype=np.float64)
-    except ValueError as e:
-        raise FormulaException(e)
+    """最近 n 个周期的最小值，n 为 0 时从第一个周期开始"""
+    return NumericSeries(apply_window(lambda x: get_kernel("LLV")(x, n), s.series, n))
 
-    result = np.min(rolling_window(series, n), 1)
 
-    return NumericSeries(result)
+@lazy_operator(NumericSeries)
+@handle_numpy_warning
+def hhvbars(s, n):
+    """最近 n 个周期的最大值到现在的周期数，有多个最大值时取最近的"""
+    return NumericSeries(apply_window(lambda x: sliding_extreme(x, n, with_offset=True)[1], s.series, n))
+
+
+@lazy_operator(NumericSeries)
+@handle_numpy_warning
+def llvbars(s, n):
+    """最近 n 个周期的最小值到现在的周期数，有多个最小值时取最近的"""
+    return NumericSeries(apply_window(lambda x: sliding_extreme(x, n, maximum=False, with_offset=True)[1], s.series, n))
 
 
+@lazy_operator(NumericSeries)
 @handle_numpy_warning
 def iif(condition, true_statement, false_statement):
     series1 = get_series(true_statement)
     series2 = get_series(false_statement)
     cond_series, series1, series2 = fit_series(condition.series, series1, series2)
 
-    series = series2.copy()
-    series[cond_series] = series1[cond_series]
+    series = np.where(cond_series, series1, series2)
 
     return NumericSeries(series)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import math
+
+import numpy as np
+import six
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+from .kernels import register_kernel, get_kernel
+from .utils import FormulaException
+
+
+# 连续的逐元素运算合并成一个表达式一次算完，不为每个运算创建 NumericSeries 和整段长度的临时数组。
+# 表达式是嵌套的 tuple 或 list：("input", 输入编号)、("const", 值) 或 (运算符, 子表达式...)
+
+ARITHMETIC_UFUNCS = {
+    "+": np.add,
+    "-": np.subtract,
+    "*": np.multiply,
+    "/": np.true_divide,
+    "NEG": np.negative,
+}
+COMPARE_UFUNCS = {
+    "=": np.equal,
+    "<>": np.not_equal,
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+}
+LOGICAL_UFUNCS = {
+    "AND": np.logical_and,
+    "OR": np.logical_or,
+    "NOT": np.logical_not,
+}
+UFUNCS = dict(ARITHMETIC_UFUNCS, **dict(COMPARE_UFUNCS, **LOGICAL_UFUNCS))
+UNARY_OPS = ("NEG", "NOT")
+
+NUMEXPR_OPS = {"=": "==", "<>": "!=", "AND": "&", "OR": "|"}
+
+
+def check_expr(expr, inputs):
+    """检查运算符、参数个数、常数和输入编号，不合法时抛出 FormulaException
+
+    :param inputs: 输入的个数
+    :returns: 转成 tuple 的表达式
+    """
+    op = expr[0]
+    if op == "input":
+        if len(expr) != 2 or not isinstance(expr[1], six.integer_types) or not 0 <= expr[1] < inputs:
+            raise FormulaException("invalid input {!r}".format(expr))
+    elif op == "const":
+        if len(expr) != 2 or not isinstance(expr[1], (bool, float) + six.integer_types):
+            raise FormulaException("invalid constant {!r}".format(expr))
+    elif op in UFUNCS:
+        if len(expr) != (2 if op in UNARY_OPS else 3):
+            raise FormulaException("invalid arguments for {}".format(op))
+        return (op, ) + tuple(check_expr(arg, inputs) for arg in expr[1:])
+    else:
+        raise FormulaException("invalid operator {!r}".format(op))
+    return tuple(expr)
+
+
+def is_bool(expr, arrays):
+    op = expr[0]
+    if op == "input":
+        return arrays[expr[1]].dtype == np.bool_
+    if op == "const":
+        return isinstance(expr[1], bool)
+    return op in COMPARE_UFUNCS or op in LOGICAL_UFUNCS
+
+
+def is_exact(expr, arrays):
+    """逐个运算用 numpy 计算时结果是否和 evaluate 相同
+
+    evaluate 按公式的规则把逻辑值当作 1 和 0 参与算术运算，把非 0 的数值当作真参与逻辑运算。
+    numpy 中两个逻辑值的 + 和 * 是逻辑或、逻辑与，- 和取负会报错，数值的 & | ~ 按位计算或者报错。
+    """
+    op = expr[0]
+    if op in ("input", "const"):
+        return True
+    args = expr[1:]
+    if not all(is_exact(arg, arrays) for arg in args):
+        return False
+    if op in LOGICAL_UFUNCS:
+        return all(is_bool(arg, arrays) for arg in args)
+    if op in ARITHMETIC_UFUNCS and op != "/":
+        return not all(is_bool(arg, arrays) for arg in args)
+    return True
+
+
+# 表达式 -> compile_program 的结果
+_programs = {}
+PROGRAMS_MAXSIZE = 4096
+
+
+def compile_program(expr):
+    """把表达式按后序排成 ufunc 调用的列表，并给每个运算分配临时数组
+
+    运算结果优先写回类型相同的子表达式的临时数组，其次复用已经用完的临时数组，
+    所以整个表达式只需要很少几个临时数组。
+
+    :returns: (指令列表, 每个临时数组的 dtype, 结果所在的临时数组)，
+        指令是 (ufunc, 参数, 结果所在的临时数组, 是否按 float64 计算)，参数是 ("input"|"const"|"temp", 值)
+    """
+    program = []
+    dtypes = []
+    free = {np.float64: [], np.bool_: []}
+
+    def visit(expr):
+        op = expr[0]
+        if op in ("input", "const"):
+            return expr
+        operands = [visit(arg) for arg in expr[1:]]
+        # 逻辑值参与算术运算时当作 1 和 0
+        dtype = np.float64 if op in ARITHMETIC_UFUNCS else np.bool_
+        temps = [operand[1] for operand in operands if operand[0] == "temp"]
+        out = None
+        for temp in temps:
+            if dtypes[temp] is dtype:
+                out = temp
+                break
+        if out is None:
+            if free[dtype]:
+                out = free[dtype].pop()
+            else:
+                out = len(dtypes)
+                dtypes.append(dtype)
+        for temp in temps:
+            if temp != out:
+                free[dtypes[temp]].append(temp)
+        program.append((UFUNCS[op], operands, out, dtype is np.float64))
+        return ("temp", out)
+
+    return program, dtypes, visit(expr)[1]
+
+
+@register_kernel("FUSE", "numpy")
+def fuse_numpy(expr, arrays):
+    """用 ufunc 的 out 参数把每个运算写进复用的临时数组"""
+    compiled = _programs.get(expr)
+    if compiled is None:
+        compiled = compile_program(expr)
+        if len(_programs) >= PROGRAMS_MAXSIZE:
+            _programs.clear()
+        _programs[expr] = compiled
+    program, dtypes, result = compiled
+
+    sizes = [len(array) for array in arrays if np.ndim(array) > 0]
+    shape = (max(sizes), ) if sizes else ()
+    temps = [np.empty(shape, dtype=dtype) for dtype in dtypes]
+    for ufunc, operands, out, is_float in program:
+        args = [arrays[value] if kind == "input" else temps[value] if kind == "temp" else value
+                for kind, value in operands]
+        if is_float:
+            ufunc(*args, out=temps[out], dtype=np.float64)
+        else:
+            ufunc(*args, out=temps[out])
+    return temps[result]
+
+
+def get_numexpr_code(expr, arrays, constants):
+    """生成 numexpr 的表达式，nan、inf 之类的常数放进 constants"""
+    op = expr[0]
+    if op == "input":
+        return "x{:d}".format(expr[1])
+    if op == "const":
+        value = expr[1]
+        if isinstance(value, bool):
+            return repr(value)
+        value = float(value)
+        if math.isinf(value) or math.isnan(value):
+            name = "k{:d}".format(len(constants))
+            constants[name] = np.float64(value)
+            return name
+        return repr(value)
+
+    codes = []
+    for arg in expr[1:]:
+        code = get_numexpr_code(arg, arrays, constants)
+        if op in LOGICAL_UFUNCS:
+            # numexpr 的 & | ~ 只接受逻辑值
+            if not is_bool(arg, arrays):
+                code = "({} != 0)".format(code)
+        elif is_bool(arg, arrays):
+            code = "where({}, 1.0, 0.0)".format(code)
+        codes.append(code)
+    if op == "NEG":
+        return "(-{})".format(codes[0])
+    if op == "NOT":
+        return "(~{})".format(codes[0])
+    return "({} {} {})".format(codes[0], NUMEXPR_OPS.get(op, op), codes[1])
+
+
+if numexpr is not None:
+    @register_kernel("FUSE", "numexpr")
+    def fuse_numexpr(expr, arrays):
+        constants = {}
+        code = get_numexpr_code(expr, arrays, constants)
+        local_dict = dict(("x{:d}".format(i), array) for i, array in enumerate(arrays))
+        local_dict.update(constants)
+        return numexpr.evaluate(code, local_dict=local_dict)
+
+
+def evaluate(expr, arrays):
+    """计算表达式
+
+    逻辑值参与算术运算时当作 1 和 0，数值参与逻辑运算时非 0 为真，和公式的语义一致，
+    和逐个运算的 numpy 结果不同的情况见 is_exact。
+
+    :param expr: 经过 check_expr 检查的 tuple 表达式
+    :param arrays: 长度相同的输入，逻辑值之外的转成 float64
+    :rtype: numpy.ndarray，比较和逻辑运算的结果为 bool
+    """
+    arrays = [np.asarray(array) for array in arrays]
+    arrays = [array if array.dtype == np.bool_ else array.astype(np.float64, copy=False) for array in arrays]
+    with np.errstate(all="ignore"):
+        return get_kernel("FUSE")(expr, arrays)
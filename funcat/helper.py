@@ -7,6 +7,10 @@ import datetime
 import numpy as np
 
 from .context import ExecutionContext, set_current_security, set_current_date, symbol
+from .time_series import bar_cache
+from .data.cache import get_load_end
+from .data.resample import get_source_freq
+from .lookback import infer_lookback, get_fetch_start_date
 from .utils import getsourcelines, FormulaException, get_int_date
 
 
@@ -30,24 +34,119 @@ def choose(order_book_id, func, callback):
         pass
 
 
+def get_lookback_start_date(calendar, date, lookback, freqs, default_freq):
+    """公式中用到的每个频率都要取够 lookback 根 bar，取最早的一个起始日期，无法确定时返回 None"""
+    start_dates = [get_fetch_start_date(calendar, date, lookback, freq if freq is not None else default_freq)
+                   for freq in (freqs or [None])]
+    if any(start_date is None for start_date in start_dates):
+        return None
+    return min(start_dates)
+
+
+def get_load_freq(data_backend, freq):
+    """实际向 data_backend 取行情的频率，在本地合成的频率取合成前的 1m/1d"""
+    if data_backend.local_resample:
+        return get_source_freq(freq) or freq
+    return freq
+
+
+def get_daily_history(data_backend, order_book_id, start, end, freq):
+    """返回公式本来就要加载的、每个交易日都有 bar 的历史，用来判断每天是否有行情
+
+    日线和分钟线用它们自己的历史，由 1m/1d 合成的频率用合成前的历史。
+    周线、月线等返回 None，交给 backend 的 get_availability（例如由停牌数据得到），不在这里另取日线。
+    """
+    freq = get_load_freq(data_backend, freq)
+    if freq in ("1d", "D") or (freq.endswith("m") and freq[:-1].isdigit()):
+        return bar_cache.get_history(data_backend, order_book_id, start=start, end=end, freq=freq)
+    return None
+
+
+def iter_prefetched(data_backend, order_book_id_list, start, end, freq, chunk_size=200):
+    """按 bar_cache 放得下的数量分批预加载，一批股票算完之后再加载下一批，依次返回 order_book_id
+
+    第一批只加载一只，用它的大小估计之后每批的数量。
+    """
+    i, size = 0, 1
+    while i < len(order_book_id_list):
+        chunk = order_book_id_list[i:i + size]
+        count, nbytes = bar_cache.prefetch(data_backend, chunk, start=start, end=end, freq=freq, chunk_size=chunk_size)
+        for order_book_id in chunk:
+            yield order_book_id
+        i += len(chunk)
+        size = bar_cache.get_prefetch_size(nbytes // count if count else None, chunk_size)
+
+
 @suppress_numpy_warn
-def select(func, start_date="2016-10-01", end_date=None, callback=print):
-    print(getsourcelines(func))
+def select(func, start_date="2016-10-01", end_date=None, callback=print, lookback=None, prefetch=True):
+    """
+    :param lookback: 公式需要最近多少根 bar，只取这些行情来计算。默认为 None，使用从 start_date 开始的全部历史；
+        为 "auto" 时由公式推断（见 funcat.lookback.infer_lookback），推断不了时同样使用全部历史
+    :param prefetch: 是否批量预加载股票的行情。每批的数量受 bar_cache 的条数和字节上限约束，
+        一批股票算完再加载下一批；设为 False 时按需逐只加载
+    """
+    print(getattr(func, "source", None) or getsourcelines(func))
     start_date = get_int_date(start_date)
     if end_date is None:
         end_date = datetime.date.today()
+    end_date = get_int_date(end_date)
     data_backend = ExecutionContext.get_data_backend()
     order_book_id_list = data_backend.get_order_book_id_list()
-    trading_dates = data_backend.get_trading_dates(start=start_date, end=end_date)
-    for idx, date in enumerate(reversed(trading_dates)):
-        if end_date and date > get_int_date(end_date):
-            continue
-        if date < get_int_date(start_date):
-            break
-        set_current_date(str(date))
-        print("[{}]".format(date))
-
-        for order_book_id in order_book_id_list:
-            choose(order_book_id, func, callback)
+    # 日历覆盖不到 start_date 或者 end_date 时重新生成
+    calendar = ExecutionContext.get_trading_calendar(start_date, end_date)
+    trading_dates = calendar.get_trading_dates(start_date, end_date)
+    start = ExecutionContext.get_start_date()
+    freq = ExecutionContext.get_current_freq()
+
+    freqs = None
+    if lookback == "auto":
+        lookback, freqs = infer_lookback(func)
+    fetch_start = None
+    if lookback and len(trading_dates) > 0:
+        fetch_start = get_lookback_start_date(calendar, trading_dates[0], lookback, freqs, freq)
+    if fetch_start is None or fetch_start <= start:
+        lookback, fetch_start = None, start
+
+    bar_count, old_fetch_start = ExecutionContext.get_bar_count(), ExecutionContext.get_fetch_start_date()
+    ExecutionContext.set_bar_count(lookback, fetch_start)
+    try:
+        if prefetch:
+            # 和 time_series.load_bars 取同样频率的行情，预加载的才能被用到
+            load_freq = get_load_freq(data_backend, freq)
+            if getattr(data_backend, "prefetch", None) is not None:
+                # 在后台按顺序加载，和公式计算同时进行
+                data_backend.prefetch(order_book_id_list, start=fetch_start, end=get_load_end(end_date), freq=load_freq)
+            else:
+                # 批量加载行情，之后每个交易日只需要截取
+                order_book_id_list = iter_prefetched(data_backend, order_book_id_list, fetch_start, end_date, load_freq)
+
+        # 逐只股票算完所有交易日，每只股票的历史只加载一次。
+        # 按日期在外层循环时，bar_cache 放不下所有股票的话每次访问都会被挤出去重新加载
+        dates = [(date, calendar.index(date)) for date in reversed(trading_dates.tolist())]
+        selected = dict((date, []) for date, _ in dates)
+        # 同一股票、日期下重复的计算只做一次
+        with ExecutionContext.memoize():
+            for order_book_id in order_book_id_list:
+                bars = get_daily_history(data_backend, order_book_id, fetch_start, end_date, freq)
+                mask = data_backend.get_availability(
+                    order_book_id, bars=bars, start=fetch_start if fetch_start != start else None)
+                for date, pos in dates:
+                    # 停牌、未上市或已退市的直接跳过
+                    if not mask[pos]:
+                        continue
+                    set_current_date(date)
+                    choose(order_book_id, func, lambda *args: selected[date].append(args))
+
+        # 按日期从近到远、股票的顺序输出
+        for date, _ in dates:
+            print("[{}]".format(date))
+            for args in selected[date]:
+                callback(*args)
+    finally:
+        ExecutionContext.set_bar_count(bar_count, old_fetch_start)
+        # 停止后台的预加载，出错或者被中断时不再占用内存。只取消预加载，不关闭用户的 backend
+        cancel_prefetch = getattr(data_backend, "cancel_prefetch", None)
+        if cancel_prefetch is not None:
+            cancel_prefetch()
 
     print("")
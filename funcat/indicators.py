@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+
 from .api import (
     OPEN, HIGH, LOW, CLOSE, VOLUME, AMO,
     ABS, MIN, MAX, HHV, LLV, CROSS,
@@ -8,8 +10,11 @@ from .api import (
 )
 from .time_series import (
     NumericSeries,
+    fused,
 )
+from .func import range_extreme
 
+@fused
 def KDJ(N=9, M1=3, M2=3):
     """
     KDJ 随机指标
@@ -22,6 +27,7 @@ def KDJ(N=9, M1=3, M2=3):
     return K, D, J
 
 
+@fused
 def DMI(M1=14, M2=6):
     """
     DMI 趋向指标
@@ -51,6 +57,7 @@ def MACD(SHORT=12, LONG=26, M=9):
     return DIFF, DEA, MACD
 
 
+@fused
 def RSI(N1=6, N2=12, N3=24):
     """
     RSI 相对强弱指标
@@ -75,6 +82,7 @@ def BOLL(N=20, P=2):
     return UPPER, MID, LOWER
 
 
+@fused
 def WR(N=10, N1=6):
     """
     W&R 威廉指标
@@ -95,6 +103,7 @@ def TQA(N1=20, N2=10):
     return TQA_H, TQA_L
 
 
+@fused
 def BIAS(L1=5, L4=3, L5=10):
     """
     BIAS 乖离率
@@ -106,6 +115,7 @@ def BIAS(L1=5, L4=3, L5=10):
     return BIAS, BIAS2, BIAS3
 
 
+@fused
 def ASI(M1=26, M2=10):
     """
     ASI 震动升降指标
@@ -165,6 +175,7 @@ def AMOUNT(M1=6, M2=12, M3=24):
     return AMO, MAAMO1, MAAMO2, MAAMO3
 
 
+@fused
 def ARBR(M1=26):
     """
     ARBR人气意愿指标
@@ -182,6 +193,7 @@ def DPO(M1=20, M2=10, M3=6):
     return DPO, MADPO
 
 
+@fused
 def TRIX(M1=12, M2=20):
     TR = EMA(EMA(EMA(CLOSE, M1), M1), M1)
     TRIX = (TR - REF(TR, 1)) / REF(TR, 1) * 100
@@ -210,6 +222,7 @@ def BBIBOLL(N=11, M=3):
     return BBIBOLL, UPR, DWN
 
 
+@fused
 def DKX(M=10):
     """
     DKX 多空线
@@ -227,44 +240,31 @@ def DKX(M=10):
     return DKX, MADKX
 
 
-def ZIG(K=3, N=10):
-    """计算之字转向"""
-    if isinstance(K, int):
-        if K == 0:
-            hhv = HHV(OPEN, 12)
-            llv = LLV(OPEN, 12)
-        elif K == 1:
-            hhv = HHV(HIGH, 12)
-            llv = LLV(HIGH, 12)
-        elif K == 2:
-            hhv = HHV(LOW, 12)
-            llv = LLV(LOW, 12)
-        elif K == 3:
-            hhv = HHV(CLOSE, 12)
-            llv = LLV(CLOSE, 12)
-        elif K == 4:
-            hhv = HHV(HIGH, 12)
-            llv = LLV(LOW, 12)
-        else:
-            hhv = HHV(CLOSE, 12)
-            llv = LLV(CLOSE, 12)
-    else:
-        hhv = HHV(K, 12)
-        llv = LLV(K, 12)
-    #
+def find_zig_peaks(hhv, llv, N):
+    """ZIG 的转折点，返回 [('high' 或 'low', 价格, 距今的周期数), ...]
+
+    只有 HHV/LLV 出现拐点的周期才可能成为转折点，先用数组运算找出这些周期，
+    再只对它们按距今由近到远执行状态机。
+    """
     count = min(len(hhv), len(llv)) - 1
-    # print(hhv.series)
-    # print(llv.series)
+    if count < 2:
+        return []
+    # 按距今的周期数排列，h[i] 即 REF(hhv, i).value
+    h = hhv[::-1][:count + 1]
+    l = llv[::-1][:count + 1]
+    with np.errstate(invalid='ignore'):
+        is_h = np.r_[False, (h[2:] < h[1:-1]) & (h[1:-1] == h[:-2])]
+        is_l = np.r_[False, (l[2:] > l[1:-1]) & (l[1:-1] == l[:-2])]
+
     cur_stat = None
-    last_h = ('high', hhv.value, 0)
-    last_l = ('low', llv.value, 0)
+    last_h = ('high', h[0], 0)
+    last_l = ('low', l[0], 0)
     peak_list = []
-    for i in range(1, count):
+    for i in np.flatnonzero(is_h | is_l).tolist():
         if cur_stat is None:
             # 状态为空时候初始化，需要同时判断峰谷两个点
-            new_h1, new_h2, new_h3 = REF(hhv, i+1).value, REF(hhv, i).value, REF(hhv, i-1).value
-            if new_h1 < new_h2 == new_h3 and new_h2 >= last_h[1]:
-                last_h = ('high', new_h2, i)
+            if is_h[i] and h[i] >= last_h[1]:
+                last_h = ('high', h[i], i)
                 # 涨幅还是跌幅
                 if last_h[2] > last_l[2]:
                     chg_ratio = (last_h[1] - last_l[1]) / last_h[1]
@@ -279,9 +279,8 @@ def ZIG(K=3, N=10):
                         peak_list.append(last_h)
                         peak_list.append(last_l)
                     cur_stat = -1
-            new_l1, new_l2, new_l3 = REF(llv, i+1).value, REF(llv, i).value, REF(llv, i-1).value
-            if new_l1 > new_l2 == new_l3 and new_l2 <= last_l[1]:
-                last_l = ('low', new_l2, i)
+            if is_l[i] and l[i] <= last_l[1]:
+                last_l = ('low', l[i], i)
                 # 涨幅还是跌幅
                 if last_h[2] > last_l[2]:
                     chg_ratio = (last_h[1] - last_l[1]) / last_h[1]
@@ -296,52 +295,66 @@ def ZIG(K=3, N=10):
                         peak_list.append(last_h)
                         peak_list.append(last_l)
                     cur_stat = 1
-            pass
         else:
             # 检测波峰并判断是否复合条件
-            new_h1, new_h2, new_h3 = REF(hhv, i+1).value, REF(hhv, i).value, REF(hhv, i-1).value
-            if new_h1 < new_h2 == new_h3:
-                # print(new_h1, new_h2, new_h3)
+            if is_h[i]:
                 flag, last_c, idx = peak_list[-1]
                 if flag == 'high':
-                    if new_h2 > last_c:
-                        peak_list[-1] = ('high', new_h2, i)
-                    else:
-                        pass
-                elif (new_h2 - last_c) / new_h2 > N/100:  # 跌幅
-                    peak_list.append(('high', new_h2, i))
-            # 检测波峰并判断是否复合条件
-            new_l1, new_l2, new_l3 = REF(llv, i+1).value, REF(llv, i).value, REF(llv, i-1).value
-            if new_l1 > new_l2 == new_l3:
-                # print(new_l1, new_l2, new_l3)
+                    if h[i] > last_c:
+                        peak_list[-1] = ('high', h[i], i)
+                elif (h[i] - last_c) / h[i] > N/100:  # 跌幅
+                    peak_list.append(('high', h[i], i))
+            # 检测波谷并判断是否复合条件
+            if is_l[i]:
                 flag, last_c, idx = peak_list[-1]
                 if flag == 'low':
-                    if new_l2 < last_c:
-                        peak_list[-1] = ('low', new_l2, i)
-                    else:
-                        pass
-                elif (last_c - new_l2) / new_l2 > N/100:  # 涨幅
-                    peak_list.append(('low', new_l2, i))
+                    if l[i] < last_c:
+                        peak_list[-1] = ('low', l[i], i)
+                elif (last_c - l[i]) / l[i] > N/100:  # 涨幅
+                    peak_list.append(('low', l[i], i))
+    return peak_list
+
+
+def ZIG(K=3, N=10):
+    """计算之字转向"""
+    if isinstance(K, int):
+        if K == 0:
+            hhv = HHV(OPEN, 12)
+            llv = LLV(OPEN, 12)
+        elif K == 1:
+            hhv = HHV(HIGH, 12)
+            llv = LLV(HIGH, 12)
+        elif K == 2:
+            hhv = HHV(LOW, 12)
+            llv = LLV(LOW, 12)
+        elif K == 3:
+            hhv = HHV(CLOSE, 12)
+            llv = LLV(CLOSE, 12)
+        elif K == 4:
+            hhv = HHV(HIGH, 12)
+            llv = LLV(LOW, 12)
+        else:
+            hhv = HHV(CLOSE, 12)
+            llv = LLV(CLOSE, 12)
+    else:
+        hhv = HHV(K, 12)
+        llv = LLV(K, 12)
+    peak_list = find_zig_peaks(hhv.series, llv.series, N)
     #
-    bool_list, h_bool_list, l_bool_list = [], [], []
-    i = 0
-    for p in peak_list:
-        while i != p[2]:
-            bool_list.append(False)
-            h_bool_list.append(False)
-            l_bool_list.append(False)
-            i += 1
-        if p[0] == 'low':
-            h_bool_list.append(False)
-            l_bool_list.append(True)
+    size = max(p[2] for p in peak_list) + 1 if peak_list else 0
+    bool_list = np.zeros(size, dtype=bool)
+    h_bool_list = np.zeros(size, dtype=bool)
+    l_bool_list = np.zeros(size, dtype=bool)
+    if size == 0:
+        empty = NumericSeries(np.array([], dtype=np.float64))
+        return empty, empty, empty, bool_list
+    # p[2] 是距今的周期数，掩码按时间正序
+    for flag, _, i in peak_list:
+        bool_list[size - 1 - i] = True
+        if flag == 'low':
+            l_bool_list[size - 1 - i] = True
         else:
-            h_bool_list.append(True)
-            l_bool_list.append(False)
-        bool_list.append(True)
-        i += 1
-    bool_list.reverse()
-    h_bool_list.reverse()
-    l_bool_list.reverse()
+            h_bool_list[size - 1 - i] = True
     #
     if isinstance(K, int):
         # o,h,l,c 对应返回
@@ -371,244 +384,125 @@ def ZIG(K=3, N=10):
         a_series = series[bool_list]
         h_series = series[h_bool_list]
         l_series = series[l_bool_list]
-    # print(peak_list)
-    # print(series)
     return NumericSeries(a_series), NumericSeries(h_series), NumericSeries(l_series), bool_list
 
 
+def find_boxes(flags, M):
+    """对每个周期找它之前最近的一段连续 flags 成立的区间
+
+    和逐周期扫描的结果一致：begin 是 [1, M - 1] 个周期前第一个成立的周期，
+    end 是这段连续区间最早的周期，但最多到 M - 2 个周期前。
+
+    :returns: (lo, hi, valid)，区间 end、begin 在序列中的下标，以及是否找到箱体
+    """
+    size = len(flags)
+    index = np.arange(size)
+    last_true = np.maximum.accumulate(np.where(flags, index, -1))
+    last_false = np.maximum.accumulate(np.where(flags, -1, index))
+    hi = np.r_[-1, last_true[:-1]]
+    begin = index - hi
+    end = np.minimum(index - (last_false[np.maximum(hi, 0)] + 1), M - 2)
+    valid = (hi >= 0) & (begin <= M - 1) & (end >= begin)
+    lo = index - end
+    hi = np.where(valid, hi, 0)
+    lo = np.where(valid, lo, 0)
+    return lo, hi, valid
+
+
+def get_box_candles(up):
+    """BOX_DOWN 找连续阳线，BOX_UP 找连续阴线，平盘时和前一天的收盘价比较"""
+    c, o = CLOSE.series, OPEN.series
+    prev_c = np.r_[np.nan, c[:-1]]
+    with np.errstate(invalid='ignore'):
+        if up:
+            return (c > o) | ((c == o) & (c > prev_c))
+        return (c < o) | ((c == o) & (c <= prev_c))
+
+
+def get_box_range(lo, hi, valid):
+    """[lo, hi] 区间内的最高价和最低价，没有箱体的周期为 nan"""
+    top = range_extreme(HIGH.series, lo, hi)
+    bottom = range_extreme(LOW.series, lo, hi, maximum=False)
+    top[~valid] = np.nan
+    bottom[~valid] = np.nan
+    return top, bottom
+
+
+def get_second_box(lo, valid, top, bottom):
+    """第一个箱体之前的第二个箱体，即在第一个箱体的 end 处再找一次"""
+    valid2 = valid & valid[lo]
+    top2 = np.where(valid2, top[lo], np.nan)
+    bottom2 = np.where(valid2, bottom[lo], np.nan)
+    return top2, bottom2
+
+
 def BOX_FIND(Direction=None, M1=20):
     """
     BOX_FIND 箱体查找
-    """    
+
+    返回每个周期的箱体 (end 处的最低价/最高价, end 处的开盘价, begin 处的收盘价, begin 处的最高价/最低价)，
+    没有箱体的周期为 nan。Direction 为 None 时按前一周期是阳线还是阴线决定方向。
+    """
+    c, o, h, l = CLOSE.series, OPEN.series, HIGH.series, LOW.series
+    with np.errstate(invalid='ignore'):
+        up = c > o
+        down = c < o
+    results = {}
+    for direction, flags in ((1, up), (-1, down)):
+        lo, hi, valid = find_boxes(flags, M1)
+        first = l if direction == 1 else h
+        last = h if direction == 1 else l
+        results[direction] = [np.where(valid, series[index], np.nan)
+                              for series, index in ((first, lo), (o, lo), (c, hi), (last, hi))]
     if Direction is None:
-        if REF(CLOSE,1) > REF(OPEN,1):
-            Direction = 1
-        else:
-            Direction = -1
-    # 不一定能够找到箱体
-    if Direction == 1:
-        begin_i, end_i = M1, 0
-        for i in range(1, M1):
-            if REF(CLOSE,i) > REF(OPEN,i):
-                begin_i = i
-                for j in range(begin_i, M1):
-                    if not REF(CLOSE,j) > REF(OPEN,j):
-                        break
-                end_i = j - 1
-                break
-        # print(begin_i, end_i)
-        if end_i >= begin_i:
-            # 箱体区间
-            return REF(LOW, end_i), REF(OPEN, end_i), REF(CLOSE, begin_i), REF(HIGH, begin_i)
+        prev_up = np.r_[False, up[:-1]]
+        result = [np.where(prev_up, s1, s2) for s1, s2 in zip(results[1], results[-1])]
     else:
-        begin_i, end_i = M1, 0
-        for i in range(1, M1):
-            if REF(CLOSE,i) < REF(OPEN,i):
-                begin_i = i
-                for j in range(begin_i, M1):
-                    if not REF(CLOSE,j) < REF(OPEN,j):
-                        break
-                end_i = j - 1
-                break
-        # print(begin_i, end_i)
-        if end_i >= begin_i:
-            # 箱体区间
-            return REF(HIGH, end_i), REF(OPEN, end_i), REF(CLOSE, begin_i), REF(LOW, begin_i)
-        
-        
+        result = results[1] if Direction == 1 else results[-1]
+    return tuple(NumericSeries(series) for series in result)
+
+
 def BOX_DOWN(M2=20):
     """
     BOX_DOWN 查找前面周期连续阳线，来确定向下突破箱体
+
+    返回每个周期的 (箱体底, 箱体顶)，没有箱体的周期为 nan
     """
-    start_i, stop_i = 1, M2
-    begin_i, end_i = M2, 0
-    # for i in range(start_i, stop_i):
-    #     if REF(CLOSE,i) > REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) > REF(CLOSE,i+1)):
-    #         begin_i = i
-    #         for j in range(begin_i, stop_i):
-    #             if not REF(CLOSE,j) > REF(OPEN,j):
-    #                 break
-    #         end_i = j - 1
-    #         break
-    c_index, c_series, o_index, o_series = len(CLOSE) - 1, CLOSE.series, len(OPEN) - 1, OPEN.series
-    for i in range(start_i, stop_i):
-        if c_series[c_index-i] > o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] > c_series[c_index-(i+1)]):
-            begin_i = i
-            for j in range(begin_i, stop_i):
-                if not (c_series[c_index-j] > o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] > c_series[c_index-(j+1)])):
-                    break
-            end_i = j - 1
-            break
-    # 不一定能够找到箱体
-    if end_i >= begin_i:
-        # 第一个箱体区间
-        n1 = end_i - begin_i
-        if n1 <= 1:
-            bottom1, top1 = MIN(REF(LOW, end_i), REF(LOW, begin_i)), MAX(REF(HIGH, end_i), REF(HIGH, begin_i))
-        else:
-            bottom1, top1 = LLV(REF(LOW, begin_i), n1+1), HHV(REF(HIGH, begin_i), n1+1)
-        return bottom1, top1
-    #
-    return None, None
+    lo, hi, valid = find_boxes(get_box_candles(up=True), M2)
+    top, bottom = get_box_range(lo, hi, valid)
+    return NumericSeries(bottom), NumericSeries(top)
+
 
- 
 def BOX_UP(M2=20):
     """
     BOX_UP 查找前面周期连续阴线，来确定向上突破箱体
+
+    返回每个周期的 (箱体顶, 箱体底)，没有箱体的周期为 nan
     """
-    start_i, stop_i = 1, M2
-    begin_i, end_i = M2, 0
-    # for i in range(start_i, stop_i):
-    #     if REF(CLOSE,i) < REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) < REF(CLOSE,i+1)):
-    #         begin_i = i
-    #         for j in range(begin_i, stop_i):
-    #             if not REF(CLOSE,j) < REF(OPEN,j):
-    #                 break
-    #         end_i = j - 1
-    #         break
-    c_index, c_series, o_index, o_series = len(CLOSE) - 1, CLOSE.series, len(OPEN) - 1, OPEN.series
-    for i in range(start_i, stop_i):
-        if c_series[c_index-i] < o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] <= c_series[c_index-(i+1)]):
-            begin_i = i
-            for j in range(begin_i, stop_i):
-                if not (c_series[c_index-j] < o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] <= c_series[c_index-(j+1)])):
-                    break
-            end_i = j - 1
-            break
-    # 不一定能够找到箱体
-    if end_i >= begin_i:
-        # 第一个箱体区间
-        n1 = end_i - begin_i
-        if n1 <= 1:
-            top1, bottom1 = MAX(REF(HIGH, end_i), REF(HIGH, begin_i)), MIN(REF(LOW, end_i), REF(LOW, begin_i))
-        else:
-            top1, bottom1 = HHV(REF(HIGH, begin_i), n1+1), LLV(REF(LOW, begin_i), n1+1)
-        return top1, bottom1
-    #
-    return None, None
+    lo, hi, valid = find_boxes(get_box_candles(up=False), M2)
+    top, bottom = get_box_range(lo, hi, valid)
+    return NumericSeries(top), NumericSeries(bottom)
+
 
-                
 def BOX_BOX_DOWN(M2=20):
     """
     BOX_DOWN 查找前面周期连续阳线，来确定向下突破箱体
+
+    返回每个周期的 (箱体底, 箱体顶, 第二个箱体底, 第二个箱体顶)，没有箱体的周期为 nan
     """
-    start_i, stop_i = 1, M2
-    begin_i, end_i = M2, 0
-    # for i in range(start_i, stop_i):
-    #     if REF(CLOSE,i) > REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) > REF(CLOSE,i+1)):
-    #         begin_i = i
-    #         for j in range(begin_i, stop_i):
-    #             if not (REF(CLOSE,j) > REF(OPEN,j) or (REF(CLOSE,j) == REF(OPEN,j) and REF(CLOSE,j) > REF(CLOSE,j+1))):
-    #                 break
-    #         end_i = j - 1
-    #         break
-    c_index, c_series, o_index, o_series = len(CLOSE) - 1, CLOSE.series, len(OPEN) - 1, OPEN.series
-    for i in range(start_i, stop_i):
-        if c_series[c_index-i] > o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] > c_series[c_index-(i+1)]):
-            begin_i = i
-            for j in range(begin_i, stop_i):
-                if not (c_series[c_index-j] > o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] > c_series[c_index-(j+1)])):
-                    break
-            end_i = j - 1
-            break
-    # 不一定能够找到箱体
-    if end_i >= begin_i:
-        # 第一个箱体区间
-        n1 = end_i - begin_i
-        if n1 <= 1:
-            bottom1, top1 = MIN(REF(LOW, end_i), REF(LOW, begin_i)), MAX(REF(HIGH, end_i), REF(HIGH, begin_i))
-        else:
-            bottom1, top1 = LLV(REF(LOW, begin_i), n1+1), HHV(REF(HIGH, begin_i), n1+1)
-        # 之后再找第二个
-        start_i, stop_i = 1 + end_i, M2 + end_i
-        begin_i, end_i = M2, 0
-        # for i in range(start_i, stop_i):
-        #     if REF(CLOSE,i) > REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) > REF(CLOSE,i+1)):
-        #         begin_i = i
-        #         for j in range(begin_i, stop_i):
-        #             if not (REF(CLOSE,j) > REF(OPEN,j) or (REF(CLOSE,j) == REF(OPEN,j) and REF(CLOSE,j) > REF(CLOSE,j+1))):
-        #                 break
-        #         end_i = j - 1
-        #         break
-        for i in range(start_i, stop_i):
-            if c_series[c_index-i] > o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] > c_series[c_index-(i+1)]):
-                begin_i = i
-                for j in range(begin_i, stop_i):
-                    if not (c_series[c_index-j] > o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] > c_series[c_index-(j+1)])):
-                        break
-                end_i = j - 1
-                break
-        if end_i >= begin_i:
-            n2 = end_i - begin_i
-            if n2 <= 1:
-                bottom2, top2 = MIN(REF(LOW, end_i), REF(LOW, begin_i)), MAX(REF(HIGH, end_i), REF(HIGH, begin_i))
-            else:
-                bottom2, top2 = LLV(REF(LOW, begin_i), n2+1), HHV(REF(HIGH, begin_i), n2+1)
-            return bottom1, top1, bottom2, top2
-        else:
-            return bottom1, top1, None, None
-    #
-    return None, None, None, None
+    lo, hi, valid = find_boxes(get_box_candles(up=True), M2)
+    top, bottom = get_box_range(lo, hi, valid)
+    top2, bottom2 = get_second_box(lo, valid, top, bottom)
+    return NumericSeries(bottom), NumericSeries(top), NumericSeries(bottom2), NumericSeries(top2)
+
 
-   
 def BOX_BOX_UP(M2=20):
     """
     BOX_UP 查找前面周期连续阴线，来确定向上突破箱体
+
+    返回每个周期的 (箱体顶, 箱体底, 第二个箱体顶, 第二个箱体底)，没有箱体的周期为 nan
     """
-    start_i, stop_i = 1, M2
-    begin_i, end_i = M2, 0
-    # for i in range(start_i, stop_i):
-    #     if REF(CLOSE,i) < REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) <= REF(CLOSE,i+1)):
-    #         begin_i = i
-    #         for j in range(begin_i, stop_i):
-    #             if not (REF(CLOSE,j) < REF(OPEN,j) or (REF(CLOSE,j) == REF(OPEN,j) and REF(CLOSE,j) <= REF(CLOSE,j+1))):
-    #                 break
-    #         end_i = j - 1
-    #         break
-    c_index, c_series, o_index, o_series = len(CLOSE) - 1, CLOSE.series, len(OPEN) - 1, OPEN.series
-    for i in range(start_i, stop_i):
-        if c_series[c_index-i] < o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] <= c_series[c_index-(i+1)]):
-            begin_i = i
-            for j in range(begin_i, stop_i):
-                if not (c_series[c_index-j] < o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] <= c_series[c_index-(j+1)])):
-                    break
-            end_i = j - 1
-            break
-    # 不一定能够找到箱体
-    if end_i >= begin_i:
-        # 第一个箱体区间
-        n1 = end_i - begin_i
-        if n1 <= 1:
-            top1, bottom1 = MAX(REF(HIGH, end_i), REF(HIGH, begin_i)), MIN(REF(LOW, end_i), REF(LOW, begin_i))
-        else:
-            top1, bottom1 = HHV(REF(HIGH, begin_i), n1+1), LLV(REF(LOW, begin_i), n1+1)
-        # 之后再找第二个
-        start_i, stop_i = 1 + end_i, M2 + end_i
-        begin_i, end_i = M2, 0
-        # for i in range(start_i, stop_i):
-        #     if REF(CLOSE,i) < REF(OPEN,i) or (REF(CLOSE,i) == REF(OPEN,i) and REF(CLOSE,i) <= REF(CLOSE,i+1)):
-        #         begin_i = i
-        #         for j in range(begin_i, stop_i):
-        #             if not (REF(CLOSE,j) < REF(OPEN,j) or (REF(CLOSE,j) == REF(OPEN,j) and REF(CLOSE,j) <= REF(CLOSE,j+1))):
-        #                 break
-        #         end_i = j - 1
-        #         break
-        for i in range(start_i, stop_i):
-            if c_series[c_index-i] < o_series[o_index-i] or (c_series[c_index-i] == o_series[o_index-i] and c_series[c_index-i] <= c_series[c_index-(i+1)]):
-                begin_i = i
-                for j in range(begin_i, stop_i):
-                    if not (c_series[c_index-j] < o_series[o_index-j] or (c_series[c_index-j] == o_series[o_index-j] and c_series[c_index-j] <= c_series[c_index-(j+1)])):
-                        break
-                end_i = j - 1
-                break
-        if end_i >= begin_i:
-            n2 = end_i - begin_i
-            if n2 <= 1:
-                top2, bottom2 = MAX(REF(HIGH, end_i), REF(HIGH, begin_i)), MIN(REF(LOW, end_i), REF(LOW, begin_i))
-            else:
-                top2, bottom2 = HHV(REF(HIGH, begin_i), n2+1), LLV(REF(LOW, begin_i), n2+1)
-            return top1, bottom1, top2, bottom2
-        else:
-            return top1, bottom1, None, None
-    #
-    return None, None, None, None
\ No newline at end of file
+    lo, hi, valid = find_boxes(get_box_candles(up=False), M2)
+    top, bottom = get_box_range(lo, hi, valid)
+    top2, bottom2 = get_second_box(lo, valid, top, bottom)
+    return NumericSeries(top), NumericSeries(bottom), NumericSeries(top2), NumericSeries(bottom2)
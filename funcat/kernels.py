@@ -0,0 +1,712 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import os
+import json
+import time
+import functools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+try:
+    import talib
+except ImportError:
+    talib = None
+try:
+    from scipy.signal import lfilter
+except ImportError:
+    lfilter = None
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from .utils import FormulaException
+
+
+# 基础运算的名字 -> {实现的名字: 函数}
+KERNELS = OrderedDict()
+
+# 强制使用的实现，例如 "numpy" 或者 "MA=talib,EMA=numba"
+KERNELS_ENV = "FUNCAT_KERNELS"
+# 测速结果的缓存文件，不设置时只保存在内存中，每个进程第一次用到时测速
+KERNEL_CACHE_ENV = "FUNCAT_KERNEL_CACHE"
+
+_selected = {}
+_lock = threading.RLock()
+
+
+def register_kernel(name, impl):
+    """把函数注册为 name 的一种实现
+
+    :param name: 基础运算的名字，例如 MA
+    :param impl: 实现的名字，例如 numpy
+    """
+    def decorator(func):
+        KERNELS.setdefault(name, OrderedDict())[impl] = func
+        return func
+    return decorator
+
+
+def get_kernel(name):
+    """返回 name 当前使用的实现
+
+    优先级：set_kernel 指定的 > 环境变量 FUNCAT_KERNELS 指定的 > FUNCAT_KERNEL_CACHE 缓存文件中的测速结果 > 当场测速
+    """
+    func = _selected.get(name)
+    if func is not None:
+        return func
+    with _lock:
+        if name not in _selected:
+            impls = KERNELS.get(name)
+            if not impls:
+                raise FormulaException("unknown kernel {}".format(name))
+            impl = get_forced_impl(name)
+            if impl is None:
+                impl = load_kernel_cache().get(name)
+            if impl not in impls:
+                timings = benchmark_kernel(name)
+                impl = min(timings, key=timings.get)
+                save_kernel_cache(name, impl)
+            _selected[name] = impls[impl]
+        return _selected[name]
+
+
+def set_kernel(name, impl):
+    """指定 name 使用的实现，impl 为 None 时重新选择"""
+    with _lock:
+        if impl is None:
+            _selected.pop(name, None)
+            return
+        if impl not in KERNELS.get(name, {}):
+            raise FormulaException("kernel {} has no implementation {}".format(name, impl))
+        _selected[name] = KERNELS[name][impl]
+
+
+def dispatcher(name):
+    """返回调用 name 当前实现的函数，可以放在类属性里"""
+    def dispatch(*args):
+        return get_kernel(name)(*args)
+    dispatch.__name__ = name
+    return dispatch
+
+
+def get_forced_impl(name):
+    impls = KERNELS[name]
+    preferred = []
+    for item in os.environ.get(KERNELS_ENV, "").split(","):
+        item = item.strip()
+        if "=" in item:
+            kernel, impl = item.split("=", 1)
+            if kernel.strip() == name:
+                return impl.strip()
+        elif item:
+            preferred.append(item)
+    for impl in preferred:
+        if impl in impls:
+            return impl
+    return None
+
+
+def get_kernel_cache_path():
+    """没有设置环境变量 FUNCAT_KERNEL_CACHE 时为 None，不读写磁盘"""
+    path = os.environ.get(KERNEL_CACHE_ENV)
+    return os.path.expanduser(path) if path else None
+
+
+def load_kernel_cache():
+    path = get_kernel_cache_path()
+    if path is None:
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_kernel_cache(name, impl):
+    path = get_kernel_cache_path()
+    if path is None:
+        return
+    cache = load_kernel_cache()
+    cache[name] = impl
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)
+    except (IOError, OSError):
+        pass
+
+
+def get_benchmark_args(name, size, invalid=False):
+    """测速用的参数
+
+    :param invalid: 是否在中间放 nan 和 inf，用来检查各实现的结果是否一致，不用来测速
+    """
+    rng = np.random.RandomState(0)
+    close = 10 + np.cumsum(rng.normal(0, 0.1, size))
+    if invalid:
+        close[[size // 3, size // 3 + 1, size // 2]] = np.nan
+        close[size * 2 // 3] = -np.inf
+    if name == "CCI":
+        return close + 0.1, close - 0.1, close, 14
+    if name == "SMA":
+        return close, 1 / 6
+    if name == "COUNT":
+        return close > close.mean(), 20
+    if name == "FUSE":
+        # KDJ 的 RSV：(C - LLV) / (HHV - LLV) * 100
+        high, low = close + 0.1, close - 0.1
+        rsv = ("*", ("/", ("-", ("input", 0), ("input", 1)), ("-", ("input", 2), ("input", 1))), ("const", 100))
+        return rsv, [close, low, high]
+    return close, 20
+
+
+def is_consistent(name, impl, args):
+    """impl 的结果是否和 numpy 实现一致，出错也算不一致"""
+    impls = KERNELS[name]
+    if impl == "numpy" or "numpy" not in impls:
+        return True
+    try:
+        with np.errstate(all="ignore"):
+            expected = impls["numpy"](*args)
+            result = impls[impl](*args)
+    except Exception:
+        return False
+    return np.allclose(result, expected, rtol=1e-6, atol=1e-8, equal_nan=True)
+
+
+def benchmark_kernel(name, size=10000, repeat=5):
+    """测量 name 每种实现的耗时，结果和 numpy 实现不一致的实现会被排除
+
+    在没有 nan 的数据上测速，另外用中间有 nan、inf 的数据检查结果是否一致，
+    否则遇到 nan 时改用 numpy 实现的 TA-Lib 测的是 numpy 的速度。
+
+    :returns: {实现的名字: 秒}
+    """
+    args = get_benchmark_args(name, size)
+    invalid_args = get_benchmark_args(name, size, invalid=True)
+    timings = {}
+    for impl, func in KERNELS[name].items():
+        # is_consistent 中的调用包含 JIT 编译，不计时
+        if not is_consistent(name, impl, args) or not is_consistent(name, impl, invalid_args):
+            continue
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            elapsed.append(time.perf_counter() - start)
+        timings[impl] = min(elapsed)
+    if not timings:
+        raise FormulaException("no usable implementation for kernel {}".format(name))
+    return timings
+
+
+def talib_compatible(inputs=1, poison=True):
+    """和 TA-Lib 的行为保持一致：跳过开头的 nan，输出和输入等长，前 n - 1 个为 nan
+
+    poison 为 True 时，开头之后出现 nan 则之后的输出全是 nan（TA-Lib 用累加和计算）；
+    为 False 时中间的 nan 交给被装饰的函数处理，例如用 window_nan 只让包含 nan 的窗口为 nan。
+    被装饰的函数的参数是 inputs 个去掉开头 nan 的序列、窗口长度 n 和其他参数，返回从第 n - 1 个开始的结果。
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            arrays = [np.asarray(arg, dtype=np.float64) for arg in args[:inputs]]
+            n = args[inputs]
+            size = len(arrays[0])
+            result = np.full(size, np.nan)
+            finite = ~np.isnan(arrays[0])
+            for array in arrays[1:]:
+                finite &= ~np.isnan(array)
+            begin = int(np.argmax(finite)) if finite.any() else size
+            if n < 1 or size - begin < n:
+                return result
+            if poison and n == 1:
+                # 窗口长度为 1 时 TA-Lib 原样输出，nan 只影响所在的位置
+                arrays = [np.where(finite, array, 0) for array in arrays]
+            values = func(*([array[begin:] for array in arrays] + [n] + list(args[inputs + 1:])))
+            result[begin + n - 1:] = values
+            if poison and not finite[begin:].all():
+                if n == 1:
+                    result[~finite] = np.nan
+                else:
+                    result[begin + int(np.argmin(finite[begin:])):] = np.nan
+            return result
+        return wrapper
+    return decorator
+
+
+def window_nan(func):
+    """窗口中有 nan 或 inf 时结果为 nan，只影响包含它的窗口，之后的窗口照常计算
+
+    用在 talib_compatible(poison=False) 里面，被装饰的函数只会拿到有限的数。
+    """
+    @functools.wraps(func)
+    def wrapper(series, n, *args):
+        invalid = ~np.isfinite(series)
+        if not invalid.any():
+            return func(series, n, *args)
+        result = func(np.where(invalid, 0, series), n, *args)
+        result[count_true(invalid, n) > 0] = np.nan
+        return result
+    return wrapper
+
+
+def get_block_sums(values, n):
+    """把 values 按 n 分块，返回每个位置到所在块末尾的和、所在块开头到这个位置的和，展平成一维"""
+    blocks = values.reshape(-1, n)
+    suffix = np.cumsum(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    prefix = np.cumsum(blocks, axis=1).ravel()
+    return suffix, prefix
+
+
+def split_windows(series, n):
+    """和 sliding_extreme 一样按 n 分块，窗口 [i, i + n - 1] 拆成 i 所在块的后缀和下一块的前缀
+
+    每一段最多只累加 n 个数，误差不会像整个序列的累加和那样随长度增长。
+
+    :returns: (分块后补齐的序列, 后缀的长度, 前缀的长度)
+    """
+    size = len(series)
+    blocks = np.concatenate([series, np.zeros(-size % n)])
+    head = n - np.arange(size - n + 1) % n
+    return blocks, head, n - head
+
+
+def rolling_sum(series, n):
+    """滑动窗口的和"""
+    blocks, head, tail = split_windows(series, n)
+    suffix, prefix = get_block_sums(blocks, n)
+    m = len(head)
+    return suffix[:m] + np.where(tail > 0, prefix[n - 1:n - 1 + m], 0)
+
+
+def rolling_var(series, n):
+    """滑动窗口的总体方差
+
+    每块先减去块的第一个数，后缀和前缀两段分别求离差平方和，再用 Chan 的公式合并，
+    避免 E[X^2] - E[X]^2 的大数相消。
+    """
+    blocks, head, tail = split_windows(series, n)
+    anchors = np.repeat(blocks[::n], n)
+    centered = blocks - anchors
+    suffix, prefix = get_block_sums(centered, n)
+    square_suffix, square_prefix = get_block_sums(centered * centered, n)
+    m = len(head)
+    has_tail = tail > 0
+    head_sum = suffix[:m]
+    tail_sum = np.where(has_tail, prefix[n - 1:n - 1 + m], 0)
+    tail_size = np.maximum(tail, 1)
+    head_m2 = square_suffix[:m] - head_sum * head_sum / head
+    tail_m2 = np.where(has_tail, square_prefix[n - 1:n - 1 + m] - tail_sum * tail_sum / tail_size, 0)
+    delta = (anchors[n - 1:n - 1 + m] + tail_sum / tail_size) - (anchors[:m] + head_sum / head)
+    return (head_m2 + tail_m2 + delta * delta * head * tail / n) / n
+
+
+# ewm: Y = weight * X + (1 - weight) * Y'，第一个值取 X
+
+def ewm_lfilter(series, weight):
+    """用 scipy 的 IIR 滤波计算 ewm，有 nan 或 inf 时滤波器的状态会变成 nan，改用 ewm_numpy"""
+    if not np.isfinite(series).all():
+        return ewm_numpy(series, weight)
+    decay = 1 - weight
+    results = np.empty_like(series)
+    results[0] = series[0]
+    results[1:], _ = lfilter([weight], [1, -decay], series[1:], zi=[decay * series[0]])
+    return results
+
+
+def ewm_numpy(series, weight, block_size=256):
+    """ewm 的 numpy 实现，按块展开递推
+
+    块内 Y[j] = decay^(j+1) * (Y[-1] + weight * sum(X[k] / decay^(k+1)))，
+    块的长度保证 decay^block_size 不会下溢。X 很大时 X[k] / decay^(k+1) 可能溢出，这样的块逐个递推。
+    """
+    decay = 1 - weight
+    results = np.empty_like(series)
+    results[0] = series[0]
+    if decay == 0:
+        results[1:] = series[1:]
+        return results
+    if decay < 1:
+        block_size = int(min(block_size, max(1, 100 / -np.log10(decay))))
+    powers = decay ** np.arange(1, block_size + 1)
+    prev = series[0]
+    for start in range(1, len(series), block_size):
+        chunk = series[start:start + block_size]
+        p = powers[:len(chunk)]
+        with np.errstate(over="ignore", invalid="ignore"):
+            block = p * (prev + weight * np.cumsum(chunk / p))
+        if not np.isfinite(block[-1]) and np.isfinite(prev) and np.isfinite(chunk).all():
+            for k, value in enumerate(chunk):
+                prev = weight * value + decay * prev
+                block[k] = prev
+        results[start:start + len(chunk)] = block
+        prev = block[-1]
+    return results
+
+
+def count_true(series, n):
+    """滑动窗口内 series == True 的个数，用累加和的差计算
+
+    :param n: 窗口长度，为 0 时从第一个元素开始累计
+    :returns: n 为 0 时长度为 len(series)，否则为 len(series) - n + 1
+    """
+    if n < 0 or n > len(series):
+        raise FormulaException("window size {} out of range".format(n))
+    cumsum = np.cumsum(series == True, dtype=np.int64)
+    if n == 0:
+        return cumsum
+    return cumsum[n - 1:] - np.r_[0, cumsum[:len(cumsum) - n]]
+
+
+def sliding_extreme(series, n, maximum=True, with_offset=False):
+    """滑动窗口的最大（最小）值，van Herk/Gil-Werman 算法，和窗口长度无关，O(len)
+
+    把序列按 n 分块，窗口 [i, i + n - 1] 最多跨两块，其最大值是
+    i 所在块的后缀最大值和 i + n - 1 所在块的前缀最大值中较大的一个。
+    窗口中有 nan 时结果为 nan，和 np.max 一致。
+
+    :param n: 窗口长度，为 0 时从第一个元素开始
+    :param with_offset: 是否同时返回最大值到窗口末尾的距离，有多个最大值时取最近的
+    :returns: (values, offsets)，长度为 len(series) - n + 1，n 为 0 时为 len(series)
+    """
+    x = np.asarray(series, dtype=np.float64)
+    size = len(x)
+    if n < 0 or n > size or size == 0:
+        raise FormulaException("window size {} out of range".format(n))
+    if not maximum:
+        x = -x
+    nan_mask = np.isnan(x)
+    has_nan = nan_mask.any()
+    if has_nan:
+        x = np.where(nan_mask, -np.inf, x)
+
+    if n == 0:
+        values = np.maximum.accumulate(x)
+        ends = np.arange(size)
+        args = np.maximum.accumulate(np.where(x == values, ends, -1)) if with_offset else None
+        nan_windows = np.cumsum(nan_mask) > 0 if has_nan else None
+    else:
+        blocks = np.concatenate([x, np.full(-size % n, -np.inf)]).reshape(-1, n)
+        prefix = np.maximum.accumulate(blocks, axis=1)
+        suffix = np.maximum.accumulate(blocks[:, ::-1], axis=1)[:, ::-1]
+        head = suffix.ravel()[:size - n + 1]
+        tail = prefix.ravel()[n - 1:size]
+        values = np.maximum(head, tail)
+        ends = np.arange(n - 1, size)
+        args = None
+        if with_offset:
+            positions = np.arange(blocks.size).reshape(blocks.shape)
+            # 前缀最大值最近一次出现的位置
+            prefix_args = np.maximum.accumulate(np.where(blocks == prefix, positions, -1), axis=1)
+            # 后缀最大值最近一次出现的位置，是后缀最大值保持不变的这一段的末尾
+            run_ends = np.ones(blocks.shape, dtype=bool)
+            run_ends[:, :-1] = suffix[:, :-1] > suffix[:, 1:]
+            suffix_args = np.minimum.accumulate(
+                np.where(run_ends, positions, blocks.size)[:, ::-1], axis=1)[:, ::-1]
+            args = np.where(tail >= head, prefix_args.ravel()[n - 1:size], suffix_args.ravel()[:size - n + 1])
+        nan_windows = count_true(nan_mask, n) > 0 if has_nan else None
+
+    if not maximum:
+        values = -values
+    offsets = (ends - args).astype(np.float64) if with_offset else None
+    if has_nan:
+        values[nan_windows] = np.nan
+        if with_offset:
+            offsets[nan_windows] = np.nan
+    return values, offsets
+
+
+# numpy
+
+@register_kernel("MA", "numpy")
+@talib_compatible()
+def ma_numpy(series, n):
+    return rolling_sum(series, n) / n
+
+
+@register_kernel("SUM", "numpy")
+@talib_compatible()
+def sum_numpy(series, n):
+    return rolling_sum(series, n)
+
+
+@register_kernel("WMA", "numpy")
+@talib_compatible(poison=False)
+@window_nan
+def wma_numpy(series, n):
+    return np.convolve(series, np.arange(n, 0, -1, dtype=np.float64), "valid") / (n * (n + 1) / 2)
+
+
+@register_kernel("EMA", "numpy")
+@talib_compatible()
+def ema_numpy(series, n):
+    # 和 TA-Lib 一样用前 n 个的均值作为初值
+    return ewm_numpy(np.r_[series[:n].mean(), series[n:]], 2 / (n + 1))
+
+
+@register_kernel("STD", "numpy")
+@talib_compatible(poison=False)
+@window_nan
+def std_numpy(series, n, nbdev=1.0):
+    return np.sqrt(np.maximum(rolling_var(series, n), 0)) * nbdev
+
+
+@register_kernel("CCI", "numpy")
+@talib_compatible(inputs=3, poison=False)
+def cci_numpy(high, low, close, n):
+    typical = (high + low + close) / 3
+    windows = np.lib.stride_tricks.as_strided(
+        typical, shape=(len(typical) - n + 1, n), strides=typical.strides * 2)
+    mean = windows.mean(axis=1)
+    deviation = np.abs(windows - mean[:, None]).mean(axis=1)
+    diff = typical[n - 1:] - mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where((deviation != 0) & (diff != 0), diff / (0.015 * deviation), 0.0)
+
+
+@register_kernel("SMA", "numpy")
+def sma_numpy(series, weight):
+    return ewm_numpy(series, weight)
+
+
+@register_kernel("HHV", "numpy")
+def hhv_numpy(series, n):
+    return sliding_extreme(series, n)[0]
+
+
+@register_kernel("LLV", "numpy")
+def llv_numpy(series, n):
+    return sliding_extreme(series, n, maximum=False)[0]
+
+
+register_kernel("COUNT", "numpy")(count_true)
+
+
+# scipy
+
+if lfilter is not None:
+    @register_kernel("EMA", "scipy")
+    @talib_compatible()
+    def ema_scipy(series, n):
+        return ewm_lfilter(np.r_[series[:n].mean(), series[n:]], 2 / (n + 1))
+
+    @register_kernel("SMA", "scipy")
+    def sma_scipy(series, weight):
+        return ewm_lfilter(series, weight)
+
+
+# TA-Lib
+
+if talib is not None:
+    def has_invalid(arrays):
+        """去掉开头的 nan 之后是否还有 nan 或 inf"""
+        valid = ~np.isnan(arrays[0])
+        for array in arrays[1:]:
+            valid &= ~np.isnan(array)
+        begin = int(np.argmax(valid)) if valid.any() else len(valid)
+        return not all(np.isfinite(array[begin:]).all() for array in arrays)
+
+    def register_talib(name, func, min_period=1):
+        """TA-Lib 用累加和计算，中间有 nan 或 inf 时之后的结果和 numpy 实现不同，
+        窗口长度小于 min_period 时报错，这两种情况改用 numpy 实现
+        """
+        def call(*args):
+            args = [np.asarray(arg, dtype=np.float64) if isinstance(arg, np.ndarray) else arg for arg in args]
+            arrays = [arg for arg in args if isinstance(arg, np.ndarray)]
+            if args[len(arrays)] < min_period or has_invalid(arrays):
+                return KERNELS[name]["numpy"](*args)
+            return func(*args)
+        call.__name__ = func.__name__
+        register_kernel(name, "talib")(call)
+
+    register_talib("MA", talib.MA)
+    register_talib("EMA", talib.EMA)
+    register_talib("WMA", talib.WMA)
+    register_talib("STD", talib.STDDEV, min_period=2)
+    register_talib("SUM", talib.SUM, min_period=2)
+    register_talib("CCI", talib.CCI, min_period=2)
+
+
+# numba
+
+if numba is not None:
+    # 累加和每 n 个重新计算一次，避免加减累积的浮点误差，均摊下来仍然是 O(len)
+
+    @numba.njit(cache=True)
+    def sum_numba_raw(series, n):
+        result = np.empty(len(series) - n + 1)
+        total = 0.0
+        for i in range(len(series)):
+            if i >= n and i % n == 0:
+                total = 0.0
+                for k in range(i - n + 1, i + 1):
+                    total += series[k]
+            else:
+                total += series[i]
+                if i >= n:
+                    total -= series[i - n]
+            if i >= n - 1:
+                result[i - n + 1] = total
+        return result
+
+    @numba.njit(cache=True)
+    def wma_numba_raw(series, n):
+        result = np.empty(len(series) - n + 1)
+        total = 0.0
+        weighted = 0.0
+        for i in range(len(series)):
+            if i < n:
+                weighted += (i + 1) * series[i]
+                total += series[i]
+            elif i % n == 0:
+                total = 0.0
+                weighted = 0.0
+                for k in range(i - n + 1, i + 1):
+                    total += series[k]
+                    weighted += (k - i + n) * series[k]
+            else:
+                # 窗口内原有的权重都减 1，最早的一个移出
+                weighted += n * series[i] - total
+                total += series[i] - series[i - n]
+            if i >= n - 1:
+                result[i - n + 1] = weighted / (n * (n + 1) / 2)
+        return result
+
+    @numba.njit(cache=True)
+    def ewm_numba(series, weight):
+        result = np.empty(len(series))
+        result[0] = series[0]
+        for i in range(1, len(series)):
+            if weight == 1:
+                # 和 ewm_numpy 一样直接取 X，不让之前的 inf 乘 0 得到 nan
+                result[i] = series[i]
+            else:
+                result[i] = weight * series[i] + (1 - weight) * result[i - 1]
+        return result
+
+    @numba.njit(cache=True)
+    def std_numba_raw(series, n, nbdev):
+        # Welford 算法的滑动窗口版本，m2 是窗口内的离差平方和
+        result = np.empty(len(series) - n + 1)
+        mean = 0.0
+        m2 = 0.0
+        for i in range(len(series)):
+            value = series[i]
+            if i < n:
+                delta = value - mean
+                mean += delta / (i + 1)
+                m2 += delta * (value - mean)
+            elif i % n == 0:
+                mean = 0.0
+                for k in range(i - n + 1, i + 1):
+                    mean += series[k]
+                mean /= n
+                m2 = 0.0
+                for k in range(i - n + 1, i + 1):
+                    m2 += (series[k] - mean) * (series[k] - mean)
+            else:
+                oldest = series[i - n]
+                old_mean = mean
+                mean += (value - oldest) / n
+                m2 += (value - oldest) * (value - mean + oldest - old_mean)
+            if i >= n - 1:
+                result[i - n + 1] = np.sqrt(m2 / n) * nbdev if m2 > 0 else 0.0
+        return result
+
+    @numba.njit(cache=True)
+    def sliding_max_numba(series, n):
+        # 单调队列，nan 当作 -inf，窗口中有 nan 时结果为 nan
+        size = len(series)
+        result = np.empty(size - n + 1)
+        queue = np.empty(size, dtype=np.int64)
+        values = np.empty(size)
+        head = 0
+        tail = 0
+        last_nan = -1
+        for i in range(size):
+            value = series[i]
+            if value != value:
+                last_nan = i
+                value = -np.inf
+            values[i] = value
+            while tail > head and values[queue[tail - 1]] <= value:
+                tail -= 1
+            queue[tail] = i
+            tail += 1
+            if queue[head] <= i - n:
+                head += 1
+            if i >= n - 1:
+                result[i - n + 1] = np.nan if last_nan > i - n else values[queue[head]]
+        return result
+
+    @numba.njit(cache=True)
+    def count_numba_raw(hits, n):
+        result = np.empty(len(hits) - n + 1, dtype=np.int64)
+        total = 0
+        for i in range(len(hits)):
+            total += hits[i]
+            if i >= n:
+                total -= hits[i - n]
+            if i >= n - 1:
+                result[i - n + 1] = total
+        return result
+
+    @register_kernel("MA", "numba")
+    @talib_compatible()
+    def ma_numba(series, n):
+        return sum_numba_raw(series, n) / n
+
+    @register_kernel("SUM", "numba")
+    @talib_compatible()
+    def sum_numba(series, n):
+        return sum_numba_raw(series, n)
+
+    @register_kernel("WMA", "numba")
+    @talib_compatible(poison=False)
+    @window_nan
+    def wma_numba(series, n):
+        return wma_numba_raw(series, n)
+
+    @register_kernel("EMA", "numba")
+    @talib_compatible()
+    def ema_numba(series, n):
+        return ewm_numba(np.concatenate((np.full(1, series[:n].mean()), series[n:])), 2 / (n + 1))
+
+    @register_kernel("STD", "numba")
+    @talib_compatible(poison=False)
+    @window_nan
+    def std_numba(series, n, nbdev=1.0):
+        return std_numba_raw(series, n, float(nbdev))
+
+    @register_kernel("SMA", "numba")
+    def sma_numba(series, weight):
+        return ewm_numba(series, weight)
+
+    @register_kernel("HHV", "numba")
+    def hhv_numba(series, n):
+        if n == 0 or n > len(series):
+            return hhv_numpy(series, n)
+        return sliding_max_numba(np.asarray(series, dtype=np.float64), n)
+
+    @register_kernel("LLV", "numba")
+    def llv_numba(series, n):
+        if n == 0 or n > len(series):
+            return llv_numpy(series, n)
+        return -sliding_max_numba(-np.asarray(series, dtype=np.float64), n)
+
+    @register_kernel("COUNT", "numba")
+    def count_numba(series, n):
+        if n <= 0 or n > len(series):
+            return count_true(series, n)
+        return count_numba_raw((series == True).astype(np.int64), n)
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import math
+
+import six
+
+from .context import ExecutionContext
+from .time_series import TimeSeries, MarketDataSeries, ExprSeries, ref
+from .utils import FormulaException
+from .func import (
+    SumSeries,
+    AbsSeries,
+    StdSeries,
+    SMASeries,
+    CCISeries,
+    MovingAverageSeries,
+    WeightedMovingAverageSeries,
+    ExponentialMovingAverageSeries,
+    CrossOver,
+    Ref,
+    minimum,
+    maximum,
+    every,
+    exist,
+    last,
+    count,
+    hhv,
+    llv,
+    hhvbars,
+    llvbars,
+    iif,
+)
+
+
+# EMA、SMA 这类递推的指标，初值的权重衰减到 EMA_TOLERANCE 以下才认为结果稳定
+EMA_TOLERANCE = 1e-6
+
+# ExprSeries.func -> 规则
+LOOKBACK_RULES = {}
+
+
+def register_lookback(*funcs):
+    """注册 funcs 的 lookback 规则
+
+    规则的参数是节点的 args 和 tolerance，返回在参数需要的 bar 数之外还要往前多看几根，
+    返回 None 表示需要全部历史。lazy_operator 包装过的函数和 ExprSeries 中的原函数都会注册。
+    """
+    def decorator(rule):
+        for func in funcs:
+            LOOKBACK_RULES[func] = rule
+            LOOKBACK_RULES[getattr(func, "__wrapped__", func)] = rule
+        return rule
+    return decorator
+
+
+def get_decay_bars(weight, tolerance):
+    """Y = weight * X + (1 - weight) * Y' 中初值的权重衰减到 tolerance 以下需要的周期数"""
+    if weight >= 1:
+        return 0
+    if weight <= 0:
+        return None
+    return int(math.ceil(math.log(tolerance) / math.log(1 - weight)))
+
+
+def get_window(n):
+    """窗口长度为 n 时需要多看的 bar 数，n 为 0 时表示从第一个周期开始"""
+    if not isinstance(n, six.integer_types) or n <= 0:
+        return None
+    return n - 1
+
+
+@register_lookback(
+    TimeSeries.__lt__, TimeSeries.__gt__, TimeSeries.__eq__, TimeSeries.__ne__, TimeSeries.__ge__,
+    TimeSeries.__le__, TimeSeries.__and__, TimeSeries.__or__, TimeSeries.__invert__,
+    TimeSeries.__sub__, TimeSeries.__rsub__, TimeSeries.__add__, TimeSeries.__radd__,
+    TimeSeries.__mul__, TimeSeries.__rmul__, TimeSeries.__truediv__, TimeSeries.__rtruediv__,
+    AbsSeries, minimum, maximum, iif)
+def elementwise_lookback(args, tolerance):
+    return 0
+
+
+@register_lookback(ref, Ref)
+def ref_lookback(args, tolerance):
+    n = args[1]
+    return n if isinstance(n, six.integer_types) and n >= 0 else None
+
+
+@register_lookback(CrossOver)
+def cross_lookback(args, tolerance):
+    return 1
+
+
+@register_lookback(MovingAverageSeries, WeightedMovingAverageSeries, StdSeries, SumSeries)
+def window_lookback(args, tolerance):
+    return get_window(args[1])
+
+
+@register_lookback(CCISeries)
+def cci_lookback(args, tolerance):
+    # CCISeries(high, low, close) 固定用 14 日
+    return 13
+
+
+@register_lookback(ExponentialMovingAverageSeries)
+def ema_lookback(args, tolerance):
+    # 和 TA-Lib 一样前 n 个的均值作为初值
+    window = get_window(args[1])
+    if window is None:
+        return None
+    return window + get_decay_bars(2 / (args[1] + 1), tolerance)
+
+
+@register_lookback(SMASeries)
+def sma_lookback(args, tolerance):
+    n, m = args[1], args[2]
+    if n <= 0 or not 0 <= m <= n:
+        return None
+    return get_decay_bars(m / n, tolerance)
+
+
+@register_lookback(count, every, exist, hhv, llv, hhvbars, llvbars)
+def count_lookback(args, tolerance):
+    return get_window(args[1])
+
+
+@register_lookback(last)
+def last_lookback(args, tolerance):
+    a = args[1]
+    if not isinstance(a, six.integer_types) or a <= 0:
+        return None
+    return a
+
+
+def get_lookback(series, tolerance=EMA_TOLERANCE):
+    """计算 series 最后一个值需要最近多少根 bar
+
+    :param series: TimeSeries，一般是惰性模式下得到的 ExprSeries
+    :param tolerance: EMA、SMA 初值的权重衰减到 tolerance 以下才认为结果稳定
+    :returns: bar 数，不依赖行情时为 0，无法推断（有未知的运算或者需要全部历史）时为 None
+    """
+    return _get_lookback(series, tolerance, {})
+
+
+def _get_lookback(series, tolerance, visited):
+    if isinstance(series, MarketDataSeries):
+        return 1 if series._dynamic_update else 0
+    if not isinstance(series, ExprSeries):
+        return 0
+    if id(series) in visited:
+        return visited[id(series)]
+
+    lookbacks = [_get_lookback(arg, tolerance, visited) for arg in series.args if isinstance(arg, TimeSeries)]
+    result = get_call_lookback(series.func, series.args, lookbacks, tolerance)
+    visited[id(series)] = result
+    return result
+
+
+def get_call_lookback(func, args, lookbacks, tolerance=EMA_TOLERANCE):
+    """func(*args) 最后一个值需要最近多少根 bar
+
+    :param args: 规则只用到其中的常数参数，序列参数可以用 None 代替
+    :param lookbacks: args 中每个序列参数需要的 bar 数
+    """
+    rule = LOOKBACK_RULES.get(func)
+    if rule is None or None in lookbacks:
+        return None
+    result = max(lookbacks) if lookbacks else 0
+    if result == 0:
+        return 0
+    try:
+        extra = rule(args, tolerance)
+    except (TypeError, ValueError, IndexError):
+        # 参数个数不对或者应该是常数的参数是序列，推断不了，计算时再报错
+        return None
+    return None if extra is None else result + extra
+
+
+def get_freqs(series):
+    """series 用到的行情频率，None 表示当前频率"""
+    freqs = set()
+    stack = [series]
+    visited = set()
+    while stack:
+        node = stack.pop()
+        if id(node) in visited:
+            continue
+        visited.add(id(node))
+        if isinstance(node, MarketDataSeries) and node._dynamic_update:
+            freqs.add(node._freq)
+        elif isinstance(node, ExprSeries):
+            stack.extend(node.args)
+    return freqs
+
+
+def infer_lookback(func, tolerance=EMA_TOLERANCE):
+    """在惰性模式下调用一次 func 得到表达式，推断需要的 bar 数
+
+    func 中如果有 if、and、or 等需要取值的 Python 语句，或者调用了不支持惰性计算的指标，
+    推断时会需要行情，这种情况返回 None。func 有 get_lookback 方法（比如编译好的 Formula）时直接调用。
+    推断只是优化，func 在推断时抛出的任何异常都当作推断不了，真正计算时再报出来。
+
+    :returns: (bar 数, 用到的频率)，无法推断时为 (None, None)
+    """
+    try:
+        get_func_lookback = getattr(func, "get_lookback", None)
+        if get_func_lookback is not None:
+            return get_func_lookback(tolerance)
+        with ExecutionContext.tracing():
+            series = func()
+        if not isinstance(series, TimeSeries):
+            return None, None
+        return get_lookback(series, tolerance), get_freqs(series)
+    except Exception:
+        return None, None
+
+
+# 每个交易日最多有几根 bar
+BARS_PER_DAY = 240
+
+
+def get_fetch_start_date(calendar, date, bar_count, freq):
+    """为了在 date 得到 bar_count 根 freq 的 bar，需要从哪个交易日开始取行情
+
+    周线按每周最多 5 个交易日、月线按每月最多 23 个交易日往前推，分钟线多取一天。
+
+    :returns: 交易日，超出交易日历的范围时为 None
+    """
+    if freq in ("1w", "W"):
+        days = bar_count * 5
+    elif freq in ("1M", "M"):
+        days = bar_count * 23
+    elif freq == "1d":
+        days = bar_count
+    elif freq.endswith("m") and freq[:-1].isdigit() and 0 < int(freq[:-1]) <= BARS_PER_DAY:
+        days = int(math.ceil(bar_count / (BARS_PER_DAY // int(freq[:-1])))) + 1
+    else:
+        return None
+    try:
+        return calendar.offset(date, -(days - 1))
+    except IndexError:
+        return None
@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import math
+from collections import deque
+
+import numpy as np
+
+from .utils import FormulaException
+
+
+class StreamingIndicator(object):
+    """增量计算的指标，每来一根新 bar 调用一次 update，O(1) 得到最新的值
+
+    结果和 func.py 中对应的序列在同一根 bar 上的值一致，
+    适合盘中对大量股票逐根 bar 更新，不用每次从 start_date 开始重新计算整个序列。
+
+    :param field: update 传入的是 bar 时取哪个字段，例如 close，为 None 时传入的就是数值
+    """
+
+    def __init__(self, field=None):
+        self.field = field
+        self.value = np.nan
+        self.count = 0
+
+    def update(self, bar):
+        """加入一根新 bar，返回最新的指标值"""
+        value = bar if self.field is None else bar[self.field]
+        self.value = self._update(float(value))
+        self.count += 1
+        return self.value
+
+    def update_many(self, bars):
+        """依次加入多根 bar，例如用历史行情预热，返回每根 bar 上的指标值
+
+        :param bars: numpy.rec.array 或者数值序列
+        :rtype: numpy.ndarray
+        """
+        values = bars if self.field is None else bars[self.field]
+        result = np.empty(len(values), dtype=np.float64)
+        for i, value in enumerate(values):
+            result[i] = self._update(float(value))
+            self.count += 1
+        if len(values) > 0:
+            self.value = result[-1]
+        return result
+
+    def _update(self, value):
+        """self.count 是 value 的下标"""
+        raise NotImplementedError
+
+
+class TalibStreamingIndicator(StreamingIndicator):
+    """和 TA-Lib 一样跳过开头的 nan，之后出现 nan 则一直输出 nan（n 为 1 时只影响所在的位置）
+
+    poison 为 False 时，和 kernels.window_nan 一样 nan 只影响包含它的窗口，由 _push_nan 处理。
+    """
+
+    poison = True
+
+    def __init__(self, n, field=None):
+        if n < 1:
+            raise FormulaException("window size must be >= 1")
+        super(TalibStreamingIndicator, self).__init__(field)
+        self.n = n
+        self.started = False
+        self.poisoned = False
+
+    def _update(self, value):
+        # 和 replace_inf(series, np.nan) 一致
+        if value == np.inf:
+            value = np.nan
+        if value != value:
+            if self.started and self.n > 1:
+                if not self.poison:
+                    return self._push_nan()
+                self.poisoned = True
+            return np.nan
+        self.started = True
+        if self.poisoned:
+            return np.nan
+        return self._push(value)
+
+    def _push(self, value):
+        raise NotImplementedError
+
+    def _push_nan(self):
+        raise NotImplementedError
+
+
+class RollingSum(object):
+    """最近 n 个数的和
+
+    每 n 次更新用 math.fsum 重新求一次和，避免加减累积的浮点误差，均摊下来仍然是 O(1)。
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.window = deque(maxlen=n)
+        self.total = 0.0
+        self.updates = 0
+
+    def push(self, value):
+        """加入 value，返回窗口还没填满时为 nan"""
+        if len(self.window) == self.n:
+            self.total -= self.window[0]
+        self.window.append(value)
+        self.total += value
+        self.updates += 1
+        if self.updates == self.n:
+            self.updates = 0
+            self.total = math.fsum(self.window)
+        if len(self.window) < self.n:
+            return np.nan
+        return self.total
+
+
+class StreamingSUM(TalibStreamingIndicator):
+    """最近 n 个周期的和"""
+
+    def __init__(self, n, field=None):
+        super(StreamingSUM, self).__init__(n, field)
+        self.sum = RollingSum(n)
+
+    def _update(self, value):
+        # 和 replace_inf(series, 0, negative=True) 一致
+        if value == np.inf or value == -np.inf:
+            value = 0.0
+        return super(StreamingSUM, self)._update(value)
+
+    def _push(self, value):
+        return self.sum.push(value)
+
+
+class StreamingMA(TalibStreamingIndicator):
+    """简单移动平均"""
+
+    def __init__(self, n, field=None):
+        super(StreamingMA, self).__init__(n, field)
+        self.sum = RollingSum(n)
+
+    def _push(self, value):
+        return self.sum.push(value) / self.n
+
+
+class StreamingSTD(TalibStreamingIndicator):
+    """最近 n 个周期的总体标准差，和 STD 一致
+
+    用 Welford 算法的滑动窗口版本维护均值和离差平方和，避免 E[X^2] - E[X]^2 的大数相消，
+    和 RollingSum 一样每 n 次更新重新计算一次。
+    窗口中有 nan 或 -inf 时为 nan，移出窗口之后恢复。
+    """
+
+    poison = False
+
+    def __init__(self, n, nbdev=1.0, field=None):
+        super(StreamingSTD, self).__init__(n, field)
+        self.nbdev = nbdev
+        self.window = deque(maxlen=n)
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.updates = 0
+
+    def _push_nan(self):
+        # 之后的 n 个窗口都包含这个 nan，重新开始累计
+        self.window.clear()
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.updates = 0
+        return np.nan
+
+    def _push(self, value):
+        if value == -np.inf:
+            return self._push_nan()
+        window = self.window
+        if len(window) < self.n:
+            window.append(value)
+            delta = value - self.mean
+            self.mean += delta / len(window)
+            self.m2 += delta * (value - self.mean)
+        else:
+            oldest = window[0]
+            window.append(value)
+            old_mean = self.mean
+            self.mean += (value - oldest) / self.n
+            self.m2 += (value - oldest) * (value - self.mean + oldest - old_mean)
+        self.updates += 1
+        if self.updates == self.n:
+            self.updates = 0
+            self.mean = math.fsum(window) / len(window)
+            self.m2 = math.fsum((x - self.mean) ** 2 for x in window)
+        if len(window) < self.n:
+            return np.nan
+        return math.sqrt(max(self.m2, 0) / self.n) * self.nbdev
+
+
+class StreamingEMA(TalibStreamingIndicator):
+    """指数移动平均，和 TA-Lib 一样用前 n 个的均值作为初值"""
+
+    def __init__(self, n, field=None):
+        super(StreamingEMA, self).__init__(n, field)
+        self.weight = 2 / (n + 1)
+        self.seen = 0
+        self.ema = 0.0
+
+    def _push(self, value):
+        self.seen += 1
+        if self.seen < self.n:
+            self.ema += value
+            return np.nan
+        if self.seen == self.n:
+            self.ema = (self.ema + value) / self.n
+        else:
+            self.ema = self.weight * value + (1 - self.weight) * self.ema
+        return self.ema
+
+
+class StreamingSMA(StreamingIndicator):
+    """同花顺专用SMA
+
+    SMA(X, N, M): Y = (M * X + (N - M) * Y') / N，第一个值取 X，X 中的 nan 当作 0
+    """
+
+    def __init__(self, n, m, field=None):
+        if not 0 <= m <= n or n <= 0:
+            raise FormulaException("SMA requires 0 <= M <= N and N > 0")
+        super(StreamingSMA, self).__init__(field)
+        self.weight = m / n
+        self.sma = None
+
+    def _update(self, value):
+        # 和 replace_inf(series, np.nan) 之后 np.nan_to_num 一致，+inf 当作 0
+        if value != value or value == np.inf:
+            value = 0.0
+        elif value == -np.inf:
+            value = -np.finfo(np.float64).max
+        if self.sma is None:
+            self.sma = value
+        else:
+            self.sma = self.weight * value + (1 - self.weight) * self.sma
+        return self.sma
+
+
+class StreamingHHV(StreamingIndicator):
+    """最近 n 个周期的最大值，n 为 0 时从第一个周期开始
+
+    用单调队列保存窗口内可能成为最大值的 bar，每根 bar 最多进出队列一次。
+    窗口中有 nan 时结果为 nan，和 HHV 一致。
+    """
+
+    maximum = True
+
+    def __init__(self, n, field=None):
+        if n < 0:
+            raise FormulaException("window size must be >= 0")
+        super(StreamingHHV, self).__init__(field)
+        self.n = n
+        self.sign = 1.0 if self.maximum else -1.0
+        self.candidates = deque()
+        self.last_nan = None
+
+    def _update(self, value):
+        index = self.count
+        if value != value:
+            self.last_nan = index
+        else:
+            value *= self.sign
+            candidates = self.candidates
+            while candidates and candidates[-1][1] <= value:
+                candidates.pop()
+            candidates.append((index, value))
+        if self.n > 0 and self.candidates and self.candidates[0][0] <= index - self.n:
+            self.candidates.popleft()
+
+        if self.n > 0 and index < self.n - 1:
+            return np.nan
+        if self.last_nan is not None and (self.n == 0 or self.last_nan > index - self.n):
+            return np.nan
+        return self.candidates[0][1] * self.sign
+
+
+class StreamingLLV(StreamingHHV):
+    """最近 n 个周期的最小值，n 为 0 时从第一个周期开始"""
+
+    maximum = False
@@ -3,40 +3,70 @@
 
 from __future__ import division
 
+import functools
+
 import six
 import numpy as np
 
 from .utils import wrap_formula_exc, FormulaException
 from .context import ExecutionContext
+from .data.cache import BarCache, DEFAULT_MAXBYTES
+from .data.resample import Resampler, get_source_freq
+from . import fusion
+
+
+bar_cache = BarCache(maxbytes=DEFAULT_MAXBYTES)
+resampler = Resampler()
+
+
+def load_bars(data_backend, order_book_id, start_date, current_date, freq):
+    source_freq = get_source_freq(freq) if data_backend.local_resample else None
+    if source_freq is not None:
+        # 由缓存中的 1m/1d 合成，不再单独取数据
+        history = bar_cache.get_history(data_backend, order_book_id, start=start_date, end=current_date, freq=source_freq)
+        return resampler.get_bars((data_backend, order_book_id, freq, start_date), history, freq, end=current_date)
+    return bar_cache.get_bars(data_backend, order_book_id, start=start_date, end=current_date, freq=freq)
 
 
 def get_bars(freq):
+    if ExecutionContext.is_tracing():
+        raise FormulaException("market data is not available while tracing")
     data_backend = ExecutionContext.get_data_backend()
     current_date = ExecutionContext.get_current_date()
     order_book_id = ExecutionContext.get_current_security()
     start_date = ExecutionContext.get_start_date()
-
-    try:
-        bars = data_backend.get_price(order_book_id, start=start_date, end=current_date, freq=freq)
-    except KeyError:
-        return np.array([])
+    bar_count = ExecutionContext.get_bar_count()
+    fetch_start_date = ExecutionContext.get_fetch_start_date()
+
+    if bar_count is None or fetch_start_date is None or fetch_start_date <= start_date:
+        fetch_start_date = start_date
+    bars = load_bars(data_backend, order_book_id, fetch_start_date, current_date, freq)
+    if bar_count is not None:
+        if len(bars) < bar_count and fetch_start_date != start_date:
+            # 中间停牌或者新上市，从 fetch_start_date 开始不够 bar_count 根，改为从 start_date 开始取
+            bars = load_bars(data_backend, order_book_id, start_date, current_date, freq)
+        bars = bars[-bar_count:]
 
     # return empty array direct
     if len(bars) == 0:
         return bars
 
     # if security is suspend, just skip
-    if data_backend.skip_suspended and bars["datetime"][-1] // 1000000 < current_date and freq not in ("1w", "W", "M"):
+    if data_backend.skip_suspended and bars["datetime"][-1] // 1000000 < current_date and freq not in ("1w", "W", "1M", "M"):
         ExecutionContext.set_current_date(bars["datetime"][-1] // 1000000)
 
     return bars
 
 
 def fit_series(*series_list):
-    size = min(len(series) for series in series_list)
+    """把序列截成相同长度，0 维的标量保持不变，由 numpy 广播"""
+    sizes = [len(series) for series in series_list if np.ndim(series) > 0]
+    if not sizes:
+        return list(series_list)
+    size = min(sizes)
     if size == 0:
         raise FormulaException("series size == 0")
-    new_series_list = [series[-size:] for series in series_list]
+    new_series_list = [series[-size:] if np.ndim(series) > 0 else series for series in series_list]
     return new_series_list
 
 
@@ -51,14 +81,73 @@ def get_series(val):
     if isinstance(val, TimeSeries):
         return val.series
     else:
-        return DuplicateNumericSeries(val).series
+        return ScalarSeries(val).series
+
+
+# 单个股票、日期下 memo 最多缓存的结果数，超过后清空
+MEMO_MAXSIZE = 4096
+
+
+def get_arg_key(arg):
+    if isinstance(arg, (TimeSeries, np.ndarray)):
+        return ("id", id(arg))
+    return (type(arg), arg)
+
+
+def apply_operator(func, args):
+    if isinstance(func, SeriesOperatorMeta):
+        return type.__call__(func, *args)
+    return func(*args)
+
+
+def memo_call(func, args):
+    """开启 memoize 时，在当前股票、日期下，同样的函数和参数只计算一次
+
+    参数按对象标识比较，memo 持有参数的引用，所以 id 不会被复用。
+    """
+    memo = ExecutionContext.get_memo()
+    if memo is None:
+        return apply_operator(func, args)
+    key = (func, ExecutionContext.get_stamp()) + tuple(get_arg_key(arg) for arg in args)
+    try:
+        entry = memo.get(key)
+    except TypeError:
+        return apply_operator(func, args)
+    if entry is not None:
+        return entry[1]
+    result = apply_operator(func, args)
+    if len(memo) >= MEMO_MAXSIZE:
+        memo.clear()
+    memo[key] = (args, result)
+    return result
+
+
+def call_operator(func, args, result_type):
+    """惰性模式下返回 ExprSeries 节点，否则经过 memo 立即计算"""
+    if ExecutionContext.is_lazy():
+        return ExprSeries(func, args, result_type)
+    return memo_call(func, args)
+
+
+def lazy_operator(result_type):
+    """被装饰的函数在惰性模式下返回 result_type 类型的 ExprSeries 节点，否则经过 memo 计算"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            return call_operator(func, args, result_type)
+        return wrapper
+    return decorator
+
+
+def ref(series, n):
+    return series._shift(n)
 
 
 def ensure_timeseries(series):
     if isinstance(series, TimeSeries):
         return series
     else:
-        return DuplicateNumericSeries(series)
+        return ScalarSeries(series)
 
 
 class TimeSeries(object):
@@ -73,13 +162,18 @@ class TimeSeries(object):
     @property
     @wrap_formula_exc
     def value(self):
+        series = self.series
+        # 常数之间运算的结果是 0 维数组
+        if np.ndim(series) == 0:
+            return series[()]
         try:
-            return self.series[-1]
+            return series[-1]
         except IndexError:
             raise FormulaException("DATA UNAVAILABLE")
 
     def __len__(self):
-        return len(self.series)
+        series = self.series
+        return len(series) if np.ndim(series) > 0 else 1
 
     @wrap_formula_exc
     def __lt__(self, other):
@@ -217,17 +311,31 @@ class NumericSeries(TimeSeries):
 
     def __getitem__(self, index):
         assert isinstance(index, int) and index >= 0
+        return self._shift(index)
+
+    def _shift(self, index):
         return self.__class__(series=self.series[:len(self.series) - index], **self.extra_create_kwargs)
 
 
-class DuplicateNumericSeries(NumericSeries):
-    # FIXME size should come from other series
-    def __init__(self, series, size=640000):
+class ScalarSeries(NumericSeries):
+    """常数序列，series 是 0 维数组，和其他序列运算时由 numpy 广播到对方的长度
+    """
+    def __init__(self, series):
         try:
             val = series[-1]
         except:
             val = series
-        super(DuplicateNumericSeries, self).__init__(np.full(size, val, dtype=np.float64))
+        super(ScalarSeries, self).__init__(np.array(val, dtype=np.float64))
+
+    def __getitem__(self, index):
+        assert isinstance(index, int) and index >= 0
+        return self
+
+    def _shift(self, index):
+        return self
+
+
+DuplicateNumericSeries = ScalarSeries
 
 
 class MarketDataSeries(NumericSeries):
@@ -243,29 +351,33 @@ class MarketDataSeries(NumericSeries):
 
     def _ensure_series_update(self):
         if self._dynamic_update:
-            # TODO: cache
             freq = self._freq if self._freq is not None else ExecutionContext.get_current_freq()
             bars = get_bars(freq)
             if len(bars) > 0:
-                self._series = bars[self.name].astype(self.dtype)
+                # 直接引用缓存中的 bars，设为只读防止被公式修改
+                series = bars[self.name].astype(self.dtype, copy=False)
+                series.flags.writeable = False
+                self._series = series
             else:
                 self._series = bars
 
     def __getitem__(self, index):
         if isinstance(index, int):
             assert index >= 0
+            if self._dynamic_update:
+                return call_operator(ref, (self, index), self.__class__)
 
         if isinstance(index, six.string_types):
             unit = index[-1]
             period = int(index[:-1])
-            assert unit in ["m", "d"]
+            assert unit in ["m", "d", "w", "M"]
             assert period > 0
             freq = index
             # 因为是行情数据，所以需要动态更新
             time_series = self.__class__(dynamic_update=True, freq=freq, **self.extra_create_kwargs)
             return time_series
 
-        return self.__class__(series=self.series[:len(self.series) - index], **self.extra_create_kwargs)
+        return self._shift(index)
 
     @property
     def series(self):
@@ -283,3 +395,207 @@ class MarketDataSeries(NumericSeries):
 
 class BoolSeries(NumericSeries):
     pass
+
+
+class SeriesOperatorMeta(type):
+    """用位置参数构造 Series 时和其他运算一样，惰性模式下返回 ExprSeries 节点，否则经过 memo
+
+    用 series= 关键字参数构造（比如 __getitem__ 中）时总是直接创建。
+    """
+    def __call__(cls, *args, **kwargs):
+        if kwargs or not args:
+            return super(SeriesOperatorMeta, cls).__call__(*args, **kwargs)
+        return call_operator(cls, args, cls)
+
+
+class ExprSeries(NumericSeries):
+    """惰性计算的表达式节点
+
+    func 是立即计算的实现，args 中的 ExprSeries 先计算再传给 func。
+    计算结果按 ExecutionContext.get_stamp() 缓存，股票、日期、频率变化后重新计算。
+
+    :param func: 立即计算的函数或者 Series 类
+    :param args: func 的参数
+    :param result_type: 计算结果的类型
+    """
+
+    def __init__(self, func, args, result_type=NumericSeries):
+        super(ExprSeries, self).__init__(None)
+        self.func = func
+        self.args = tuple(args)
+        self.result_type = result_type
+        self._key = None
+        self._result = None
+        self._stamp = None
+        self._fused = None
+
+    @property
+    def key(self):
+        """结构相同的表达式 key 相同"""
+        if self._key is None:
+            self._key = (self.func, ) + tuple(get_expr_key(arg) for arg in self.args)
+        return self._key
+
+    def evaluate(self):
+        """计算表达式，返回 result_type 类型的结果"""
+        if self._result is not None and self._stamp == ExecutionContext.get_stamp():
+            return self._result
+        with ExecutionContext.eager():
+            if ExecutionContext.is_fusion() and self._fused is None:
+                self._fused = get_fused_expr(self) or False
+            result = None
+            if ExecutionContext.is_fusion() and self._fused:
+                # 两个逻辑值的算术运算、数值的逻辑运算不合并，和逐个运算一样按 numpy 的规则计算或者报错
+                result = evaluate_fused(*self._fused, exact=True)
+            if result is None:
+                args = tuple(arg.evaluate() if isinstance(arg, ExprSeries) else arg for arg in self.args)
+                result = memo_call(self.func, args)
+        # 停牌时 get_bars 会修改当前日期，所以 stamp 在计算之后取
+        self._result, self._stamp = result, ExecutionContext.get_stamp()
+        return result
+
+    @property
+    def series(self):
+        return self.evaluate().series
+
+    def __getitem__(self, index):
+        if ExecutionContext.is_lazy():
+            return ExprSeries(ref, (self, index), self.result_type)
+        return self.evaluate()[index]
+
+
+def get_expr_key(arg):
+    if isinstance(arg, ExprSeries):
+        return arg.key
+    if isinstance(arg, MarketDataSeries) and arg._dynamic_update:
+        return ("bars", arg.name, arg._freq)
+    if isinstance(arg, TimeSeries) or isinstance(arg, np.ndarray):
+        return ("id", id(arg))
+    return ("const", arg)
+
+
+def is_fusible(arg):
+    return isinstance(arg, (TimeSeries, bool, float, np.number) + six.integer_types)
+
+
+def get_fused_expr(root):
+    """把 root 和它下面连续的逐元素运算收集成一个 fusion 表达式
+
+    在 root 下出现多次的节点和其他运算作为输入，结构相同的输入只算一次。
+    结果只取决于表达式的结构，在 ExprSeries 中缓存，换股票、日期时不用重新收集。
+
+    :returns: (表达式, 输入的序列)，root 不是逐元素运算时返回 None
+    """
+    if root.func not in FUSED_OPS or not all(is_fusible(arg) for arg in root.args):
+        return None
+    counts = {}
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        for arg in node.args:
+            if isinstance(arg, ExprSeries) and arg.func in FUSED_OPS:
+                counts[id(arg)] = counts.get(id(arg), 0) + 1
+                if counts[id(arg)] == 1:
+                    stack.append(arg)
+
+    inputs = []
+    input_ids = {}
+
+    def visit(node, inline):
+        if inline:
+            op, reflected = FUSED_OPS[node.func]
+            args = [visit_arg(arg) for arg in node.args]
+            return (op, ) + tuple(reversed(args) if reflected else args)
+        key = get_expr_key(node)
+        if key not in input_ids:
+            input_ids[key] = len(inputs)
+            inputs.append(node)
+        return ("input", input_ids[key])
+
+    def visit_arg(arg):
+        if not isinstance(arg, TimeSeries):
+            return ("const", arg)
+        inline = (isinstance(arg, ExprSeries) and arg.func in FUSED_OPS and counts[id(arg)] == 1 and
+                  all(is_fusible(a) for a in arg.args))
+        return visit(arg, inline)
+
+    return visit(root, True), inputs
+
+
+def evaluate_fused(expr, inputs, exact=False):
+    """计算 fusion 表达式，inputs 是 TimeSeries
+
+    :param exact: 为 True 时结果和逐个运算不同的表达式（见 fusion.is_exact）不计算，返回 None
+    """
+    arrays = fit_series(*[(series.evaluate() if isinstance(series, ExprSeries) else series).series
+                          for series in inputs])
+    if exact and not fusion.is_exact(expr, arrays):
+        return None
+    result = fusion.evaluate(expr, arrays)
+    return BoolSeries(result) if result.dtype == np.bool_ else NumericSeries(result)
+
+
+def fused(func):
+    """非惰性模式下也先构建表达式再计算，让 func 中连续的逐元素运算合并计算，返回的仍然是算好的序列
+
+    用于 KDJ、DMI 这类算术运算很多的指标。表达式和股票、日期无关，按参数缓存，之后的调用只需要计算。
+    缓存中只保留表达式，每次调用之后清掉节点上算好的序列。
+    惰性模式下或者关闭 fusion 时直接调用 func。
+    """
+    # 参数 -> (表达式, 表达式中的 ExprSeries 节点)
+    exprs = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if ExecutionContext.is_lazy() or not ExecutionContext.is_fusion():
+            return func(*args, **kwargs)
+        key = args + tuple(sorted(kwargs.items()))
+        try:
+            entry = exprs.get(key)
+        except TypeError:
+            key = entry = None
+        if entry is None:
+            with ExecutionContext.lazy():
+                result = func(*args, **kwargs)
+            entry = (result, get_expr_nodes(result if isinstance(result, tuple) else (result, )))
+            if key is not None:
+                if len(exprs) >= MEMO_MAXSIZE:
+                    exprs.clear()
+                exprs[key] = entry
+        result, nodes = entry
+        try:
+            if isinstance(result, tuple):
+                return tuple(series.evaluate() if isinstance(series, ExprSeries) else series for series in result)
+            return result.evaluate() if isinstance(result, ExprSeries) else result
+        finally:
+            for node in nodes:
+                node._result = node._stamp = None
+    return wrapper
+
+
+def get_expr_nodes(roots):
+    """roots 和它们下面的所有 ExprSeries 节点"""
+    nodes = {}
+    stack = [root for root in roots if isinstance(root, ExprSeries)]
+    while stack:
+        node = stack.pop()
+        if id(node) not in nodes:
+            nodes[id(node)] = node
+            stack.extend(arg for arg in node.args if isinstance(arg, ExprSeries))
+    return list(nodes.values())
+
+
+# ExprSeries.func -> (fusion 的运算符, 是否交换参数)
+FUSED_OPS = {}
+
+# 惰性模式下运算符只构建表达式
+for _name, _result_type, _op in [
+        ("__lt__", BoolSeries, "<"), ("__gt__", BoolSeries, ">"), ("__eq__", BoolSeries, "="),
+        ("__ne__", BoolSeries, "<>"), ("__ge__", BoolSeries, ">="), ("__le__", BoolSeries, "<="),
+        ("__and__", BoolSeries, "AND"), ("__or__", BoolSeries, "OR"), ("__invert__", BoolSeries, "NOT"),
+        ("__sub__", NumericSeries, "-"), ("__rsub__", NumericSeries, "r-"), ("__add__", NumericSeries, "+"),
+        ("__radd__", NumericSeries, "r+"), ("__mul__", NumericSeries, "*"), ("__rmul__", NumericSeries, "r*"),
+        ("__truediv__", NumericSeries, "/"), ("__rtruediv__", NumericSeries, "r/")]:
+    FUSED_OPS[TimeSeries.__dict__[_name]] = (_op.lstrip("r"), _op.startswith("r"))
+    setattr(TimeSeries, _name, lazy_operator(_result_type)(TimeSeries.__dict__[_name]))
+TimeSeries.__div__ = TimeSeries.__truediv__
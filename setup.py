@@ -28,6 +28,17 @@ setup(
     license='Apache License v2',
     package_data={'': ['*.*']},
     install_requires=[str(ir.requirement) for ir in parse_requirements("requirements.txt", session=False)],
+    extras_require={
+        "talib": ["TA-Lib"],
+        "scipy": ["scipy"],
+        "numba": ["numba"],
+        "numexpr": ["numexpr"],
+    },
+    entry_points={
+        "console_scripts": [
+            "funcat-build-store = funcat.data.store_builder:main",
+        ],
+    },
     zip_safe=False,
     classifiers=[
         'Programming Language :: Python',
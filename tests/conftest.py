@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+#
+
+import datetime
+
+import numpy as np
+import pytest
+
+from funcat.data.backend import DataBackend
+
+
+ORDER_BOOK_IDS = ("000001.XSHE", "000002.XSHE", "600000.XSHG")
+BAR_DTYPE = [("datetime", "<u8"), ("open", "<f8"), ("high", "<f8"), ("low", "<f8"),
+             ("close", "<f8"), ("volume", "<f8"), ("total_turnover", "<f8")]
+
+
+def get_weekdays(count, start=datetime.date(2015, 1, 5)):
+    dates = []
+    date = start
+    while len(dates) < count:
+        if date.weekday() < 5:
+            dates.append(int(date.strftime("%Y%m%d")))
+        date += datetime.timedelta(days=1)
+    return dates
+
+
+class MemoryDataBackend(DataBackend):
+    """内存中随机生成的日线，不需要网络和数据文件
+
+    000002.XSHE 中间停牌 10 天，600000.XSHG 有不少开盘价等于收盘价的 bar。
+    get_price_calls 记录 get_price 的调用次数。
+    """
+
+    def __init__(self, count=600, seed=0, order_book_ids=ORDER_BOOK_IDS):
+        rng = np.random.RandomState(seed)
+        self.dates = get_weekdays(count)
+        self.data = {}
+        self.get_price_calls = 0
+        for order_book_id in order_book_ids:
+            close = 10 + np.cumsum(rng.randn(count) * 0.2)
+            open_ = close + rng.randn(count) * 0.1
+            if order_book_id == "600000.XSHG":
+                close = np.round(close, 1)
+                open_ = np.round(open_, 1)
+            bars = np.zeros(count, dtype=BAR_DTYPE)
+            bars["datetime"] = np.array(self.dates, dtype=np.uint64) * 1000000
+            bars["open"] = open_
+            bars["close"] = close
+            bars["high"] = np.maximum(open_, close) + rng.rand(count) * 0.2
+            bars["low"] = np.minimum(open_, close) - rng.rand(count) * 0.2
+            bars["volume"] = rng.rand(count) * 1e6
+            bars["total_turnover"] = bars["volume"] * close
+            if order_book_id == "000002.XSHE":
+                bars = np.delete(bars, np.arange(100, 110))
+            self.data[order_book_id] = bars.view(np.recarray)
+
+    def get_price(self, order_book_id, start, end, freq):
+        self.get_price_calls += 1
+        bars = self.data[order_book_id]
+        dates = bars["datetime"] // 1000000
+        return bars[(dates >= start) & (dates <= end)]
+
+    def get_order_book_id_list(self):
+        return sorted(self.data)
+
+    def get_trading_dates(self, start, end):
+        return [date for date in self.dates if start <= date <= end]
+
+    def symbol(self, order_book_id):
+        return order_book_id
+
+
+@pytest.fixture
+def data_backend():
+    return MemoryDataBackend()
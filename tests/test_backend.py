@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+
+from funcat.api import CLOSE
+from funcat.context import ExecutionContext
+from funcat.data.backend import DataBackendWrapper
+from funcat.data.prefetching_backend import PrefetchingBackend
+from funcat.helper import select
+from funcat.time_series import bar_cache
+
+
+def test_availability(data_backend):
+    dates = data_backend.get_trading_calendar().dates
+    availability = data_backend.get_availability("000002.XSHE")
+    assert len(availability) == len(dates)
+    assert availability.sum() == len(dates) - 10
+    assert not availability[100:110].any()
+
+
+def test_availability_follows_bars(data_backend):
+    # 传入的 bars 换了对象（例如 bar_cache 重新加载过）时重新计算
+    bars = data_backend.get_price("000001.XSHE", 0, data_backend.dates[-2], "1d")
+    assert not data_backend.get_availability("000001.XSHE", bars=bars)[-1]
+    assert not data_backend.get_availability("000001.XSHE", bars=bars)[-1]
+    bars = data_backend.get_price("000001.XSHE", 0, data_backend.dates[-1], "1d")
+    assert data_backend.get_availability("000001.XSHE", bars=bars)[-1]
+
+
+def test_availability_ttl(data_backend, monkeypatch):
+    # 包含今天的结果超过 availability_ttl 秒后重新计算
+    calls = []
+    get_price = data_backend.get_price
+    monkeypatch.setattr(data_backend, "get_price", lambda *args: calls.append(args) or get_price(*args))
+    data_backend.get_availability("000001.XSHE")
+    data_backend.get_availability("000001.XSHE")
+    assert len(calls) == 1
+
+    monkeypatch.setattr("funcat.data.backend.get_today", lambda: data_backend.dates[-1])
+    data_backend.get_availability("000001.XSHE")
+    assert len(calls) == 1
+    data_backend.availability_ttl = 0
+    monkeypatch.setattr("funcat.data.backend.time.monotonic", lambda: 1e12)
+    data_backend.get_availability("000001.XSHE")
+    assert len(calls) == 2
+
+
+def test_select_after_clear(data_backend):
+    # 第一次 select 时还没有最后一天的行情，清空 bar_cache 之后能选出来
+    bars = data_backend.data["000001.XSHE"]
+    data_backend.data["000001.XSHE"] = bars[:-1]
+    date = data_backend.dates[-1]
+    selected = []
+    try:
+        with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0]):
+            select(lambda: CLOSE > 0, start_date=date, end_date=date, callback=lambda *args: selected.append(args))
+            assert [order_book_id for _, order_book_id, _ in selected] == ["000002.XSHE", "600000.XSHG"]
+
+            data_backend.data["000001.XSHE"] = bars
+            bar_cache.clear()
+            del selected[:]
+            select(lambda: CLOSE > 0, start_date=date, end_date=date, callback=lambda *args: selected.append(args))
+            assert [order_book_id for _, order_book_id, _ in selected] == ["000001.XSHE", "000002.XSHE", "600000.XSHG"]
+    finally:
+        bar_cache.clear()
+
+
+def test_wrapper_availability(data_backend):
+    # 包装之后仍然使用被包装的 backend 设置的结果
+    availability = np.zeros(len(data_backend.get_trading_calendar()), dtype=bool)
+    data_backend.set_availability("000001.XSHE", availability)
+    wrapper = DataBackendWrapper(data_backend)
+    assert wrapper.get_availability("000001.XSHE") is availability
+    assert PrefetchingBackend(data_backend).get_availability("000001.XSHE") is availability
+
+
+def test_calendar_refresh(data_backend, monkeypatch):
+    # 过了一天之后日历包含新的交易日
+    monkeypatch.setattr("funcat.data.backend.get_today", lambda: data_backend.dates[-10])
+    assert data_backend.get_trading_calendar().dates[-1] == data_backend.dates[-10]
+    calendar = data_backend.get_trading_calendar(end=data_backend.dates[-20])
+    assert data_backend.get_trading_calendar() is calendar
+
+    monkeypatch.setattr("funcat.data.backend.get_today", lambda: data_backend.dates[-1])
+    assert data_backend.get_trading_calendar().dates[-1] == data_backend.dates[-1]
+
+
+def test_calendar_start_date(data_backend):
+    # 日历从 calendar_start_date 和 ExecutionContext 的 start_date 中较早的一天开始
+    data_backend.calendar_start_date = data_backend.dates[100]
+    assert data_backend.get_trading_calendar().dates[0] == data_backend.dates[100]
+    with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0]):
+        assert ExecutionContext.get_trading_calendar().dates[0] == data_backend.dates[0]
+
+        selected = []
+        dates = data_backend.dates[50:53]
+        select(lambda: CLOSE > 0, start_date=dates[0], end_date=dates[-1], callback=lambda *args: selected.append(args))
+    bar_cache.clear()
+    assert sorted(set(date for date, _, _ in selected)) == dates
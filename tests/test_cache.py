@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+#
+
+import pytest
+
+from funcat.data import cache as cache_module
+from funcat.data.cache import BarCache, slice_bars, get_datetime_int, get_load_end
+
+
+@pytest.fixture
+def today(monkeypatch, data_backend):
+    # 把最后一个交易日当作今天
+    monkeypatch.setattr(cache_module, "get_today", lambda: data_backend.dates[-1])
+    return data_backend.dates[-1]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_get_datetime_int():
+    assert get_datetime_int(20160104) == 20160104000000
+    assert get_datetime_int(20160104, end=True) == 20160104235959
+    assert get_datetime_int(20160104093100) == 20160104093100
+
+
+def test_slice_bars(data_backend):
+    bars = data_backend.data["000002.XSHE"]
+    dates = data_backend.dates
+    sliced = slice_bars(bars, dates[95], dates[115])
+    assert len(sliced) == 21 - 10
+    assert sliced.base is bars.base or sliced.base is bars
+    assert len(slice_bars(bars, end=dates[0])) == 1
+    assert len(slice_bars(bars, start=dates[-1] + 1)) == 0
+    assert len(slice_bars(bars[:0], dates[0], dates[-1])) == 0
+
+
+def test_hits_and_misses(data_backend, today):
+    cache = BarCache()
+    dates = data_backend.dates
+    bars = cache.get_bars(data_backend, "000001.XSHE", dates[0], dates[100], "1d")
+    assert len(bars) == 101
+    # 加载到今天为止，之后换日期只截取
+    assert cache.get_bars(data_backend, "000001.XSHE", dates[0], dates[-1], "1d")[-1]["close"] == \
+        data_backend.data["000001.XSHE"][-1]["close"]
+    assert len(cache.get_bars(data_backend, "000001.XSHE", dates[0], dates[50], "1d")) == 51
+    assert data_backend.get_price_calls == 1
+    info = cache.cache_info()
+    assert (info.hits, info.misses, info.currsize) == (2, 1, 1)
+    assert info.currbytes == data_backend.data["000001.XSHE"].nbytes
+
+    # start 和频率不同是不同的条目，不存在的股票缓存空结果
+    cache.get_bars(data_backend, "000001.XSHE", dates[10], dates[100], "1d")
+    assert len(cache.get_bars(data_backend, "000009.XSHE", dates[0], dates[100], "1d")) == 0
+    cache.get_bars(data_backend, "000009.XSHE", dates[0], dates[100], "1d")
+    assert data_backend.get_price_calls == 3
+    assert cache.cache_info().currsize == 3
+
+
+def test_readonly(data_backend, today):
+    bars = BarCache().get_history(data_backend, "000001.XSHE", data_backend.dates[0], today, "1d")
+    with pytest.raises(ValueError):
+        bars["close"][0] = 0
+
+
+def test_ttl(data_backend, today, clock):
+    # 加载到今天的条目超过 ttl 后重新加载
+    cache = BarCache(ttl=60)
+    dates = data_backend.dates
+    cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+    clock[0] += 59
+    cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+    assert data_backend.get_price_calls == 1
+    clock[0] += 2
+    cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+    assert data_backend.get_price_calls == 2
+
+    # ttl 为 None 时不过期
+    cache = BarCache(ttl=None)
+    cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+    clock[0] += 1e6
+    cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+    assert data_backend.get_price_calls == 3
+
+
+def test_ttl_history(data_backend, today, clock):
+    # 没有加载到今天的历史条目不会过期
+    cache = BarCache(ttl=60)
+    dates = data_backend.dates
+    cache.put(("key", ), dates[-2], data_backend.data["000001.XSHE"])
+    clock[0] += 1e6
+    assert cache.get(("key", ), dates[-3]) is not None
+    # 不覆盖需要的截止日期
+    assert cache.get(("key", ), dates[-1]) is None
+
+
+def test_refresh(data_backend, today):
+    cache = BarCache()
+    dates = data_backend.dates
+    for order_book_id in ("000001.XSHE", "000002.XSHE"):
+        cache.get_history(data_backend, order_book_id, dates[0], today, "1d")
+    cache.put(("history", ), dates[-2], data_backend.data["600000.XSHG"])
+
+    cache.refresh("000001.XSHE")
+    assert cache.cache_info().currsize == 2
+    cache.refresh()
+    assert cache.cache_info().currsize == 1
+    assert cache.cache_info().currbytes == data_backend.data["600000.XSHG"].nbytes
+    cache.clear()
+    assert cache.cache_info() == (0, 0, 8192, 0, None, 0)
+
+
+def test_eviction(data_backend, today):
+    dates = data_backend.dates
+    nbytes = data_backend.data["000001.XSHE"].nbytes
+    for cache in (BarCache(maxsize=2), BarCache(maxbytes=nbytes * 2)):
+        cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+        cache.get_history(data_backend, "600000.XSHG", dates[0], today, "1d")
+        # 最近用过的留下
+        cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+        cache.get_history(data_backend, "000002.XSHE", dates[0], today, "1d")
+        assert cache.cache_info().currsize == 2
+        assert cache.cache_info().currbytes <= nbytes * 2
+        calls = data_backend.get_price_calls
+        cache.get_history(data_backend, "000001.XSHE", dates[0], today, "1d")
+        assert data_backend.get_price_calls == calls
+        cache.get_history(data_backend, "600000.XSHG", dates[0], today, "1d")
+        assert data_backend.get_price_calls == calls + 1
+
+
+def test_prefetch(data_backend, today):
+    cache = BarCache()
+    dates = data_backend.dates
+    order_book_ids = ["000001.XSHE", "000002.XSHE", "600000.XSHG", "000009.XSHE"]
+    count, nbytes = cache.prefetch(data_backend, order_book_ids, dates[0], dates[-1], "1d", chunk_size=2)
+    assert count == 4
+    assert nbytes == sum(bars.nbytes for bars in data_backend.data.values())
+    assert data_backend.get_price_calls == 4
+
+    # 已经缓存的不再加载
+    assert cache.prefetch(data_backend, order_book_ids, dates[0], dates[-1], "1d") == (0, 0)
+    for order_book_id in order_book_ids:
+        cache.get_history(data_backend, order_book_id, dates[0], dates[-1], "1d")
+    assert data_backend.get_price_calls == 4
+    assert len(cache.get_history(data_backend, "000009.XSHE", dates[0], dates[-1], "1d")) == 0
+
+
+def test_load_end(today):
+    assert get_load_end(20150101) == today
+    assert get_load_end(99990101093000) == 99990101
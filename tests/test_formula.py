@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from funcat import formula as formula_module
+from funcat.api import CLOSE, OPEN, HIGH, LOW, EMA, MA, CROSS, HHV, LLV, SMA
+from funcat.context import ExecutionContext
+from funcat.formula import compile_formula, Compiler, Formula, get_arity, tokenize
+from funcat.utils import FormulaException
+
+
+MACD = "DIF := EMA(C, 12) - EMA(C, 26); DEA := EMA(DIF, 9); MACD: (DIF - DEA) * 2; CROSS(DIF, DEA);"
+
+
+@pytest.fixture
+def context(data_backend):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id="000001.XSHE", data_backend=data_backend):
+        yield
+
+
+@pytest.fixture
+def formula_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv(formula_module.FORMULA_CACHE_ENV, str(tmp_path))
+    monkeypatch.setattr(formula_module, "_formulas", {})
+    return tmp_path
+
+
+def get_array(series):
+    return np.asarray(series.series, dtype=np.float64)
+
+
+def test_tokenize():
+    tokens = tokenize("a:=c>=1.5e1 {注释} && not(b) // 注释")
+    assert [(kind, value) for kind, value, _ in tokens] == [
+        ("name", "A"), ("op", ":="), ("name", "C"), ("op", ">="), ("number", 15.0), ("op", "AND"),
+        ("op", "NOT"), ("op", "("), ("name", "B"), ("op", ")"), ("end", None)]
+
+
+def test_compile_plan():
+    plan = Compiler(MACD).compile()
+    assert [name for name, _ in plan["outputs"]] == ["MACD", "OUT2"]
+    # C 和 EMA(C, ...) 各只有一步，DIF 被引用多次单独成为一步
+    ops = [(step["op"], step.get("name")) for step in plan["steps"]]
+    assert ops.count(("data", "C")) == 1
+    assert ops.count(("call", "EMA")) == 3
+    assert ops.count(("call", "CROSS")) == 1
+    # 能保存成 json
+    assert json.loads(json.dumps(plan)) == plan
+
+
+def test_compile_constants():
+    plan = Compiler("C > 10 / 4 + 2 * 3").compile()
+    fused = [step for step in plan["steps"] if step["op"] == "fused"]
+    assert fused[0]["expr"] == [">", ["input", 0], ["const", 8.5]]
+
+    plan = Compiler("X := 1 + 1; X * 2").compile()
+    assert plan["outputs"] == [["OUT1", ["const", 4]]]
+
+
+@pytest.mark.parametrize("source, message", [
+    ("MA(C)", "MA takes 2 arguments, got 1 at line 1, column 1"),
+    ("X := C;\n  CROSS(X, 1, 2)", "CROSS takes 2 arguments, got 3 at line 2, column 3"),
+    ("FOO(C)", "unknown function FOO at line 1, column 1"),
+    ("C + BAR", "unknown name BAR at line 1, column 5"),
+    ("C(1)", "C is not a function at line 1, column 1"),
+    ("MA + 1", "MA requires arguments at line 1, column 1"),
+    ("C + ", "unexpected token, found end of formula at line 1, column 5"),
+    ("C $ 1", "unexpected character '$' at line 1, column 3"),
+    ("", "empty formula"),
+])
+def test_compile_errors(source, message):
+    with pytest.raises(FormulaException) as excinfo:
+        compile_formula(source)
+    assert str(excinfo.value) == message
+
+
+def test_arity():
+    assert get_arity(MA) == (2, 2)
+    assert get_arity(SMA) == (3, 3)
+    assert get_arity(CROSS) == (2, 2)
+    assert get_arity(lambda a, b=1, *args: None) == (1, None)
+
+
+def test_invalid_arguments_lookback():
+    # 应该是常数的参数是序列时推断不了 lookback，不影响编译
+    assert compile_formula("SMA(C, C, 1)").lookback is None
+    assert compile_formula("MA(C, 5)").lookback == 5
+
+
+def test_outputs(context):
+    outputs = compile_formula(MACD).outputs()
+    assert list(outputs) == ["MACD", "OUT2"]
+    dif = EMA(CLOSE, 12) - EMA(CLOSE, 26)
+    dea = EMA(dif, 9)
+    assert np.allclose(get_array(outputs["MACD"]), get_array((dif - dea) * 2), equal_nan=True)
+    assert np.array_equal(get_array(outputs["OUT2"]), get_array(CROSS(dif, dea)))
+    assert bool(compile_formula(MACD)()) == bool(CROSS(dif, dea))
+
+
+def test_formula_matches_api(context):
+    source = "RSV := (C - LLV(L, 9)) / (HHV(H, 9) - LLV(L, 9)) * 100; K: SMA(RSV, 3, 1); C > O AND K > MA(K, 5)"
+    outputs = compile_formula(source).outputs()
+    rsv = (CLOSE - LLV(LOW, 9)) / (HHV(HIGH, 9) - LLV(LOW, 9)) * 100
+    k = SMA(rsv, 3, 1)
+    assert np.allclose(get_array(outputs["K"]), get_array(k), equal_nan=True)
+    expected = (CLOSE > OPEN) & (k > MA(k, 5))
+    assert np.array_equal(get_array(outputs["OUT2"]), get_array(expected))
+
+
+def test_formula_cache(formula_cache, context, monkeypatch):
+    formula = compile_formula(MACD)
+    assert compile_formula(MACD) is formula
+    paths = os.listdir(str(formula_cache))
+    assert len(paths) == 1 and paths[0].endswith(".json")
+
+    # 内存中的缓存清空后从磁盘加载，不再解析
+    monkeypatch.setattr(formula_module, "_formulas", {})
+    monkeypatch.setattr(formula_module, "Compiler", None)
+    loaded = compile_formula(MACD)
+    assert loaded is not formula
+    assert loaded.steps == formula.steps
+    assert np.array_equal(get_array(loaded()), get_array(formula()))
+
+
+@pytest.mark.parametrize("change", [
+    lambda plan: plan.update(version=0),
+    lambda plan: plan.update(source="C"),
+    lambda plan: plan["steps"][0].update(name="S"),
+    lambda plan: plan["steps"].reverse(),
+    lambda plan: plan.clear(),
+])
+def test_formula_cache_invalid(formula_cache, context, monkeypatch, change):
+    # 磁盘上的计划过期或者损坏时重新编译
+    formula = compile_formula(MACD)
+    path = os.path.join(str(formula_cache), os.listdir(str(formula_cache))[0])
+    with open(path) as f:
+        plan = json.load(f)
+    change(plan)
+    with open(path, "w") as f:
+        json.dump(plan, f)
+
+    monkeypatch.setattr(formula_module, "_formulas", {})
+    loaded = compile_formula(MACD)
+    assert loaded.steps == formula.steps
+    with open(path) as f:
+        assert json.load(f) == Compiler(MACD).compile()
+
+
+def test_formula_cache_corrupt(formula_cache):
+    formula = compile_formula(MACD)
+    path = os.path.join(str(formula_cache), os.listdir(str(formula_cache))[0])
+    with open(path, "w") as f:
+        f.write("{")
+    formula_module._formulas.clear()
+    assert compile_formula(MACD).steps == formula.steps
+
+
+def test_formula_select(data_backend):
+    from funcat.helper import select
+    from funcat.time_series import bar_cache
+
+    selected = []
+    dates = data_backend.dates[-5:]
+    try:
+        with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0]):
+            select(compile_formula("C > O"), start_date=dates[0], end_date=dates[-1],
+                   callback=lambda *args: selected.append(args))
+    finally:
+        bar_cache.clear()
+    for date, order_book_id, _ in selected:
+        bars = data_backend.data[order_book_id]
+        bar = bars[bars["datetime"] // 1000000 == date][0]
+        assert bar["close"] > bar["open"]
+    assert selected
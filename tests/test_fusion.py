@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+#
+
+import gc
+
+import numpy as np
+import pytest
+
+from funcat import indicators, fusion
+from funcat.api import CLOSE, OPEN, HIGH, LOW, VOLUME, MA, REF
+from funcat.context import ExecutionContext
+from funcat.time_series import ExprSeries
+from funcat.utils import FormulaException
+
+
+FUSED_INDICATORS = ["KDJ", "DMI", "RSI", "WR", "BIAS", "ASI", "ARBR", "TRIX", "DKX"]
+ORDER_BOOK_IDS = ["000001.XSHE", "000002.XSHE", "600000.XSHG"]
+
+
+def get_arrays(result):
+    if not isinstance(result, tuple):
+        result = (result, )
+    return [np.asarray(series.series) for series in result]
+
+
+def run(data_backend, func, order_book_id="000001.XSHE", date=None, **kwargs):
+    date = date or data_backend.dates[-1]
+    with ExecutionContext(date=date, order_book_id=order_book_id, data_backend=data_backend, **kwargs):
+        return get_arrays(func())
+
+
+def assert_identical(result, expected):
+    assert len(result) == len(expected)
+    for x, y in zip(result, expected):
+        assert x.dtype == y.dtype
+        assert np.array_equal(x, y, equal_nan=True)
+
+
+@pytest.mark.parametrize("order_book_id", ORDER_BOOK_IDS)
+@pytest.mark.parametrize("name", FUSED_INDICATORS)
+def test_fused_indicator(data_backend, name, order_book_id):
+    func = getattr(indicators, name)
+    expected = run(data_backend, func, order_book_id, fusion=False)
+    assert_identical(run(data_backend, func, order_book_id), expected)
+    assert_identical(run(data_backend, func, order_book_id, lazy=True), expected)
+
+
+def test_fused_indicator_dates(data_backend):
+    # 缓存的表达式换日期、股票之后重新计算
+    for date in (data_backend.dates[80], data_backend.dates[300], data_backend.dates[-1]):
+        for order_book_id in ORDER_BOOK_IDS:
+            expected = run(data_backend, indicators.KDJ, order_book_id, date, fusion=False)
+            assert_identical(run(data_backend, indicators.KDJ, order_book_id, date), expected)
+
+
+def test_fused_results_released(data_backend):
+    run(data_backend, indicators.KDJ)
+    run(data_backend, indicators.DMI)
+    gc.collect()
+    assert not [obj for obj in gc.get_objects() if isinstance(obj, ExprSeries) and obj._result is not None]
+
+
+OPERATOR_CASES = [
+    lambda: (CLOSE - OPEN) / (HIGH - LOW) * 100 > 50,
+    lambda: 1 - (CLOSE - OPEN) / (HIGH - LOW) * 2 + (CLOSE > REF(CLOSE, 1)) * 3,
+    lambda: 5 / CLOSE - CLOSE / 0 + (0 - CLOSE),
+    lambda: ((CLOSE > OPEN) & (HIGH - LOW > 0.1)) | ~(VOLUME > MA(VOLUME, 5)),
+    lambda: (CLOSE > OPEN) * 2 + CLOSE,
+    lambda: (CLOSE > OPEN) / (CLOSE < OPEN),
+    # numpy 中两个逻辑值相加、相乘是逻辑或、逻辑与
+    lambda: (CLOSE > OPEN) * (HIGH > REF(HIGH, 1)),
+    lambda: (CLOSE > OPEN) + (HIGH > REF(HIGH, 1)),
+    lambda: ((CLOSE > OPEN) & (CLOSE > 10)) * 1.0 + CLOSE,
+]
+
+INVALID_OPERATOR_CASES = [
+    lambda: (CLOSE > OPEN) - (HIGH > REF(HIGH, 1)),
+    lambda: ~(CLOSE + 1),
+    lambda: (CLOSE + 1) & (OPEN * 2),
+    lambda: (CLOSE > OPEN) | (OPEN * 2),
+]
+
+
+@pytest.mark.parametrize("case", range(len(OPERATOR_CASES)))
+def test_fused_operators(data_backend, case):
+    def evaluate():
+        with ExecutionContext.lazy():
+            result = OPERATOR_CASES[case]()
+        return result.evaluate()
+
+    expected = run(data_backend, OPERATOR_CASES[case], fusion=False)
+    assert_identical(run(data_backend, evaluate), expected)
+
+
+@pytest.mark.parametrize("case", range(len(INVALID_OPERATOR_CASES)))
+def test_fused_invalid_operators(data_backend, case):
+    def evaluate():
+        with ExecutionContext.lazy():
+            result = INVALID_OPERATOR_CASES[case]()
+        return result.evaluate()
+
+    with pytest.raises(TypeError):
+        run(data_backend, INVALID_OPERATOR_CASES[case], fusion=False)
+    with pytest.raises(TypeError):
+        run(data_backend, evaluate)
+
+
+def test_is_exact():
+    arrays = [np.zeros(3), np.zeros(3, dtype=bool), np.zeros(3, dtype=bool)]
+    assert fusion.is_exact(("+", ("input", 0), ("input", 1)), arrays)
+    assert fusion.is_exact(("AND", ("input", 1), ("NOT", ("input", 2))), arrays)
+    assert fusion.is_exact(("/", ("input", 1), ("input", 2)), arrays)
+    assert not fusion.is_exact(("*", ("input", 1), ("input", 2)), arrays)
+    assert not fusion.is_exact(("NEG", ("input", 1)), arrays)
+    assert not fusion.is_exact(("+", ("input", 1), ("const", True)), arrays)
+    assert not fusion.is_exact(("OR", ("input", 1), ("input", 0)), arrays)
+    assert not fusion.is_exact((">", ("NOT", ("input", 0)), ("const", 1)), arrays)
+
+
+def test_formula_semantics():
+    # 不经过 is_exact，逻辑值按 1 和 0 计算，非 0 数值为真
+    arrays = [np.array([0.0, 2.0, np.nan]), np.array([True, True, False])]
+    result = fusion.evaluate(("+", ("input", 1), ("input", 1)), arrays)
+    assert result.tolist() == [2.0, 2.0, 0.0]
+    result = fusion.evaluate(("AND", ("input", 0), ("NOT", ("input", 1))), arrays)
+    assert result.tolist() == [False, False, True]
+
+
+@pytest.mark.parametrize("expr", [
+    ("SQRT", ("input", 0)),
+    ("+", ("input", 0)),
+    ("NEG", ("input", 0), ("input", 0)),
+    ("input", 2),
+    ("input", -1),
+    ("input", 1.0),
+    ("input", 0, 1),
+    ("const", "1"),
+    ("const", None),
+    ("+", ("input", 0), ("const", [1])),
+    ("AND", ("input", 0), ("unknown", 1)),
+])
+def test_check_expr_rejects(expr):
+    with pytest.raises(FormulaException):
+        fusion.check_expr(expr, 2)
+
+
+def test_check_expr():
+    expr = ["*", ["-", ["input", 0], ["const", 1]], ["NOT", ["input", 1]]]
+    assert fusion.check_expr(expr, 2) == ("*", ("-", ("input", 0), ("const", 1)), ("NOT", ("input", 1)))
+
+
+def get_rsv():
+    return ("*", ("/", ("-", ("input", 0), ("input", 1)), ("-", ("input", 2), ("input", 1))), ("const", 100))
+
+
+def test_compile_program_reuses_temps():
+    program, dtypes, result = fusion.compile_program(get_rsv())
+    assert len(program) == 4
+    assert dtypes == [np.float64, np.float64]
+
+    expr = ("input", 0)
+    for i in range(1, 8):
+        expr = ("+", expr, ("input", i))
+    program, dtypes, result = fusion.compile_program(expr)
+    assert len(program) == 7
+    assert dtypes == [np.float64]
+
+    expr = ("AND", (">", ("input", 0), ("input", 1)), ("<", ("+", ("input", 0), ("input", 1)), ("const", 1)))
+    program, dtypes, result = fusion.compile_program(expr)
+    assert dtypes == [np.bool_, np.float64, np.bool_]
+    assert dtypes[result] is np.bool_
+
+
+def test_fuse_numpy():
+    rng = np.random.RandomState(0)
+    close = 10 + np.cumsum(rng.randn(100) * 0.1)
+    close[[10, 50]] = np.nan
+    low, high = close - rng.rand(100), close + rng.rand(100)
+    high[20] = low[20]
+    with np.errstate(all="ignore"):
+        expected = (close - low) / (high - low) * 100
+        result = fusion.fuse_numpy(get_rsv(), [close, low, high])
+    assert np.array_equal(result, expected, equal_nan=True)
+
+    expr = ("OR", (">", ("input", 0), ("const", 10)), ("NOT", ("input", 1)))
+    flags = close < high - 0.5
+    with np.errstate(invalid="ignore"):
+        expected = (close > 10) | ~flags
+    assert np.array_equal(fusion.fuse_numpy(expr, [close, flags]), expected)
+
+
+def test_numexpr_code():
+    constants = {}
+    code = fusion.get_numexpr_code(get_rsv(), [np.zeros(3)] * 3, constants)
+    assert code == "(((x0 - x1) / (x2 - x1)) * 100.0)"
+    assert constants == {}
+
+    arrays = [np.zeros(3), np.zeros(3, dtype=bool)]
+    expr = ("AND", ("input", 1), ("<>", ("NEG", ("input", 0)), ("const", float("inf"))))
+    code = fusion.get_numexpr_code(expr, arrays, constants)
+    assert code == "(x1 & ((-x0) != k0))"
+    assert constants == {"k0": np.inf}
+
+    constants = {}
+    expr = ("+", ("input", 1), ("OR", ("input", 0), ("NOT", ("const", True))))
+    code = fusion.get_numexpr_code(expr, arrays, constants)
+    assert code == "(where(x1, 1.0, 0.0) + where(((x0 != 0) | (~True)), 1.0, 0.0))"
+
+    constants = {}
+    expr = ("=", ("input", 0), ("const", float("nan")))
+    assert fusion.get_numexpr_code(expr, arrays, constants) == "(x0 == k0)"
+    assert np.isnan(constants["k0"])
+
+
+def test_fuse_numexpr():
+    pytest.importorskip("numexpr")
+    rng = np.random.RandomState(0)
+    arrays = [rng.randn(1000), rng.randn(1000), rng.randn(1000) + 3, rng.rand(1000) > 0.5]
+    arrays[0][[3, 7]] = np.nan
+    exprs = [
+        get_rsv(),
+        ("AND", ("input", 3), (">", ("NEG", ("input", 0)), ("const", float("-inf")))),
+        ("+", ("input", 3), ("*", ("OR", ("input", 0), ("NOT", ("input", 3))), ("const", 2))),
+        ("/", ("input", 3), ("-", ("input", 1), ("input", 1))),
+    ]
+    for expr in exprs:
+        with np.errstate(all="ignore"):
+            expected = fusion.fuse_numpy(expr, arrays)
+            result = fusion.fuse_numexpr(expr, arrays)
+        assert result.dtype == expected.dtype
+        assert np.allclose(result, expected, rtol=1e-12, atol=0, equal_nan=True)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+
+import pytest
+
+from funcat.api import CLOSE, OPEN
+from funcat.context import ExecutionContext
+from funcat.data.cache import BarCache
+from funcat.data.prefetching_backend import PrefetchingBackend
+from funcat.helper import select
+from funcat.time_series import bar_cache
+
+from conftest import MemoryDataBackend
+
+
+ORDER_BOOK_IDS = ["{:06d}.XSHE".format(i) for i in range(1, 44)]
+
+
+@pytest.fixture
+def small_cache(monkeypatch):
+    monkeypatch.setattr(bar_cache, "maxsize", 30)
+    bar_cache.clear()
+    yield bar_cache
+    bar_cache.clear()
+
+
+def run_select(data_backend, func, start_date, end_date, **kwargs):
+    selected = []
+    with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0]):
+        select(func, start_date=start_date, end_date=end_date, callback=lambda *args: selected.append(args),
+               **kwargs)
+    return selected
+
+
+def test_select_loads_each_security_once(small_cache):
+    # 股票比缓存能放下的多，每只股票的历史也只加载一次
+    data_backend = MemoryDataBackend(order_book_ids=ORDER_BOOK_IDS)
+    dates = data_backend.dates[-6:]
+    selected = run_select(data_backend, lambda: CLOSE > OPEN, dates[0], dates[-1], prefetch=False)
+    assert data_backend.get_price_calls == len(ORDER_BOOK_IDS)
+
+    # 输出顺序不变：日期从近到远，同一天内按股票顺序
+    expected = []
+    for date in reversed(dates):
+        for order_book_id in ORDER_BOOK_IDS:
+            bars = data_backend.data[order_book_id]
+            bar = bars[bars["datetime"] // 1000000 == date][0]
+            if bar["close"] > bar["open"]:
+                expected.append((date, order_book_id, order_book_id))
+    assert selected == expected
+
+
+@pytest.mark.parametrize("limit", ["maxsize", "maxbytes"])
+def test_select_prefetch_within_budget(small_cache, monkeypatch, limit):
+    # 预加载按缓存放得下的数量分批进行，加载的行情在用到之前不会被挤出去
+    data_backend = MemoryDataBackend(order_book_ids=ORDER_BOOK_IDS)
+    if limit == "maxbytes":
+        monkeypatch.setattr(bar_cache, "maxsize", None)
+        monkeypatch.setattr(bar_cache, "maxbytes", data_backend.data[ORDER_BOOK_IDS[0]].nbytes * 10)
+    dates = data_backend.dates[-6:]
+    selected = run_select(data_backend, lambda: CLOSE > OPEN, dates[0], dates[-1])
+    assert data_backend.get_price_calls == len(ORDER_BOOK_IDS)
+    assert selected == run_select(MemoryDataBackend(order_book_ids=ORDER_BOOK_IDS), lambda: CLOSE > OPEN,
+                                  dates[0], dates[-1], prefetch=False)
+
+
+def test_prefetch_size():
+    cache = BarCache(maxsize=30, maxbytes=1000)
+    assert cache.get_prefetch_size(None, 200) == 15
+    assert cache.get_prefetch_size(100, 200) == 5
+    assert cache.get_prefetch_size(10000, 200) == 1
+    assert BarCache(maxsize=None).get_prefetch_size(100, 200) == 200
+
+
+class ResampleDataBackend(MemoryDataBackend):
+    """只有日线，周线在本地合成，记录每次取行情的频率"""
+
+    local_resample = True
+
+    def __init__(self, *args, **kwargs):
+        super(ResampleDataBackend, self).__init__(*args, **kwargs)
+        self.freqs = []
+
+    def get_price(self, order_book_id, start, end, freq):
+        self.freqs.append(freq)
+        return super(ResampleDataBackend, self).get_price(order_book_id, start, end, freq)
+
+
+def test_select_prefetch_source_freq(small_cache):
+    # 周线由日线合成，预加载的是日线，之后不再逐只加载
+    data_backend = ResampleDataBackend(order_book_ids=ORDER_BOOK_IDS)
+    dates = data_backend.dates[-6:]
+    with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0], freq="1w"):
+        select(lambda: CLOSE > OPEN, start_date=dates[0], end_date=dates[-1], callback=lambda *args: None)
+    assert data_backend.freqs == ["1d"] * len(ORDER_BOOK_IDS)
+
+
+class ClosableDataBackend(MemoryDataBackend):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_select_does_not_close_backend(small_cache):
+    # select 只取消后台的预加载，不关闭用户的 backend，包装之后也一样
+    data_backend = ClosableDataBackend()
+    date = data_backend.dates[-1]
+    run_select(data_backend, lambda: CLOSE > OPEN, date, date)
+    assert not data_backend.closed
+
+    with PrefetchingBackend(data_backend) as prefetching_backend:
+        expected = run_select(prefetching_backend, lambda: CLOSE > OPEN, date, date)
+        assert not data_backend.closed
+        bar_cache.clear()
+        # 没有被关闭，可以继续预加载
+        assert run_select(prefetching_backend, lambda: CLOSE > OPEN, date, date) == expected
+        assert prefetching_backend._executor is not None
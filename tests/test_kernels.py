@@ -0,0 +1,421 @@
+# -*- coding: utf-8 -*-
+#
+
+import json
+import time
+
+import numpy as np
+import pytest
+
+from funcat import kernels
+from funcat.api import CLOSE, OPEN, HIGH, LOW, SMA, COUNT, EVERY, EXIST, LAST, HHV, LLV, HHVBARS
+from funcat.context import ExecutionContext
+from funcat.func import llvbars
+from funcat.indicators import find_zig_peaks, ZIG, BOX_FIND, BOX_DOWN, BOX_UP, BOX_BOX_DOWN, BOX_BOX_UP
+from funcat.kernels import KERNELS, get_kernel, set_kernel
+from funcat.time_series import NumericSeries, BoolSeries
+from funcat.utils import FormulaException
+
+
+def make_series(kind, size=300, seed=0):
+    rng = np.random.RandomState(seed)
+    series = 10 + np.cumsum(rng.normal(0, 0.1, size))
+    if kind == "leading_nan":
+        series[:7] = np.nan
+    elif kind == "nan":
+        series[[40, 41, 150]] = np.nan
+    elif kind == "inf":
+        series[60] = np.inf
+        series[200] = -np.inf
+    elif kind == "ties":
+        series = np.round(series, 1)
+    return series
+
+
+SERIES_KINDS = ["clean", "leading_nan", "nan", "inf", "ties"]
+
+
+def get_kernel_args(name, series):
+    if name == "CCI":
+        return [(series + 0.1, series - 0.1, series, n) for n in (1, 14)]
+    if name == "SMA":
+        return [(np.nan_to_num(series), weight) for weight in (1 / 6, 2 / 3, 1.0)]
+    if name == "COUNT":
+        return [(series > 10, n) for n in (0, 1, 20, len(series))] + [(series, 5)]
+    if name in ("HHV", "LLV"):
+        return [(series, n) for n in (0, 1, 2, 20, len(series))]
+    if name == "STD":
+        return [(series, n) for n in (1, 2, 20)] + [(series, 20, 2.0)]
+    return [(series, n) for n in (1, 2, 20, len(series), len(series) + 1)]
+
+
+@pytest.mark.parametrize("kind", SERIES_KINDS)
+@pytest.mark.parametrize("name,impl", [(name, impl) for name in KERNELS if name != "FUSE"
+                                       for impl in KERNELS[name] if impl != "numpy"])
+def test_kernel_parity(name, impl, kind):
+    series = make_series(kind)
+    for args in get_kernel_args(name, series):
+        with np.errstate(all="ignore"):
+            expected = KERNELS[name]["numpy"](*args)
+            result = KERNELS[name][impl](*args)
+        assert len(result) == len(expected)
+        assert np.allclose(result, expected, rtol=1e-8, atol=1e-8, equal_nan=True), (name, impl, args[1:])
+
+
+def test_window_nan():
+    series = make_series("nan")
+    for name in ("WMA", "STD"):
+        result = KERNELS[name]["numpy"](series, 5)
+        invalid = np.isnan(result)
+        assert invalid[:4].all()
+        assert invalid[40:46].all() and invalid[150:155].all()
+        assert not invalid[46:150].any() and not invalid[155:].any()
+
+
+def old_sma(series, n, m):
+    # TwoArgumentSeries 把 inf 换成 nan，SMA 再把 nan 换成 0、-inf 换成最小的浮点数
+    results = np.nan_to_num(np.where(series == np.inf, np.nan, series))
+    for i in range(1, len(series)):
+        results[i] = (m * results[i] + (n - m) * results[i - 1]) / n
+    return results
+
+
+@pytest.mark.parametrize("kind", SERIES_KINDS)
+def test_sma(kind):
+    series = make_series(kind)
+    for n, m in ((6, 1), (3, 1), (9, 2), (5, 5), (2, 0)):
+        result = SMA(NumericSeries(series), n, m).series
+        with np.errstate(all="ignore"):
+            expected = old_sma(series, n, m)
+        # 原来的循环先算 M * X，X 接近最大的浮点数时会溢出
+        finite = np.isfinite(expected)
+        assert finite.all() or kind == "inf"
+        assert np.isfinite(result).all()
+        assert np.allclose(result[finite], expected[finite], rtol=1e-10, atol=1e-10), (n, m)
+    with pytest.raises(FormulaException):
+        SMA(NumericSeries(series), 3, 4)
+
+
+def get_windows(size, n):
+    """每个窗口在序列中的 [begin, end)，n 为 0 时从第一个开始"""
+    if n == 0:
+        return [(0, end) for end in range(1, size + 1)]
+    return [(end - n, end) for end in range(n, size + 1)]
+
+
+def make_cond(size=100, seed=1):
+    return np.random.RandomState(seed).rand(size) > 0.3
+
+
+@pytest.mark.parametrize("n", [0, 1, 2, 7, 100])
+def test_count_every_exist(n):
+    cond = make_cond()
+    windows = get_windows(len(cond), n)
+    assert COUNT(BoolSeries(cond), n).series.tolist() == [cond[b:e].sum() for b, e in windows]
+    assert EVERY(BoolSeries(cond), n).series.tolist() == [cond[b:e].all() for b, e in windows]
+    assert EXIST(BoolSeries(cond), n).series.tolist() == [cond[b:e].any() for b, e in windows]
+
+
+def test_count_out_of_range():
+    cond = BoolSeries(make_cond())
+    for func in (COUNT, EVERY, EXIST):
+        with pytest.raises(FormulaException):
+            func(cond, 101)
+        with pytest.raises(FormulaException):
+            func(cond, -1)
+
+
+@pytest.mark.parametrize("a,b", [(0, 0), (0, 3), (1, 0), (1, 1), (5, 0), (5, 2), (5, 5), (99, 0)])
+def test_last(a, b):
+    cond = make_cond()
+    cond[:20] = True
+    # LAST(X, A, B)：从前 A 个周期到前 B 个周期 X 一直成立，A 为 0 时从第一个周期开始
+    if a == 0:
+        expected = [cond[:i - b + 1].all() for i in range(b, len(cond))]
+    else:
+        expected = [cond[i - a:i - b + 1].all() for i in range(a, len(cond))]
+    assert LAST(BoolSeries(cond), a, b).series.tolist() == expected
+
+
+def test_last_invalid():
+    cond = BoolSeries(make_cond())
+    with pytest.raises(FormulaException):
+        LAST(cond, 2, 3)
+    with pytest.raises(FormulaException):
+        LAST(cond, 2, -1)
+    with pytest.raises(FormulaException):
+        LAST(cond, 100, 0)
+
+
+def old_extreme(series, n, maximum=True):
+    reduce = np.max if maximum else np.min
+    return np.array([reduce(series[b:e]) for b, e in get_windows(len(series), n)])
+
+
+def old_bars(series, n, maximum=True):
+    result = []
+    for b, e in get_windows(len(series), n):
+        window = series[b:e]
+        if np.isnan(window).any():
+            result.append(np.nan)
+            continue
+        target = window.max() if maximum else window.min()
+        result.append(len(window) - 1 - np.flatnonzero(window == target)[-1])
+    return np.array(result, dtype=np.float64)
+
+
+@pytest.mark.parametrize("kind", SERIES_KINDS)
+@pytest.mark.parametrize("n", [0, 1, 2, 3, 12, 300])
+def test_hhv_llv(kind, n):
+    series = make_series(kind)
+    assert np.array_equal(HHV(NumericSeries(series), n).series, old_extreme(series, n), equal_nan=True)
+    assert np.array_equal(LLV(NumericSeries(series), n).series, old_extreme(series, n, False), equal_nan=True)
+    assert np.array_equal(HHVBARS(NumericSeries(series), n).series, old_bars(series, n), equal_nan=True)
+    assert np.array_equal(llvbars(NumericSeries(series), n).series, old_bars(series, n, False), equal_nan=True)
+
+
+def old_zig_peaks(hhv, llv, N):
+    """ZIG 原来逐周期用 REF 取值的扫描"""
+    def ref(series, i):
+        return series[len(series) - 1 - i]
+
+    count = min(len(hhv), len(llv)) - 1
+    cur_stat = None
+    last_h = ('high', ref(hhv, 0), 0)
+    last_l = ('low', ref(llv, 0), 0)
+    peak_list = []
+
+    def add_first_peaks():
+        if last_h[2] > last_l[2]:
+            chg_ratio = (last_h[1] - last_l[1]) / last_h[1]
+        else:
+            chg_ratio = (last_h[1] - last_l[1]) / last_l[1]
+        if chg_ratio > N / 100:
+            peak_list.extend([last_l, last_h] if last_h[2] > last_l[2] else [last_h, last_l])
+            return True
+        return False
+
+    for i in range(1, count):
+        new_h1, new_h2, new_h3 = ref(hhv, i + 1), ref(hhv, i), ref(hhv, i - 1)
+        new_l1, new_l2, new_l3 = ref(llv, i + 1), ref(llv, i), ref(llv, i - 1)
+        if cur_stat is None:
+            if new_h1 < new_h2 == new_h3 and new_h2 >= last_h[1]:
+                last_h = ('high', new_h2, i)
+                if add_first_peaks():
+                    cur_stat = -1
+            if new_l1 > new_l2 == new_l3 and new_l2 <= last_l[1]:
+                last_l = ('low', new_l2, i)
+                if add_first_peaks():
+                    cur_stat = 1
+        else:
+            if new_h1 < new_h2 == new_h3:
+                flag, last_c, idx = peak_list[-1]
+                if flag == 'high':
+                    if new_h2 > last_c:
+                        peak_list[-1] = ('high', new_h2, i)
+                elif (new_h2 - last_c) / new_h2 > N / 100:
+                    peak_list.append(('high', new_h2, i))
+            if new_l1 > new_l2 == new_l3:
+                flag, last_c, idx = peak_list[-1]
+                if flag == 'low':
+                    if new_l2 < last_c:
+                        peak_list[-1] = ('low', new_l2, i)
+                elif (last_c - new_l2) / new_l2 > N / 100:
+                    peak_list.append(('low', new_l2, i))
+    return peak_list
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_zig_peaks(seed):
+    rng = np.random.RandomState(seed)
+    series = np.round(10 + np.cumsum(rng.normal(0, 0.3, 400)), 1)
+    hhv = old_extreme(series, 12)
+    llv = old_extreme(series, 12, False)
+    for N in (1, 5, 10, 15):
+        assert find_zig_peaks(hhv, llv, N) == old_zig_peaks(hhv, llv, N)
+    assert find_zig_peaks(hhv[:2], llv[:2], 5) == old_zig_peaks(hhv[:2], llv[:2], 5) == []
+
+
+@pytest.mark.parametrize("order_book_id", ["000001.XSHE", "000002.XSHE", "600000.XSHG"])
+def test_zig(data_backend, order_book_id):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id=order_book_id, data_backend=data_backend):
+        for K, series, hhv, llv in ((3, CLOSE, CLOSE, CLOSE), (4, CLOSE, HIGH, LOW), (1, HIGH, HIGH, HIGH)):
+            peaks = old_zig_peaks(HHV(hhv, 12).series, LLV(llv, 12).series, 5)
+            a_series, h_series, l_series, flags = ZIG(K, 5)
+            size = peaks[-1][2] + 1
+            assert len(flags) == size
+            assert np.flatnonzero(flags).tolist() == sorted(size - 1 - i for _, _, i in peaks)
+            assert a_series.series.tolist() == [series.series[-1 - i] for _, _, i in reversed(peaks)]
+            if K == 4:
+                assert h_series.series.tolist() == [HIGH.series[-1 - i] for flag, _, i in reversed(peaks)
+                                                    if flag == "high"]
+                assert l_series.series.tolist() == [LOW.series[-1 - i] for flag, _, i in reversed(peaks)
+                                                    if flag == "low"]
+
+
+def old_find_box(is_candle, start, stop, M):
+    """BOX_* 原来在当前周期往前逐个周期扫描，返回 (begin_i, end_i)，找不到时为 None"""
+    begin_i, end_i = M, 0
+    for i in range(start, stop):
+        if is_candle(i):
+            begin_i = i
+            for j in range(begin_i, stop):
+                if not is_candle(j):
+                    break
+            end_i = j - 1
+            break
+    return (begin_i, end_i) if end_i >= begin_i else None
+
+
+def old_box(c, o, h, l, k, M, up, second=False):
+    def is_candle(i):
+        close, open_, prev_close = c[k - i], o[k - i], c[k - i - 1]
+        if up:
+            return close > open_ or (close == open_ and close > prev_close)
+        return close < open_ or (close == open_ and close <= prev_close)
+
+    def get_range(box):
+        if box is None:
+            return np.nan, np.nan
+        begin_i, end_i = box
+        return h[k - end_i:k - begin_i + 1].max(), l[k - end_i:k - begin_i + 1].min()
+
+    box = old_find_box(is_candle, 1, M, M)
+    result = get_range(box)
+    if second:
+        box2 = old_find_box(is_candle, 1 + box[1], M + box[1], M) if box is not None else None
+        result += get_range(box2)
+    return result
+
+
+def old_box_find(c, o, h, l, k, direction, M):
+    if direction is None:
+        direction = 1 if c[k - 1] > o[k - 1] else -1
+    if direction == 1:
+        box = old_find_box(lambda i: c[k - i] > o[k - i], 1, M, M)
+        first, last = l, h
+    else:
+        box = old_find_box(lambda i: c[k - i] < o[k - i], 1, M, M)
+        first, last = h, l
+    if box is None:
+        return (np.nan, ) * 4
+    begin_i, end_i = box
+    return first[k - end_i], o[k - end_i], c[k - begin_i], last[k - begin_i]
+
+
+@pytest.mark.parametrize("order_book_id", ["000001.XSHE", "000002.XSHE", "600000.XSHG"])
+def test_box(data_backend, order_book_id):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id=order_book_id, data_backend=data_backend):
+        c, o, h, l = CLOSE.series, OPEN.series, HIGH.series, LOW.series
+        for M in (3, 6, 20):
+            results = {
+                "BOX_DOWN": [s.series for s in BOX_DOWN(M)],
+                "BOX_UP": [s.series for s in BOX_UP(M)],
+                "BOX_BOX_DOWN": [s.series for s in BOX_BOX_DOWN(M)],
+                "BOX_BOX_UP": [s.series for s in BOX_BOX_UP(M)],
+                "BOX_FIND": [s.series for s in BOX_FIND(None, M)],
+                "BOX_FIND_UP": [s.series for s in BOX_FIND(1, M)],
+                "BOX_FIND_DOWN": [s.series for s in BOX_FIND(-1, M)],
+            }
+            for k in range(2 * M + 2, len(c)):
+                top, bottom = old_box(c, o, h, l, k, M, up=True)
+                expected = {
+                    "BOX_DOWN": (bottom, top),
+                    "BOX_UP": old_box(c, o, h, l, k, M, up=False),
+                    "BOX_FIND": old_box_find(c, o, h, l, k, None, M),
+                    "BOX_FIND_UP": old_box_find(c, o, h, l, k, 1, M),
+                    "BOX_FIND_DOWN": old_box_find(c, o, h, l, k, -1, M),
+                }
+                top, bottom, top2, bottom2 = old_box(c, o, h, l, k, M, up=True, second=True)
+                expected["BOX_BOX_DOWN"] = (bottom, top, bottom2, top2)
+                expected["BOX_BOX_UP"] = old_box(c, o, h, l, k, M, up=False, second=True)
+                for name, values in expected.items():
+                    result = [series[k] for series in results[name]]
+                    assert np.array_equal(result, values, equal_nan=True), (name, M, k)
+
+
+@pytest.fixture
+def kernel_env(monkeypatch):
+    monkeypatch.setattr(kernels, "_selected", {})
+    monkeypatch.delenv(kernels.KERNELS_ENV, raising=False)
+    monkeypatch.delenv(kernels.KERNEL_CACHE_ENV, raising=False)
+    return monkeypatch
+
+
+def fail_benchmark(name, *args, **kwargs):
+    raise AssertionError("benchmark {}".format(name))
+
+
+def test_set_kernel(kernel_env):
+    kernel_env.setattr(kernels, "benchmark_kernel", fail_benchmark)
+    set_kernel("MA", "numpy")
+    assert get_kernel("MA") is KERNELS["MA"]["numpy"]
+    with pytest.raises(FormulaException):
+        set_kernel("MA", "missing")
+    with pytest.raises(FormulaException):
+        set_kernel("MISSING", "numpy")
+    with pytest.raises(FormulaException):
+        get_kernel("MISSING")
+    set_kernel("MA", None)
+    with pytest.raises(AssertionError):
+        get_kernel("MA")
+
+
+def test_kernels_env(kernel_env):
+    kernel_env.setattr(kernels, "benchmark_kernel", fail_benchmark)
+    kernel_env.setenv(kernels.KERNELS_ENV, "missing, numpy, MA=numpy")
+    for name in KERNELS:
+        assert get_kernel(name) is KERNELS[name]["numpy"]
+
+    kernel_env.setattr(kernels, "_selected", {})
+    impl = list(KERNELS["EMA"])[-1]
+    kernel_env.setenv(kernels.KERNELS_ENV, "EMA={}".format(impl))
+    assert get_kernel("EMA") is KERNELS["EMA"][impl]
+    # set_kernel 优先于环境变量
+    set_kernel("EMA", "numpy")
+    assert get_kernel("EMA") is KERNELS["EMA"]["numpy"]
+
+
+def test_kernel_benchmark(kernel_env, tmp_path):
+    timings = kernels.benchmark_kernel("SUM", size=1000, repeat=1)
+    assert "numpy" in timings
+    get_kernel("SUM")
+    assert not list(tmp_path.iterdir())
+
+    path = tmp_path / "kernels.json"
+    kernel_env.setenv(kernels.KERNEL_CACHE_ENV, str(path))
+    kernel_env.setattr(kernels, "_selected", {})
+    impl = kernels.benchmark_kernel("HHV", size=1000, repeat=1)
+    get_kernel("HHV")
+    assert json.loads(path.read_text())["HHV"] in impl
+
+    kernel_env.setattr(kernels, "_selected", {})
+    kernel_env.setattr(kernels, "benchmark_kernel", fail_benchmark)
+    path.write_text(json.dumps({"HHV": "numpy"}))
+    assert get_kernel("HHV") is KERNELS["HHV"]["numpy"]
+
+
+def test_benchmark_clean_input(kernel_env):
+    # 测速用没有 nan 的数据，中间有 nan、inf 时结果不一致的实现只在检查时排除
+    numpy_ma = KERNELS["MA"]["numpy"]
+
+    def nan_to_num_ma(series, n):
+        return numpy_ma(np.nan_to_num(series), n)
+
+    kernel_env.setitem(KERNELS["MA"], "nan_to_num", nan_to_num_ma)
+    timings = kernels.benchmark_kernel("MA", size=1000, repeat=1)
+    assert "numpy" in timings and "nan_to_num" not in timings
+
+
+def test_benchmark_chooses_talib(kernel_env):
+    pytest.importorskip("talib")
+    numpy_ma = KERNELS["MA"]["numpy"]
+
+    def slow_ma(*args):
+        time.sleep(0.002)
+        return numpy_ma(*args)
+
+    kernel_env.setitem(KERNELS["MA"], "numpy", slow_ma)
+    timings = kernels.benchmark_kernel("MA", repeat=3)
+    assert timings["talib"] < 0.001
+    assert get_kernel("MA") is KERNELS["MA"]["talib"]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+
+from __future__ import division
+
+import pytest
+
+from funcat.api import (C, O, H, L, MA, EMA, SMA, SUM, REF, CROSS, HHV, COUNT, LAST, CCI, CLOSE, OPEN)
+from funcat.context import ExecutionContext
+from funcat.data.trading_calendar import TradingCalendar
+from funcat.helper import select
+from funcat.lookback import infer_lookback, get_decay_bars, get_fetch_start_date, EMA_TOLERANCE
+from funcat.time_series import bar_cache
+
+from conftest import MemoryDataBackend, get_weekdays
+
+
+@pytest.fixture
+def context(data_backend):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id="000001.XSHE", data_backend=data_backend):
+        yield
+
+
+@pytest.mark.parametrize("func, expected", [
+    (lambda: MA(C, 5), 5),
+    (lambda: REF(MA(C, 5), 3), 8),
+    (lambda: CROSS(MA(C, 5), MA(C, 10)), 11),
+    (lambda: C > O, 1),
+    (lambda: COUNT(C > O, 5) + LAST(C > O, 5, 2), 6),
+    (lambda: EMA(C, 10), 10 + get_decay_bars(2 / 11, EMA_TOLERANCE)),
+    (lambda: SMA(C, 3, 1), 1 + get_decay_bars(1 / 3, EMA_TOLERANCE)),
+    (lambda: CCI(H, L, C), 14),
+    (lambda: MA(C, 5) * 0 + 1, 5),
+    # 需要全部历史
+    (lambda: HHV(C, 0), None),
+    (lambda: SUM(C, 0), None),
+])
+def test_get_lookback(context, func, expected):
+    assert infer_lookback(func)[0] == expected
+
+
+def test_get_decay_bars():
+    assert get_decay_bars(1, EMA_TOLERANCE) == 0
+    assert get_decay_bars(0, EMA_TOLERANCE) is None
+    n = get_decay_bars(0.5, EMA_TOLERANCE)
+    assert 0.5 ** n <= EMA_TOLERANCE < 0.5 ** (n - 1)
+
+
+def test_infer_freqs(context):
+    assert infer_lookback(lambda: C["1w"] > MA(C, 5)) == (5, set(["1w", None]))
+
+
+def test_infer_failure(context):
+    # 需要取值的 Python 语句、抛出异常的公式都推断不了
+    assert infer_lookback(lambda: 1 if C > O else 0) == (None, None)
+    assert infer_lookback(lambda: 1 / 0) == (None, None)
+    assert infer_lookback(lambda: MA(C, "x")) == (None, set([None]))
+
+
+def test_fetch_start_date():
+    calendar = TradingCalendar(get_weekdays(600))
+    date = calendar.dates[-1]
+    assert get_fetch_start_date(calendar, date, 5, "1d") == calendar.dates[-5]
+    assert get_fetch_start_date(calendar, date, 2, "1w") == calendar.dates[-10]
+    assert get_fetch_start_date(calendar, date, 2, "1M") == calendar.dates[-46]
+    assert get_fetch_start_date(calendar, date, 240, "5m") == calendar.dates[-6]
+    assert get_fetch_start_date(calendar, date, 1000, "1d") is None
+    assert get_fetch_start_date(calendar, date, 5, "2h") is None
+
+
+@pytest.mark.parametrize("func", [
+    lambda: CROSS(MA(CLOSE, 5), MA(CLOSE, 20)),
+    lambda: (CLOSE > REF(HHV(CLOSE, 10), 1)) | (COUNT(CLOSE > OPEN, 5) >= 4),
+    lambda: CLOSE > OPEN,
+])
+def test_select_auto_lookback(func):
+    # 只取最近的行情，选出来的和使用全部历史一样
+    data_backend = MemoryDataBackend()
+    dates = data_backend.dates[-20:]
+
+    def run(lookback):
+        selected = []
+        bar_cache.clear()
+        try:
+            with ExecutionContext(data_backend=data_backend, start_date=data_backend.dates[0]):
+                select(func, start_date=dates[0], end_date=dates[-1], lookback=lookback,
+                       callback=lambda *args: selected.append(args))
+        finally:
+            bar_cache.clear()
+        return selected
+
+    loaded = []
+    get_price = data_backend.get_price
+    data_backend.get_price = lambda *args: loaded.append(get_price(*args)) or loaded[-1]
+    expected = run(None)
+    full_rows = sum(len(bars) for bars in loaded)
+    del loaded[:]
+    assert run("auto") == expected
+    assert sum(len(bars) for bars in loaded) < full_rows / 5
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+#
+
+import gc
+
+import numpy as np
+import pytest
+
+from funcat.data.cache import slice_bars
+from funcat.data.resample import Resampler, resample_bars, get_source_freq
+
+from conftest import BAR_DTYPE, get_weekdays
+
+
+def test_resampler_releases_history(data_backend):
+    # 源历史被回收后，合成的结果不再占用内存
+    resampler = Resampler()
+    histories = [data_backend.get_price(order_book_id, 0, 99999999, "1d") for order_book_id in sorted(data_backend.data)]
+    for i, history in enumerate(histories):
+        resampler.get_bars(i, history, "1w", data_backend.dates[-1])
+    assert len(resampler) == len(histories)
+
+    del history
+    histories.pop()
+    gc.collect()
+    assert len(resampler) == len(histories)
+
+    # 相同 key 换了新的源历史，重新合成
+    history = data_backend.get_price("000001.XSHE", 0, 99999999, "1d")
+    first = resampler.get_bars(0, histories[0], "1w", data_backend.dates[-1])
+    assert resampler.get_bars(0, history, "1w", data_backend.dates[-1]) is not first
+    del histories[:]
+    gc.collect()
+    assert len(resampler) == 1
+
+
+def get_minute_bars(days=3):
+    """每天 240 根 1m，9:31-11:30 和 13:01-15:00"""
+    rng = np.random.RandomState(1)
+    minutes = [h * 100 + m for h, m in
+               [divmod(t, 60) for t in list(range(9 * 60 + 31, 11 * 60 + 31)) + list(range(13 * 60 + 1, 15 * 60 + 1))]]
+    dt = [date * 1000000 + hhmm * 100 for date in get_weekdays(days) for hhmm in minutes]
+    count = len(dt)
+    bars = np.zeros(count, dtype=BAR_DTYPE)
+    bars["datetime"] = dt
+    bars["close"] = 10 + np.cumsum(rng.randn(count) * 0.01)
+    bars["open"] = bars["close"] + rng.randn(count) * 0.01
+    bars["high"] = np.maximum(bars["open"], bars["close"]) + 0.01
+    bars["low"] = np.minimum(bars["open"], bars["close"]) - 0.01
+    bars["volume"] = rng.rand(count) * 1e4
+    bars["total_turnover"] = bars["volume"] * bars["close"]
+    bars = bars.view(np.recarray)
+    bars.flags.writeable = False
+    return bars
+
+
+def assert_bars_equal(bars, expected):
+    assert len(bars) == len(expected)
+    for name in expected.dtype.names:
+        assert np.array_equal(bars[name], expected[name])
+
+
+def test_resample_bars():
+    bars = get_minute_bars(1)
+    resampled, starts = resample_bars(bars, "60m")
+    assert len(resampled) == 4
+    assert starts.tolist() == [0, 60, 120, 180]
+    # 每根 bar 的时间是周期中最后一根 1m 的时间
+    assert [dt % 1000000 // 100 for dt in resampled["datetime"]] == [1030, 1130, 1400, 1500]
+    assert resampled["open"][1] == bars["open"][60]
+    assert resampled["close"][1] == bars["close"][119]
+    assert resampled["high"][1] == bars["high"][60:120].max()
+    assert resampled["low"][1] == bars["low"][60:120].min()
+    assert np.isclose(resampled["volume"][1], bars["volume"][60:120].sum())
+
+    resampled, _ = resample_bars(get_minute_bars(1)[:0], "5m")
+    assert len(resampled) == 0
+
+
+def test_resample_weekly(data_backend):
+    history = data_backend.get_price("000001.XSHE", 0, 99999999, "1d")
+    resampled, starts = resample_bars(history, "1w")
+    # 2015-01-05 是周一，每周 5 个交易日
+    assert len(resampled) == 120
+    assert (np.diff(starts) == 5).all()
+    assert resampled["datetime"][0] // 1000000 == 20150109
+    assert resampled["close"][0] == history["close"][4]
+
+    resampled, _ = resample_bars(history, "1M")
+    assert [dt // 1000000 for dt in resampled["datetime"][:2]] == [20150130, 20150227]
+
+
+@pytest.mark.parametrize("freq, source_freq", [("1w", "1d"), ("1M", "1d"), ("5m", "1m"), ("60m", "1m")])
+def test_resampler_matches_slice(data_backend, freq, source_freq):
+    # 截止时间在周期中间时最后一根 bar 只合成截止之前的部分，和先截取再合成一样
+    assert get_source_freq(freq) == source_freq
+    if source_freq == "1d":
+        history = data_backend.get_price("000002.XSHE", 0, 99999999, "1d")
+        dt = history["datetime"]
+        ends = [int(x) // 1000000 for x in dt[[0, 1, 3, 99, 100, 150, 287, 300, -1]]] + [20150103, 20150110]
+    else:
+        history = get_minute_bars()
+        dt = history["datetime"]
+        ends = [int(x) for x in dt[[0, 2, 4, 5, 59, 60, 61, 119, 120, 121, 239, 240, 241, 500, -1]]]
+        ends += [int(dt[0]) // 1000000, int(dt[-1]) // 1000000, int(dt[300]) - 1]
+
+    resampler = Resampler()
+    for end in ends:
+        expected, _ = resample_bars(slice_bars(history, end=end), freq)
+        assert_bars_equal(resampler.get_bars("key", history, freq, end), expected)
+    assert len(resampler) == 1
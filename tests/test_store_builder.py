@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from funcat.data.memmap_data_backend import MemmapDataBackend, FreqStore, INDEX_FILE
+from funcat.data.store_builder import StoreBuilder
+
+
+def build(data_backend, path, start, end, incremental=True):
+    StoreBuilder(data_backend, str(path), verbose=False).build(start=start, end=end, incremental=incremental)
+
+
+def read_index(path):
+    with open(os.path.join(str(path), "1d", INDEX_FILE)) as f:
+        return json.load(f)
+
+
+def get_bars_files(path):
+    return sorted(name for name in os.listdir(os.path.join(str(path), "1d")) if name.endswith(".dat"))
+
+
+def assert_store(data_backend, path, start, end):
+    """存储中的 bars 和 data_backend 在 [start, end] 之间的完全一样"""
+    memmap_backend = MemmapDataBackend(str(path))
+    assert memmap_backend.get_order_book_id_list() == data_backend.get_order_book_id_list()
+    assert memmap_backend.get_trading_dates(start, end) == data_backend.get_trading_dates(start, end)
+    for order_book_id in data_backend.get_order_book_id_list():
+        expected = data_backend.get_price(order_book_id, start, end, "1d")
+        bars = memmap_backend.get_price(order_book_id, start, end, "1d")
+        assert bars.dtype.names == expected.dtype.names
+        for name in expected.dtype.names:
+            assert np.array_equal(bars[name], expected[name])
+    # 预留空间和其他股票互不重叠
+    locs = sorted(read_index(path)["securities"].values())
+    for (offset, length, capacity), (next_offset, _, _) in zip(locs, locs[1:] + [[read_index(path)["rows"], 0, 0]]):
+        assert length <= capacity and offset + capacity <= next_offset
+
+
+def test_build_round_trip(data_backend, tmp_path):
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+
+    # get_price 返回的是 memmap 的 view，不会 copy
+    memmap_backend = MemmapDataBackend(str(tmp_path))
+    bars = memmap_backend.get_price("000002.XSHE", dates[90], dates[120], "1d")
+    assert isinstance(bars.base, np.memmap) or isinstance(bars.base.base, np.memmap)
+    assert len(bars) == 31 - 10
+    assert memmap_backend.symbol("000002.XSHE") == "000002.XSHE"
+    with pytest.raises(KeyError):
+        memmap_backend.get_price("000001.XSHE", 20000101, 20000201, "1d")
+    with pytest.raises(KeyError):
+        memmap_backend.get_price("000001.XSHE", dates[0], dates[-1], "1m")
+
+
+def test_incremental_top_up(data_backend, tmp_path):
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[0], dates[450])
+    old_backend = MemmapDataBackend(str(tmp_path))
+    assert len(old_backend.get_price("000001.XSHE", dates[0], dates[-1], "1d")) == 451
+    index = read_index(tmp_path)
+
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+    # 新的 bars 写进预留空间，文件和位置都不变
+    assert get_bars_files(tmp_path) == ["bars.1.dat"]
+    new_index = read_index(tmp_path)
+    assert new_index["rows"] == index["rows"]
+    for order_book_id, (offset, length, capacity) in index["securities"].items():
+        assert new_index["securities"][order_book_id] == [offset, length + 149, capacity]
+    # 已经打开的 backend 仍然只看到原来的范围
+    assert len(old_backend.get_price("000001.XSHE", dates[0], dates[-1], "1d")) == 451
+
+
+def test_incremental_overflow(data_backend, tmp_path):
+    # 预留空间不够时整段移到文件末尾
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[0], dates[100])
+    index = read_index(tmp_path)
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+    assert get_bars_files(tmp_path) == ["bars.1.dat"]
+    for offset, _, _ in read_index(tmp_path)["securities"].values():
+        assert offset >= index["rows"]
+
+    # 没有新数据时不变
+    index = read_index(tmp_path)
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert read_index(tmp_path) == index
+
+
+def test_incremental_new_security(data_backend, tmp_path):
+    dates = data_backend.dates
+    data = data_backend.data
+    data_backend.data = {order_book_id: data[order_book_id] for order_book_id in ["000001.XSHE", "600000.XSHG"]}
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    data_backend.data = data
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+
+
+def test_back_fill(data_backend, tmp_path):
+    # --start 早于已存储的起始日期时补上之前的 bars
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[450], dates[-1])
+    assert read_index(tmp_path)["start"] == dates[450]
+
+    build(data_backend, tmp_path, dates[400], dates[-1])
+    assert read_index(tmp_path)["start"] == dates[400]
+    assert_store(data_backend, tmp_path, dates[400], dates[-1])
+    assert get_bars_files(tmp_path) == ["bars.1.dat"]
+
+
+def test_compact(data_backend, tmp_path):
+    # 补数据时股票被移到文件末尾，空出来的超过一半时重写
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[300], dates[-1])
+    build(data_backend, tmp_path, dates[290], dates[-1])
+    assert get_bars_files(tmp_path) == ["bars.1.dat"]
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    assert get_bars_files(tmp_path) == ["bars.2.dat"]
+    index = read_index(tmp_path)
+    assert index["file"] == "bars.2.dat"
+    assert index["start"] == dates[0]
+    assert index["rows"] == sum(capacity for _, _, capacity in index["securities"].values())
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+
+
+def test_compact_method(data_backend, tmp_path):
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[0], dates[-1])
+    path = os.path.join(str(tmp_path), "1d")
+    StoreBuilder(data_backend, str(tmp_path), verbose=False).compact(path, "1d")
+    assert get_bars_files(tmp_path) == ["bars.2.dat"]
+    assert FreqStore(path).meta["start"] == dates[0]
+    assert_store(data_backend, tmp_path, dates[0], dates[-1])
+
+
+def test_rebuild(data_backend, tmp_path):
+    dates = data_backend.dates
+    build(data_backend, tmp_path, dates[0], dates[300])
+    build(data_backend, tmp_path, dates[100], dates[-1], incremental=False)
+    assert get_bars_files(tmp_path) == ["bars.2.dat"]
+    assert_store(data_backend, tmp_path, dates[100], dates[-1])
+    assert MemmapDataBackend(str(tmp_path)).get_price("000001.XSHE", dates[0], dates[-1], "1d")[0]["datetime"] == \
+        dates[100] * 1000000
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+import pytest
+
+from funcat.api import MA, EMA, SUM, STD, SMA, HHV, LLV
+from funcat.streaming import (StreamingMA, StreamingEMA, StreamingSUM, StreamingSTD, StreamingSMA, StreamingHHV,
+                              StreamingLLV)
+from funcat.time_series import NumericSeries
+from funcat.utils import FormulaException
+
+
+def get_data(kind, size=300):
+    rng = np.random.RandomState(0)
+    data = 10 + np.cumsum(rng.randn(size))
+    if kind == "leading_nan":
+        data[:5] = np.nan
+    elif kind == "nan":
+        data[[100, 160]] = np.nan
+    elif kind == "inf":
+        data[150] = np.inf
+        data[200] = -np.inf
+    elif kind == "large":
+        data += 1e8
+    return data
+
+
+INDICATORS = [
+    (lambda s: MA(s, 10), lambda: StreamingMA(10)),
+    (lambda s: MA(s, 1), lambda: StreamingMA(1)),
+    (lambda s: EMA(s, 10), lambda: StreamingEMA(10)),
+    (lambda s: SUM(s, 10), lambda: StreamingSUM(10)),
+    (lambda s: STD(s, 10), lambda: StreamingSTD(10)),
+    (lambda s: SMA(s, 10, 3), lambda: StreamingSMA(10, 3)),
+    (lambda s: HHV(s, 10), lambda: StreamingHHV(10)),
+    (lambda s: LLV(s, 10), lambda: StreamingLLV(10)),
+    (lambda s: HHV(s, 0), lambda: StreamingHHV(0)),
+    (lambda s: LLV(s, 1), lambda: StreamingLLV(1)),
+]
+INDICATOR_IDS = ["MA", "MA1", "EMA", "SUM", "STD", "SMA", "HHV", "LLV", "HHV0", "LLV1"]
+
+
+@pytest.mark.parametrize("kind", ["clean", "leading_nan", "nan", "inf", "large"])
+@pytest.mark.parametrize("batch, streaming", INDICATORS, ids=INDICATOR_IDS)
+def test_streaming_matches_batch(batch, streaming, kind):
+    data = get_data(kind)
+    with np.errstate(all="ignore"):
+        expected = np.asarray(batch(NumericSeries(data)).series, dtype=np.float64)
+    indicator = streaming()
+    result = indicator.update_many(data)
+    assert len(result) == len(data)
+    # HHV、LLV 的结果去掉了开头不满一个窗口的部分
+    assert np.isnan(result[:len(data) - len(expected)]).all()
+    # 数值很大时两种 STD 的算法都有相消，有效数字少几位
+    rtol = 1e-6 if kind == "large" else 1e-9
+    assert np.allclose(result[len(data) - len(expected):], expected, rtol=rtol, atol=0, equal_nan=True)
+    assert indicator.count == len(data)
+    assert np.array_equal(indicator.value, result[-1], equal_nan=True)
+
+
+@pytest.mark.parametrize("batch, streaming", INDICATORS, ids=INDICATOR_IDS)
+def test_update_matches_update_many(batch, streaming):
+    data = get_data("nan")
+    warm = streaming()
+    warm.update_many(data[:200])
+    expected = streaming().update_many(data)
+    result = [warm.update(value) for value in data[200:]]
+    assert np.array_equal(result, expected[200:], equal_nan=True)
+
+
+def test_field(data_backend):
+    bars = data_backend.data["000001.XSHE"]
+    ma = StreamingMA(5, field="close")
+    hhv = StreamingHHV(5, field="high")
+    ma.update_many(bars[:-1])
+    hhv.update_many(bars[:-1])
+    assert np.isclose(ma.update(bars[-1]), bars["close"][-5:].mean())
+    assert hhv.update(bars[-1]) == bars["high"][-5:].max()
+
+
+def test_invalid_arguments():
+    with pytest.raises(FormulaException):
+        StreamingMA(0)
+    with pytest.raises(FormulaException):
+        StreamingHHV(-1)
+    with pytest.raises(FormulaException):
+        StreamingSMA(3, 4)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+
+import numpy as np
+import pytest
+
+from funcat.api import (CLOSE, MA, EMA, WMA, SMA, SUM, STD, MAX, MIN, COUNT, EVERY, EXIST, LAST, HHV, LLV,
+                        HHVBARS, LLVBARS, CROSS)
+from funcat.context import ExecutionContext
+from funcat.time_series import ensure_timeseries
+from funcat.utils import FormulaException
+
+
+@pytest.fixture(params=[False, True], ids=["eager", "lazy"])
+def context(request, data_backend):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id="000001.XSHE", data_backend=data_backend,
+                          lazy=request.param):
+        yield
+
+
+def test_scalar_operators(context):
+    x = ensure_timeseries(5)
+    assert MAX(1, 2).value == 2
+    assert MIN(1, 2).value == 1
+    assert (x + 3).value == 8
+    assert (3 - x).value == -2
+    assert len(x * 2) == 1
+    assert bool(x > 3)
+    assert not CROSS(x, 3).value
+
+
+@pytest.mark.parametrize("func, expected", [
+    (lambda x: MA(x, 5), 5),
+    (lambda x: EMA(x, 5), 5),
+    (lambda x: WMA(x, 5), 5),
+    (lambda x: SMA(x, 5, 2), 5),
+    (lambda x: SUM(x, 4), 20),
+    (lambda x: STD(x, 5), 0),
+    (lambda x: COUNT(x > 3, 5), 5),
+    (lambda x: EVERY(x > 3, 3), True),
+    (lambda x: EXIST(x < 3, 3), False),
+    (lambda x: LAST(x > 3, 5, 2), True),
+    (lambda x: HHV(x, 5), 5),
+    (lambda x: LLV(x, 5), 5),
+    (lambda x: HHVBARS(x, 5), 0),
+    (lambda x: LLVBARS(x, 5), 0),
+])
+def test_scalar_window(context, func, expected):
+    # 常数当作足够长的常数序列，结果不会截短其他序列
+    result = func(ensure_timeseries(5))
+    assert result.value == expected
+    combined = CLOSE + result
+    assert len(combined) == len(CLOSE)
+    assert np.isclose(combined.value, CLOSE.value + expected)
+
+
+@pytest.mark.parametrize("func", [
+    lambda x: COUNT(x > 3, 0),
+    lambda x: HHV(x, 0),
+    lambda x: SUM(x, 0),
+])
+def test_scalar_window_unbounded(data_backend, func):
+    with ExecutionContext(date=data_backend.dates[-1], order_book_id="000001.XSHE", data_backend=data_backend):
+        with pytest.raises(FormulaException):
+            func(ensure_timeseries(5))